@@ -4,156 +4,570 @@ TBW model fitting and SOA calculation
 Created on Mon Jan  7 16:15:45 2019
 
 @author: Phil
+
+Usage:
+    python TBW_fitting.py <subj>               fit one subject and show the plot
+    python TBW_fitting.py --all [--jobs N]     refit every data/msi_a/msi_a_sub*.csv in parallel
+    python TBW_fitting.py --all --fitter lm    refit the whole cohort as one batched least-squares problem
+    python TBW_fitting.py --check              compare the batched fitter against lmfit for every subject
+    python TBW_fitting.py <subj> --headless    fast path for between part A and B: batched fitter,
+                                               SOA file written first, Agg backend, no plt.show()
+    python TBW_fitting.py <subj> --bootstrap N add 95% bootstrap CIs and a stability flag to the
+                                               SOA file (N resamples, refit as one batch with the
+                                               same fitter; lmfit, lm, ml or compare); also
+                                               with --all for every subject it refits
+    python TBW_fitting.py <subj> --fitter joint  one two-sided model with a shared peak (grid start)
+    python TBW_fitting.py <subj> --fitter ml   binomial maximum likelihood on the sync/total counts
+    python TBW_fitting.py --all --fitter hier  hierarchical binomial fit of the whole cohort with
+                                               group priors (a single subject is fitted with the
+                                               rest of the cohort as its group)
+    python TBW_fitting.py --all --fitter compare [--criterion aic|bic]
+                                               binomial ML fits of every tbw_fit.COMPARE_MODELS
+                                               candidate; each subject's SOAs come from its best
+                                               model, the ranking goes to cohort_models.csv
+
+msi_a.py now writes the SOA file and fit results itself at the end of a full session
+(tbw_online), so running this between part A and B is only needed after an aborted
+session; python tbw_plot.py draws those sessions' figures from the same estimates.
+
+matplotlib and lmfit are only imported when a plot or an lmfit fit is needed. Saved
+figures are rendered by tbw_plot on a reused Agg figure; python tbw_plot.py redraws
+them all and the cohort contact sheet.
 """
 
 #%%
 import pandas as pd
 import numpy as np
-import os, sys
-import matplotlib.pyplot as plt
-from lmfit import Minimizer, Parameters, report_fit
-from sympy.solvers import solve
-from sympy import Symbol
-from pylab import savefig
-import pickle
+import os, sys, glob, re, argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tbw_models import solve_soas, unreachable_soas, joint_sides, side_model
+from tbw_fit import (START_PARAMS, FitResult, side_data, fit_tbw, fit_joint, fit_binomial, fit_hierarchical,
+                     compare_models, bootstrap_tbw)
+import msi_store, tbw_plot
 
 #wd
-os.chdir('C:/data/pjohnston/msi/')
+WD = 'C:/data/pjohnston/msi/'
+
+SOA_COLUMNS = ['ASOA95', 'ASOA50', 'VSOA50', 'VSOA95']
+
+#largest relative excess of the batched fitter's least-squares cost over lmfit's allowed by --check
+CHECK_RTOL = 1e-3
+
+COHORT_FILENAME = 'data' + os.sep + 'SOAs' + os.sep + 'cohort_SOAs.csv'
+MODELS_FILENAME = 'data' + os.sep + 'SOAs' + os.sep + 'cohort_models.csv'
+
+BATCH_FITTERS = ['lm', 'joint', 'ml', 'hier', 'compare']
+
+#model name recorded with the fit parameters; the ml/hier cost is a negative log-likelihood.
+#compare records the selected model, e.g. gumbel_ml
+FIT_MODEL = {'lmfit': 'sigmoid', 'lm': 'sigmoid', 'joint': 'joint', 'ml': 'sigmoid_ml', 'hier': 'sigmoid_hier'}
 
-#get subj number from command line
-subj = str(sys.argv[1])
+#fitters --bootstrap can refit resamples with: least squares (lmfit, lm) or binomial ML (ml, compare).
+#A joint fit's sides share a peak and a hier fit's a group prior, which per-side resamples can't keep
+BOOTSTRAP_FITTERS = {'lmfit': False, 'lm': False, 'ml': True, 'compare': True}
 
-#check for existing output filename
-output_filename = "data" + os.sep + "SOAs" + os.sep + "msi_a_sub" + subj + "_SOAs.csv"
-if os.path.isfile(output_filename):
-    sys.exit("Data for this subject already exists")
+#an SOA is stable if its 95% CI is at most this wide (ms) and it was solvable in this fraction of
+#resamples; the widths are about 1.5x those of a typical 304-trial session
+STABLE_CI_WIDTH = {'ASOA95': 200, 'ASOA50': 80, 'VSOA50': 80, 'VSOA95': 200}
+STABLE_SOLVED = 0.95
+
+
+def subject_paths(subj):
+    """Input and output filenames for one subject"""
+    return {'data': 'data' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '.csv',
+            'SOAs': 'data' + os.sep + 'SOAs' + os.sep + 'msi_a_sub' + subj + '_SOAs.csv',
+            'plot': 'data' + os.sep + 'plots' + os.sep + 'msi_a_sub' + subj + '_TBW.png',
+            'fit': 'data' + os.sep + 'fit_results' + os.sep + 'msi_a_sub' + subj + '_fit.csv',
+            'msi_b': 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '.csv',
+            'msi_b_journal': 'data' + os.sep + 'logfiles' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj
+                             + '_journal.jsonl'}
 
-#load data
-df = pd.read_csv('data' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '.csv')
 
 #%% calculate synchrony rate
-df_rate = pd.crosstab(index=df['SOA'], columns=df['resp_recode'], margins = True, margins_name = 'total')
-df_rate['SOA'] = df_rate.index
-df_rate['sync_rate'] = df_rate['sync']/df_rate['total']
-df_rate = df_rate.drop(['total'], axis = 0)
+def sync_rates(df):
+    """Rate of synchrony perception per SOA from a msi_a response dataframe.
+
+    Only sync/async responses are counted: no-response trials are in neither the rate nor total."""
+    df = df[df['resp_recode'].isin(['sync', 'async'])]
+    df_rate = pd.crosstab(index=df['SOA'], columns=pd.Categorical(df['resp_recode'], categories=['async', 'sync']),
+                          margins = True, margins_name = 'total', dropna = False)
+    df_rate.columns = df_rate.columns.astype(str)
+    df_rate.columns.name = 'resp_recode'
+    df_rate['SOA'] = df_rate.index
+    df_rate['sync_rate'] = df_rate['sync']/df_rate['total']
+    df_rate = df_rate.drop(['total'], axis = 0)
+
+    #convert df_rate to float
+    return df_rate.astype('float')
 
-#convert df_rate to float
-df_rate = df_rate.astype('float')
 
 #%%fit curves
 
-#residual function (sigmoid)    
+#residual function (sigmoid)
 def residual(params, x, data):
     a = params['a']
     b = params['b']
     c = params['c']
-    
+
     model = a / (1 + np.exp(-b * (x - c))) #sigmoid
-    
+
     return model - data
 
-#fit left curve
-left_data_x = df_rate.SOA[df_rate.SOA <= 0]
-left_data_y = df_rate.sync_rate[df_rate.SOA <= 0]
-
-params = Parameters()
-params.add('a', value = 1)
-params.add('b', value = 0.01)
-params.add('c', value = -150)
-
-l_minner = Minimizer(residual, params, fcn_args=(left_data_x, left_data_y))
-l_result = l_minner.minimize()
-
-report_fit(l_result)
-
-###extract left parameters from model
-left_a = l_result.params['a'].value
-left_b = l_result.params['b'].value
-left_c = l_result.params['c'].value
-
-###solve for left SOAs
-x = Symbol('x')
-ASOA50 = solve(left_a / (1 + 2.71828 ** (-left_b * (x - left_c))) - 0.5, x, rational = False)[0] #unclear why np.exp() doesn't work
-ASOA95 = solve(left_a / (1 + 2.71828 ** (-left_b * (x - left_c))) - 0.05, x, rational = False)[0]
-
-###generate left sigmoid line data
-x_l_fun = np.linspace(-300, 0, 500)
-y_l_fun = left_a / (1 + np.exp(-left_b * (x_l_fun - left_c)))
-
-#fit right curve
-right_data_x = df_rate.SOA[df_rate.SOA >= 0]
-right_data_y = df_rate.sync_rate[df_rate.SOA >= 0]
-
-params = Parameters()
-params.add('a', value = 1)
-params.add('b', value = -0.01)
-params.add('c', value = 150)
-
-r_minner = Minimizer(residual, params, fcn_args=(right_data_x, right_data_y))
-r_result = r_minner.minimize()
-
-report_fit(r_result)
-
-###extract right parameters from model
-right_a = r_result.params['a'].value
-right_b = r_result.params['b'].value
-right_c = r_result.params['c'].value
-
-###solve for SOAs
-x = Symbol('x')
-VSOA50 = solve(right_a / (1 + 2.71828 ** (-right_b * (x - right_c))) - 0.5, x, rational = False)[0] #unclear why np.exp() doesn't work
-VSOA95 = solve(right_a / (1 + 2.71828 ** (-right_b * (x - right_c))) - 0.05, x, rational = False)[0]
-
-###generate right sigmoid line data
-x_r_fun = np.linspace(0, 300, 500)
-y_r_fun = right_a / (1 + np.exp(-right_b * (x_r_fun - right_c)))
-
-
-# try to plot results
-try:
-    #original data
-    plt.plot(left_data_x, left_data_y, 'ko')
-    plt.plot(right_data_x, right_data_y, 'ko')
-    
-    #plot sigmoid
-    plt.plot(x_l_fun, y_l_fun, 'b')
-    plt.plot(x_r_fun, y_r_fun, 'b')
-    
-    #plot SOAs and annotate
-    plt.plot(ASOA50, 0.5, 'k+')
-    plt.annotate(str(round(ASOA50,2)), (ASOA50, 0.5))
-    plt.plot(ASOA95, 0.05, 'k+')
-    plt.annotate(str(round(ASOA95,2)), (ASOA95, 0.05))
-    plt.plot(VSOA50, 0.5, 'k+')
-    plt.annotate(str(round(VSOA50,2)), (VSOA50, 0.5))
-    plt.plot(VSOA95, 0.05, 'k+')
-    plt.annotate(str(round(VSOA95,2)), (VSOA95, 0.05))
-    
-    #format plot
-    plt.title('msi_a_sub' + subj)
-    plt.ylabel('Rate of synchrony perception')
-    plt.xlabel('SOA (ms)')
-    plt.draw()
-    
-    #save plot
-    savefig('data' + os.sep + 'plots' + os.sep + 'msi_a_sub' + subj + '_TBW.png', bbox_inches='tight')
-except ImportError:
-    pass
 
-#save SOAs and rounded SOAs (nearest multiple of 10) to csv
-SOA_out = pd.DataFrame({'ASOA95':[ASOA95], 'ASOA50':[ASOA50], 'VSOA50':[VSOA50], 'VSOA95':[VSOA95], 
-                        'ASOA95r':[round(ASOA95, -1)], 'ASOA50r':[round(ASOA50, -1)], 'VSOA50r':[round(VSOA50, -1)], 'VSOA95r':[round(VSOA95, -1)]})
-SOA_out.to_csv(output_filename)
+def pyplot():
+    """Import pyplot on first use (only needed to show a figure; see tbw_plot)"""
+    import matplotlib.pyplot as plt
+    return plt
+
 
-#pickle fit results objects
-with open('data' + os.sep + "fit_results" + os.sep + "msi_a_sub" + subj + "_left_fit.pickle", "wb") as output_file:
-    pickle.dump(l_result, output_file)
+def fit_side(df_rate, side):
+    """Fit the sigmoid to the left (SOA <= 0) or right (SOA >= 0) half of the TBW with lmfit"""
+    from lmfit import Minimizer, Parameters
 
-with open('data' + os.sep + "fit_results" + os.sep + "msi_a_sub" + subj + "_right_fit.pickle", "wb") as output_file:
-    pickle.dump(r_result, output_file)
+    params = Parameters()
+    for name, value in START_PARAMS[side].items():
+        params.add(name, value = value)
 
-#print SOAs and show plot
-print(SOA_out)
-plt.show()
+    minner = Minimizer(residual, params, fcn_args=side_data(df_rate, side))
+    return minner.minimize()
 
 
+def plot_tbw(subj, df_rate, left_params, right_params, soas, filename, model='sigmoid'):
+    """Plot data, fitted curves and SOAs for one subject in a pyplot window and save to filename.
+
+    Only for showing a figure; saved-only figures are rendered by tbw_plot.render."""
+    plt = pyplot()
+    fig = plt.figure()
+    ax = fig.add_subplot()
+    tbw_plot.set_tbw(tbw_plot.draw_tbw(ax), df_rate, left_params, right_params, soas, model=model)
+
+    #format plot
+    ax.set_title('msi_a_sub' + subj)
+    ax.set_ylabel('Rate of synchrony perception')
+    ax.set_xlabel('SOA (ms)')
+
+    #save plot
+    fig.savefig(filename, bbox_inches='tight')
+    return fig
+
+
+def soa_intervals(left, right, level=0.95, model='sigmoid'):
+    """Bootstrap CIs of each SOA from resampled left/right parameters (n_resamples, n_params).
+
+    Returns a one-row dataframe with <SOA>_lo, <SOA>_hi, <SOA>_solved (fraction of resamples
+    where the target rate was reachable), <SOA>_stable and stable (all four stable)."""
+    soas = solve_soas(left, right, model)
+    tail = 50 * (1 - level)
+    out = {}
+    for k in SOA_COLUMNS:
+        x = soas[k][~np.isnan(soas[k])]
+        lo, hi = np.percentile(x, [tail, 100 - tail]) if len(x) else (np.nan, np.nan)
+        solved = len(x) / float(len(soas[k]))
+        out[k + '_lo'], out[k + '_hi'], out[k + '_solved'] = [lo], [hi], [solved]
+        out[k + '_stable'] = [bool(hi - lo <= STABLE_CI_WIDTH[k] and solved >= STABLE_SOLVED)]
+    out['stable'] = [all(out[k + '_stable'][0] for k in SOA_COLUMNS)]
+    return pd.DataFrame(out)
+
+
+def split_joint(result):
+    """Per-side FitResults from a joint-model FitResult (cost, nfev and success are shared)"""
+    left, right = joint_sides(result.params)
+    return FitResult(left, *result[1:]), FitResult(right, *result[1:])
+
+
+def compare_fit(df_rates, criterion='bic', init=None, jobs=None):
+    """Fit every candidate model to a list of synchrony-rate dataframes (tbw_fit.compare_models, the
+    models on jobs processes) and keep each subject's best by criterion. Returns one (model, left,
+    right) per subject, model as recorded in the fit file (e.g. 'gumbel_ml'), and the comparison table."""
+    fits, table = compare_models(df_rates, criterion=criterion, jobs=jobs, init=init or 'grid')
+    selected = table[table.selected].set_index('subject').model
+    out = []
+    for i in range(len(df_rates)):
+        l_batch, r_batch = fits[selected[i]]
+        out.append((selected[i] + '_ml',) + tuple(FitResult(*[v[i] for v in res]) for res in (l_batch, r_batch)))
+    return out, table
+
+
+def model_summary(table, criterion='bic'):
+    """Per candidate model: subjects it was selected for, converged fits and summed criterion"""
+    return table.groupby('model', sort=False).agg(selected=('selected', 'sum'), converged=('success', 'sum'),
+                                                  **{criterion: (criterion, 'sum')})
+
+
+def batch_fit(df_rates, fitter='lm', init=None):
+    """Fit a list of synchrony-rate dataframes with the batched fitter; one (left, right) pair of
+    FitResults per subject. fitter is 'lm' (sides fitted separately by least squares, always from
+    START_PARAMS), 'joint', 'ml' (binomial maximum likelihood) or 'hier' (ml with group priors
+    from all of df_rates); init is the start of the last three."""
+    if fitter == 'joint':
+        results = fit_joint(df_rates, init=init or 'grid')
+        return [split_joint(FitResult(*[v[i] for v in results])) for i in range(len(df_rates))]
+    if fitter == 'ml':
+        l_batch, r_batch = fit_binomial(df_rates, init=init or 'grid')
+    elif fitter == 'hier':
+        (l_batch, r_batch), _ = fit_hierarchical(df_rates, init=init or 'grid')
+    else:
+        l_batch, r_batch = fit_tbw(df_rates)
+    return [tuple(FitResult(*[v[i] for v in res]) for res in (l_batch, r_batch)) for i in range(len(df_rates))]
+
+
+def fit_subject(subj, verbose=True, show=False, fitter='lmfit', headless=False, bootstrap=0, init=None,
+                criterion='bic'):
+    """Fit both sides of the TBW for one subject and write SOAs, plot and fit results.
+
+    fitter is 'lmfit' (Minimizer), 'lm' (batched analytic-Jacobian fitter), 'joint'
+    (two-sided model with a shared peak), 'ml' (binomial likelihood), 'hier' (ml with group
+    priors estimated together with every other msi_a subject) or 'compare' (ml fits of every
+    candidate model, the best by criterion 'aic' or 'bic' kept). init is the start of every
+    batched fitter but lm: 'grid' (default) or 'fixed' (START_PARAMS, which lm always uses).
+    headless plots with the Agg backend and never shows a window.
+    bootstrap > 0 adds CIs from that many resamples to the SOA file, refitted the way the
+    data was (see BOOTSTRAP_FITTERS; not available for joint and hier).
+    Returns the SOA_out dataframe."""
+    if bootstrap and fitter not in BOOTSTRAP_FITTERS:
+        raise ValueError("--bootstrap is not available for fitter " + fitter)
+    df_rate = sync_rates(pd.read_csv(subject_paths(subj)['data']))
+    model = FIT_MODEL.get(fitter)
+
+    if fitter == 'lmfit':
+        l_result = fit_side(df_rate, 'left')
+        r_result = fit_side(df_rate, 'right')
+
+        if verbose:
+            from lmfit import report_fit
+            report_fit(l_result)
+            report_fit(r_result)
+
+        left = [l_result.params[k].value for k in 'abc']
+        right = [r_result.params[k].value for k in 'abc']
+    elif fitter == 'hier':
+        others = [s for s in find_subjects() if s != subj]
+        df_rates = [df_rate] + [sync_rates(pd.read_csv(subject_paths(s)['data'])) for s in others]
+        l_result, r_result = batch_fit(df_rates, fitter, init)[0]
+        left, right = l_result.params, r_result.params
+    elif fitter == 'compare':
+        fits, table = compare_fit([df_rate], criterion, init, jobs=1) #one subject: quicker than starting a pool
+        model, l_result, r_result = fits[0]
+        left, right = l_result.params, r_result.params
+
+        if verbose:
+            print(table.drop(columns='subject').to_string(index=False))
+    else:
+        l_result, r_result = batch_fit([df_rate], fitter, init)[0]
+        left, right = l_result.params, r_result.params
+
+        if verbose:
+            print(l_result)
+            print(r_result)
+
+    intervals = bootstrap_intervals(df_rate, left, right, bootstrap, fitter, model) if bootstrap else None
+
+    return write_subject(subj, df_rate, left, right, l_result, r_result, show=show, headless=headless,
+                         intervals=intervals, model=model)
+
+
+def bootstrap_intervals(df_rate, left, right, n_resamples, fitter, model):
+    """soa_intervals from n_resamples resamples of one subject refitted as fitter fitted it
+    (left, right: the fit's parameters, the resamples' start; model: its recorded model name)"""
+    l_boot, r_boot = bootstrap_tbw(df_rate, n_resamples, start=(left, right), model=side_model(model),
+                                   likelihood=BOOTSTRAP_FITTERS[fitter])
+    return soa_intervals(l_boot.params, r_boot.params, model=side_model(model))
+
+
+def write_soas(subj, soas, intervals=None, source='offline'):
+    """Write the subject's SOA file from solved SOAs (ms) and return it as a dataframe.
+
+    intervals (from soa_intervals) are appended as extra columns. source is recorded in the
+    file: 'offline' for fits made here, 'online' or 'adaptive' for the ones msi_a.py writes at
+    the end of a session. Nothing is written if an SOA could not be solved."""
+    paths = subject_paths(subj)
+    unreachable = unreachable_soas(soas)
+    for name in unreachable:
+        print("Warning: sub" + subj + " " + name + " could not be solved - target rate is above fitted asymptote")
+
+    #save SOAs and rounded SOAs (nearest multiple of 10) to csv
+    SOA_out = pd.DataFrame({k: [soas[k]] for k in SOA_COLUMNS})
+    for k in SOA_COLUMNS:
+        SOA_out[k + 'r'] = round(soas[k], -1)
+    if intervals is not None:
+        SOA_out = pd.concat([SOA_out, intervals], axis=1)
+        if not intervals.stable[0]:
+            print("Warning: sub" + subj + " SOAs are unstable - check the bootstrap CIs in " + paths['SOAs'])
+    SOA_out['source'] = source
+
+    #msi_b.py cannot run with a missing SOA, so no SOA file is written rather than one with NaNs
+    if unreachable:
+        print("Warning: sub" + subj + " SOA file not written - set " + ', '.join(unreachable)
+              + " by hand in " + paths['SOAs'] + " before running msi_b.py")
+    else:
+        SOA_out.to_csv(paths['SOAs'])
+    return SOA_out
+
+
+def write_fit(subj, l_result, r_result, model='sigmoid'):
+    """Write the subject's fit results as plain numbers (one row per side) rather than pickled
+    result objects; tbw_plot draws the subject from these and the SOA file"""
+    msi_store.fit_rows(l_result, r_result, model).to_csv(subject_paths(subj)['fit'], index=False)
+
+
+def write_subject(subj, df_rate, left, right, l_result, r_result, show=False, headless=True, soas=None,
+                  intervals=None, model='sigmoid', source='offline'):
+    """Solve SOAs from fitted left/right parameters and write SOA file, plot and fit results.
+
+    model is the fit's recorded model name; its one-sided model (tbw_models.side_model) is solved and plotted.
+    soas overrides the solved SOAs. intervals and source go to the SOA file (see write_soas).
+    The SOA file is written before anything is plotted so msi_b.py can start as soon as possible."""
+    paths = subject_paths(subj)
+
+    #solve for SOAs (closed-form inverse, NaN if the target rate is above the fitted asymptote)
+    if soas is None:
+        soas = {k: float(v) for k, v in solve_soas(left, right, side_model(model)).items()}
+    SOA_out = write_soas(subj, soas, intervals, source)
+
+    # try to plot results
+    try:
+        if show and not headless:
+            fig = plot_tbw(subj, df_rate, left, right, soas, paths['plot'], side_model(model))
+            plt = pyplot()
+            plt.show()
+            plt.close(fig)
+        else:
+            tbw_plot.render(subj, df_rate, left, right, soas, paths['plot'], side_model(model))
+    except ImportError:
+        pass
+
+    write_fit(subj, l_result, r_result, model)
+    return SOA_out
+
+
+def check_fitter(subjs=None):
+    """Fit every subject with lmfit and with the batched fitter and report the largest differences.
+
+    Sides the data barely constrain can end at quite different a, b and c for the same fit,
+    so the two are compared on their cost and on the SOAs solved from them.
+    Returns True if the batched cost is nowhere more than CHECK_RTOL above lmfit's."""
+    subjs = subjs or find_subjects()
+    df_rates = [sync_rates(pd.read_csv(subject_paths(s)['data'])) for s in subjs]
+    batch = dict(zip(['left', 'right'], fit_tbw(df_rates)))
+
+    worst, worst_soa = 0, 0
+    for i, (subj, df_rate) in enumerate(zip(subjs, df_rates)):
+        ref = {}
+        for side in ['left', 'right']:
+            result = fit_side(df_rate, side)
+            ref[side] = np.array([result.params[k].value for k in 'abc'])
+            cost = 0.5 * result.chisqr
+            excess = (batch[side].cost[i] - cost) / max(cost, np.finfo(float).tiny)
+            if excess > CHECK_RTOL:
+                print("sub" + subj + " " + side + ": lmfit cost " + str(cost) + " " + str(ref[side])
+                      + ", batched cost " + str(batch[side].cost[i]) + " " + str(batch[side].params[i]))
+            worst = max(worst, excess)
+        ref_soas = solve_soas(ref['left'], ref['right'])
+        batch_soas = solve_soas(batch['left'].params[i], batch['right'].params[i])
+        for name in ref_soas:
+            both_nan = np.isnan(ref_soas[name]) and np.isnan(batch_soas[name])
+            diff = 0 if both_nan else np.abs(ref_soas[name] - batch_soas[name])
+            worst_soa = max(worst_soa, np.inf if np.isnan(diff) else diff)
+
+    print("Largest relative cost excess of the batched fitter: " + str(worst))
+    print("Largest SOA difference: " + str(round(worst_soa, 3)) + " ms")
+    return worst <= CHECK_RTOL
+
+
+#%% cohort fitting
+def find_subjects():
+    """Subject IDs of every msi_a data file, in numeric order"""
+    files = glob.glob('data' + os.sep + 'msi_a' + os.sep + 'msi_a_sub*.csv')
+    subjs = [re.match(r'msi_a_sub(\d+)\.csv$', os.path.basename(f)) for f in files]
+    return sorted([m.group(1) for m in subjs if m], key=int)
+
+
+def is_up_to_date(subj):
+    """True if the SOA file exists and is newer than the subject's msi_a data"""
+    paths = subject_paths(subj)
+    return (os.path.isfile(paths['SOAs']) and
+            os.path.getmtime(paths['SOAs']) >= os.path.getmtime(paths['data']))
+
+
+def in_use(subj):
+    """True if msi_b has been run with the subject's SOA file, which then must never change"""
+    paths = subject_paths(subj)
+    return os.path.isfile(paths['SOAs']) and (os.path.isfile(paths['msi_b']) or
+                                              os.path.isfile(paths['msi_b_journal']))
+
+
+def soa_source(subj):
+    """Source recorded in the subject's SOA file (see write_subject), None if there is no file.
+
+    Files written before the source was recorded count as 'offline'."""
+    filename = subject_paths(subj)['SOAs']
+    if not os.path.isfile(filename):
+        return None
+    SOA_out = pd.read_csv(filename, index_col=0)
+    return SOA_out.source.iloc[0] if 'source' in SOA_out else 'offline'
+
+
+def kept(subj):
+    """Why fit_cohort must leave the subject's SOA file alone, or None if it may refit it"""
+    if in_use(subj):
+        return "SOA file already used by msi_b"
+    source = soa_source(subj)
+    if source not in (None, 'offline'):
+        return source + " SOA file from msi_a"
+    return None
+
+
+def _init_worker():
+    #workers never open windows; each draws all its subjects on one reused Agg figure
+    tbw_plot.figure()
+
+
+def _fit_quietly(subj, bootstrap=0):
+    return subj, fit_subject(subj, verbose=False, headless=True, bootstrap=bootstrap)
+
+
+def _write_quietly(kwargs, bootstrap=0, fitter=None):
+    if bootstrap:
+        kwargs['intervals'] = bootstrap_intervals(kwargs['df_rate'], kwargs['left'], kwargs['right'], bootstrap,
+                                                  fitter, kwargs['model'])
+    return kwargs['subj'], write_subject(**kwargs)
+
+
+def fit_cohort(jobs=None, force=False, fitter='lmfit', init=None, criterion='bic', bootstrap=0):
+    """Refit every subject with changed inputs on a process pool and write the cohort table
+    and contact sheet.
+
+    jobs defaults to the number of cores; force refits subjects that are up to date.
+    Subjects whose SOA file msi_b has already used or msi_a wrote itself (online or adaptive)
+    are never refitted, even with force.
+    With a batched fitter (see batch_fit) all subjects are fit in one batch and only the outputs
+    are written in parallel. fitter='hier' always fits every subject, since each one's group
+    prior depends on the whole cohort, but still only writes the subjects that need it.
+    fitter='compare' fits every candidate model to the subjects being refitted, in parallel,
+    keeps each one's best by criterion and writes the ranking to MODELS_FILENAME.
+    bootstrap > 0 adds CIs to every refitted subject's SOA file as fit_subject does."""
+    if bootstrap and fitter not in BOOTSTRAP_FITTERS:
+        raise ValueError("--bootstrap is not available for fitter " + fitter)
+    subjs = find_subjects()
+    locked = {s: kept(s) for s in subjs}
+    for reason in sorted(set(locked.values()) - {None}):
+        print("Skipping sub" + ', sub'.join(s for s in subjs if locked[s] == reason) + ": " + reason)
+    todo = [s for s in subjs if not locked[s] and (force or not is_up_to_date(s))]
+    print("Fitting " + str(len(todo)) + " of " + str(len(subjs)) + " subjects")
+
+    batched = fitter in BATCH_FITTERS
+    if batched and todo:
+        fit_subjs = subjs if fitter == 'hier' else todo
+        df_rates = [sync_rates(pd.read_csv(subject_paths(s)['data'])) for s in fit_subjs]
+        if fitter == 'compare':
+            fits, table = compare_fit(df_rates, criterion, init, jobs)
+            table.insert(0, 'subj', [int(fit_subjs[i]) for i in table.subject])
+            table.drop(columns='subject').sort_values(['subj', 'delta']).to_csv(MODELS_FILENAME, index=False)
+            print(model_summary(table, criterion))
+        else:
+            fits = [(FIT_MODEL[fitter],) + results for results in batch_fit(df_rates, fitter, init)]
+        jobs_args = []
+        for subj, df_rate, (model, l_result, r_result) in zip(fit_subjs, df_rates, fits):
+            if subj not in todo:
+                continue
+            jobs_args.append(dict(subj=subj, df_rate=df_rate, left=l_result.params, right=r_result.params,
+                                  l_result=l_result, r_result=r_result, model=model))
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+        if batched:
+            futures = [pool.submit(_write_quietly, a, bootstrap, fitter) for a in jobs_args] if todo else []
+        else:
+            futures = [pool.submit(_fit_quietly, s, bootstrap) for s in todo]
+        for future in as_completed(futures):
+            try:
+                subj, _ = future.result()
+                print("sub" + subj + " done")
+            except Exception as e:
+                print("Fit failed: " + repr(e))
+
+    #summary table from every subject's SOA file, including ones that were skipped
+    rows = []
+    for subj in subjs:
+        filename = subject_paths(subj)['SOAs']
+        if os.path.isfile(filename):
+            SOA_out = pd.read_csv(filename, index_col=0)
+            SOA_out.insert(0, 'subj', int(subj))
+            rows.append(SOA_out)
+
+    if not rows:
+        return None
+    cohort = pd.concat(rows, ignore_index=True)
+    cohort.to_csv(COHORT_FILENAME, index=False)
+
+    #every subject's TBW on one page
+    try:
+        tbw_plot.contact_sheet([tbw_plot.load_subject(s) for s in tbw_plot.fitted_subjects()])
+    except ImportError:
+        pass
+
+    #refresh the Parquet store
+    try:
+        msi_store.build()
+    except ImportError:
+        print("pyarrow not installed - result store not updated")
+    return cohort
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TBW model fitting and SOA calculation')
+    parser.add_argument('subj', nargs='?', help='subject ID to fit')
+    parser.add_argument('--all', action='store_true', help='fit every msi_a subject file')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes for --all (default: all cores)')
+    parser.add_argument('--force', action='store_true',
+                        help='refit subjects whose inputs have not changed (never ones msi_b has run with or '
+                             'whose SOA file msi_a wrote)')
+    parser.add_argument('--fitter', choices=['lmfit'] + BATCH_FITTERS, default='lmfit',
+                        help='lmfit Minimizer, batched analytic-Jacobian least squares, the batched '
+                             'joint two-sided model, binomial maximum likelihood, hierarchical '
+                             'binomial fit with group priors, or the best of every candidate model')
+    parser.add_argument('--criterion', choices=['aic', 'bic'], default='bic',
+                        help='model selection criterion of --fitter compare')
+    parser.add_argument('--init', choices=['fixed', 'grid'], default=None,
+                        help='start of the joint, ml, hier and compare fitters: START_PARAMS or grid search '
+                             '(default); lm always starts from START_PARAMS')
+    parser.add_argument('--check', action='store_true', help='compare the batched fitter with lmfit and exit')
+    parser.add_argument('--headless', action='store_true',
+                        help='fast start: batched fitter, Agg backend and no plot window')
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N',
+                        help='add 95%% CIs from N bootstrap resamples to the SOA file (e.g. 2000); resamples '
+                             'are refitted with --fitter, which must be lmfit, lm, ml or compare')
+    parser.add_argument('--wd', default=WD, help='experiment directory containing data/')
+    args = parser.parse_args(argv)
+
+    if args.subj is None and not (args.all or args.check):
+        parser.error("give a subject ID, --all or --check")
+    if args.bootstrap and args.fitter not in BOOTSTRAP_FITTERS:
+        parser.error("--bootstrap is not available for --fitter " + args.fitter)
+
+    os.chdir(args.wd)
+
+    if args.check:
+        sys.exit(0 if check_fitter([args.subj] if args.subj else None) else 1)
+
+    if args.all:
+        print(fit_cohort(jobs=args.jobs, force=args.force, fitter=args.fitter, init=args.init,
+                         criterion=args.criterion, bootstrap=args.bootstrap))
+        return
+
+    #check for existing output filename
+    if os.path.isfile(subject_paths(args.subj)['SOAs']):
+        sys.exit("Data for this subject already exists")
+
+    #print SOAs and show plot
+    if args.headless:
+        fitter = args.fitter if args.fitter in BATCH_FITTERS else 'lm'
+        print(fit_subject(args.subj, verbose=False, fitter=fitter, headless=True, bootstrap=args.bootstrap,
+                          init=args.init, criterion=args.criterion))
+    else:
+        print(fit_subject(args.subj, show=True, fitter=args.fitter, bootstrap=args.bootstrap, init=args.init,
+                          criterion=args.criterion))
+
+
+if __name__ == '__main__':
+    main()
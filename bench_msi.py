@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the experiment scripts on the simulated backend
+
+Runs full msi_a and msi_b sessions headless (msi_sim) in a temporary directory and
+reports, per SOA condition:
+    - per-frame loop overhead: wall time between consecutive flips, i.e. the Python
+      work done per frame, separately for the jitter and core.rush stimulus frames
+    - I/O time: log/journal flushes on the main thread, background writes, final save
+    - trigger/flip alignment (msi_b): wall time from the flip returning to setData,
+      the trigger's offset from the flash flip in frames, and actual minus intended
+      time from the trigger log
+
+Usage:
+    python bench_msi.py [--part a|b] [--subj N]
+"""
+
+import os, time, argparse, tempfile, functools
+import numpy as np
+import pandas as pd
+import msi_logger
+from msi_sim import run_session
+from msi_triggers import load_triggers, trigger_latency
+from msi_events import CONDITION_CODES
+
+
+class IOTimer:
+    """Wraps msi_logger's writers and records how long each call takes"""
+
+    TARGETS = [('TrialLogger', 'flush', 'flush (main thread)'),
+               ('TrialLogger', '_write', 'write (logger thread)'),
+               (None, 'save_csv', 'save_csv')]
+
+    def __init__(self):
+        self.calls = {label: [] for _, _, label in self.TARGETS}
+        self._saved = []
+
+    def _wrap(self, function, label):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.calls[label].append(time.perf_counter() - start)
+        return timed
+
+    def __enter__(self):
+        for cls_name, name, label in self.TARGETS:
+            owner = getattr(msi_logger, cls_name) if cls_name else msi_logger
+            original = getattr(owner, name)
+            self._saved.append((owner, name, original))
+            setattr(owner, name, self._wrap(original, label))
+        return self
+
+    def __exit__(self, *exc):
+        for owner, name, original in self._saved:
+            setattr(owner, name, original)
+
+    def report(self):
+        rows = [(label, len(t), 1e3 * np.sum(t), 1e3 * np.max(t, initial=0)) for label, t in self.calls.items()]
+        return pd.DataFrame(rows, columns=['io', 'calls', 'total_ms', 'max_ms']).set_index('io')
+
+
+def _us(x):
+    return 1e6 * x
+
+
+def frame_overhead(sim, conditions):
+    """Per-condition distribution of wall time between consecutive flips of the same trial"""
+    flips = pd.DataFrame(sim.flips, columns=['t', 'wall', 'rush', 'flash', 'trial'])
+    flips['dt'] = flips.wall.diff()
+    same = (flips.trial == flips.trial.shift()) & (flips.rush == flips.rush.shift())
+    flips = flips[same & flips.trial.isin(conditions.index)]
+    flips['condition'] = conditions.loc[flips.trial].values
+    flips['phase'] = np.where(flips.rush, 'stimulus', 'jitter')
+    return (flips.groupby(['phase', 'condition']).dt
+            .agg(frames='size', median_us=lambda x: _us(x.median()),
+                 p99_us=lambda x: _us(x.quantile(0.99)), max_us=lambda x: _us(x.max())))
+
+
+def trigger_alignment(sim):
+    """Per-condition trigger latency after the preceding flip and offset from the flash flip"""
+    flips = pd.DataFrame(sim.flips, columns=['t', 'wall', 'rush', 'flash', 'trial'])
+    triggers = pd.DataFrame(sim.triggers, columns=['t', 'wall', 'value', 'trial'])
+    triggers = triggers[triggers.value.isin(CONDITION_CODES)]
+
+    #last flip before each trigger and the flash flip of the same trial
+    idx = np.searchsorted(flips.wall.values, triggers.wall.values) - 1
+    triggers['after_flip_us'] = _us(triggers.wall.values - flips.wall.values[idx])
+    flash_t = flips[flips.flash].groupby('trial').t.first()
+    triggers['frames_from_flash'] = np.round((triggers.t.values - flash_t.loc[triggers.trial].values) / sim.frame_dur)
+    triggers['condition'] = triggers.value.map(CONDITION_CODES)
+    return (triggers.groupby('condition')
+            .agg(n=('value', 'size'), median_after_flip_us=('after_flip_us', 'median'),
+                 max_after_flip_us=('after_flip_us', 'max'),
+                 frames_from_flash_min=('frames_from_flash', 'min'),
+                 frames_from_flash_max=('frames_from_flash', 'max')))
+
+
+def bench(part, subj, wd):
+    script = 'msi_' + part + '.py'
+    with IOTimer() as io:
+        start = time.perf_counter()
+        sim = run_session(script, subj=subj, wd=wd)
+        elapsed = time.perf_counter() - start
+    if sim.exit not in (None, 0) or sim.error:
+        raise RuntimeError(script + " did not finish: " + str(sim.exit or sim.error))
+
+    df = pd.read_csv(os.path.join(wd, 'data', 'msi_' + part, 'msi_' + part + '_sub' + subj + '.csv'))
+    conditions = df.SOA.astype(str)
+
+    print("\n=== " + script + ": " + str(len(df)) + " trials, " + str(len(sim.flips)) + " flips, "
+          + "%.1f s simulated in %.2f s" % (sim.now, elapsed))
+    print("\n-- per-frame loop overhead --")
+    print(frame_overhead(sim, conditions).round(1).to_string())
+    print("\n-- I/O --")
+    print(io.report().round(3).to_string())
+    if sim.triggers:
+        print("\n-- trigger/flip alignment --")
+        print(trigger_alignment(sim).round(1).to_string())
+        latency = _us(trigger_latency(load_triggers(os.path.join(wd, 'data', 'msi_b', 'msi_b_sub' + subj + '_triggers.npy'))))
+        print("trigger log, actual - intended (us): median %.1f  max %.1f  n %d"
+              % (np.median(latency), np.max(latency), len(latency)))
+
+
+def write_soa_file(wd, subj):
+    #fit the simulated part A so part B gets realistic SOAs
+    import TBW_fitting
+    cwd = os.getcwd()
+    os.chdir(wd)
+    try:
+        TBW_fitting.fit_subject(subj, verbose=False, fitter='lm', headless=True)
+    finally:
+        os.chdir(cwd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='msi_a/msi_b benchmark on the simulated backend')
+    parser.add_argument('--part', choices=['a', 'b'], action='append', help='default: both')
+    parser.add_argument('--subj', default='2')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as wd:
+        for part in args.part or ['a', 'b']:
+            if part == 'b' and not os.path.isfile(os.path.join(wd, 'data', 'SOAs', 'msi_a_sub' + args.subj + '_SOAs.csv')):
+                if not os.path.isfile(os.path.join(wd, 'data', 'msi_a', 'msi_a_sub' + args.subj + '.csv')):
+                    run_session('msi_a.py', subj=args.subj, wd=wd)
+                write_soa_file(wd, args.subj)
+            bench(part, args.subj, wd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark for the TBW_fitting.py headless path
+
+Runs `TBW_fitting.py <subj> --headless` on a simulated msi_a subject in a
+temporary directory and times how long it takes for the SOA file to appear.
+Exits with status 1 if that is over STARTUP_BUDGET seconds.
+
+With --fits N, instead compares the batched fit modes (least squares, joint model,
+binomial maximum likelihood and the hierarchical binomial fit) on N simulated subjects
+with narrow, wide and asymmetric windows: failed fits, SOA error and time. --blocks
+and --no-response make the simulated sessions shorter and noisier.
+
+With --models N, simulates N observers from each candidate model of the model
+comparison and reports which model AIC/BIC selects for them, the SOA error of the
+selected model's fits against the sigmoid's, and how long the comparison takes.
+
+Usage:
+    python bench_tbw.py [--repeats N] [--budget S]
+    python bench_tbw.py --fits N [--blocks B] [--no-response P]
+    python bench_tbw.py --models N [--criterion aic|bic] [--blocks B] [--no-response P]
+"""
+
+import os, sys, time, argparse, tempfile, subprocess
+import numpy as np
+import pandas as pd
+
+STARTUP_BUDGET = 1.0 #seconds from launch until the SOA file for msi_b.py exists
+
+SOA_FRAMES = [-30, -25, -20, -15, -10, -8, -5, -2, -1, 0, 1, 2, 5, 8, 10, 15, 20, 25, 30]
+
+
+def simulate_msi_a(subj, params=((0.95, 0.03, -120), (0.95, -0.025, 160)), seed=0, blocks=4, no_response=0,
+                   model='sigmoid'):
+    """msi_a response dataframe for a simulated observer with the given left/right parameters of a
+    tbw_models model.
+
+    no_response is the probability of a trial without a response ('NaN', as msi_a writes it)."""
+    from tbw_models import MODELS
+    forward = MODELS[model].forward
+    rng = np.random.default_rng(seed)
+    rows = []
+    for block in range(blocks):
+        SOA_list = 4*SOA_FRAMES
+        rng.shuffle(SOA_list)
+        for trial, SOA in enumerate(SOA_list):
+            p = forward([SOA*10], params[0] if SOA <= 0 else params[1])[0]
+            resp_recode = 'sync' if rng.random() < p else 'async'
+            if rng.random() < no_response:
+                rows.append([subj, block + 1, trial + 1, SOA*10, 'NaN', 'NaN', np.nan])
+                continue
+            rows.append([subj, block + 1, trial + 1, SOA*10, 'left', resp_recode, 0.5])
+
+    df = pd.DataFrame(rows)
+    df.columns = ['subj', 'block', 'trial', 'SOA', 'resp', 'resp_recode', 'rt']
+    return df
+
+
+def make_wd(wd, subj):
+    for folder in ['msi_a', 'SOAs', 'plots', 'fit_results']:
+        os.makedirs(os.path.join(wd, 'data', folder), exist_ok=True)
+    simulate_msi_a(subj).to_csv(os.path.join(wd, 'data', 'msi_a', 'msi_a_sub' + subj + '.csv'))
+    return os.path.join(wd, 'data', 'SOAs', 'msi_a_sub' + subj + '_SOAs.csv')
+
+
+def time_to_soa_file(wd, subj, SOA_filename):
+    """Seconds from launching the headless fit until its SOA file exists"""
+    if os.path.isfile(SOA_filename):
+        os.remove(SOA_filename)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TBW_fitting.py')
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, script, subj, '--headless', '--wd', wd],
+                            stdout=subprocess.DEVNULL)
+    while not os.path.isfile(SOA_filename):
+        if proc.poll() is not None and not os.path.isfile(SOA_filename):
+            sys.exit("TBW_fitting.py exited without writing " + SOA_filename)
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    proc.wait()
+    return elapsed
+
+
+def random_observer(rng):
+    """Left/right sigmoid parameters spanning narrow, wide and asymmetric windows"""
+    return ((rng.uniform(0.7, 1), rng.uniform(0.01, 0.1), rng.uniform(-250, -30)),
+            (rng.uniform(0.7, 1), -rng.uniform(0.01, 0.1), rng.uniform(30, 300)))
+
+
+def compare_fits(n_subjects=200, seed=0, blocks=4, no_response=0):
+    """Fit mode comparison on simulated subjects, one row per mode"""
+    from TBW_fitting import sync_rates, batch_fit
+    from tbw_models import solve_soas
+
+    rng = np.random.default_rng(seed)
+    observers = [random_observer(rng) for _ in range(n_subjects)]
+    df_rates = [sync_rates(simulate_msi_a('1', params, seed=i, blocks=blocks, no_response=no_response))
+                for i, params in enumerate(observers)]
+    truth = pd.DataFrame([{k: float(v) for k, v in solve_soas(*params).items()} for params in observers])
+
+    modes = [('lm fixed start', 'lm', 'fixed'), ('joint grid start', 'joint', 'grid'),
+             ('binomial ml', 'ml', 'grid'), ('hierarchical', 'hier', 'grid')]
+    results, rows = {}, []
+    for name, fitter, init in modes:
+        start = time.perf_counter()
+        results[name] = batch_fit(df_rates, fitter, init)
+        elapsed = time.perf_counter() - start
+        soas = pd.DataFrame([{k: float(v) for k, v in solve_soas(l.params, r.params).items()}
+                             for l, r in results[name]])
+        rows.append({'mode': name, 'time_s': elapsed,
+                     'failed': np.mean([not (l.success and r.success) for l, r in results[name]]),
+                     'unsolved': soas.isna().any(axis=1).mean(),
+                     'SOA_rmse_ms': float(np.sqrt(np.nanmean((soas - truth).values ** 2))),
+                     'median_nfev': float(np.median([l.nfev + r.nfev for l, r in results[name]]))})
+
+    return pd.DataFrame(rows).set_index('mode')
+
+
+def model_observer(rng, model):
+    """random_observer parameters adapted to a candidate model: asymptote 1 for sigmoid1 and the
+    cumulative Gaussian's slope scaled to about the same window width"""
+    params = np.array(random_observer(rng))
+    if model == 'sigmoid1':
+        params[:, 0] = 1
+    elif model == 'gaussian':
+        params[:, 1] /= 1.7
+    return params
+
+
+def model_recovery(n_per_model=50, seed=0, blocks=4, no_response=0, criterion='bic'):
+    """Model comparison on observers simulated from each candidate model.
+
+    Returns the share of each generating model's subjects each model is selected for, the RMSE
+    (ms) of the selected model's SOAs and of the sigmoid's per generating model, and the time
+    the comparison took (s)."""
+    from TBW_fitting import sync_rates
+    from tbw_fit import COMPARE_MODELS, compare_models
+    from tbw_models import solve_soas
+
+    rng = np.random.default_rng(seed)
+    generating = pd.Series([m for m in COMPARE_MODELS for _ in range(n_per_model)], name='generating')
+    observers = [model_observer(rng, m) for m in generating]
+    df_rates = [sync_rates(simulate_msi_a('1', params, seed=i, blocks=blocks, no_response=no_response, model=m))
+                for i, (params, m) in enumerate(zip(observers, generating))]
+    truth = pd.DataFrame([{k: float(v) for k, v in solve_soas(*params, model=m).items()}
+                          for params, m in zip(observers, generating)])
+
+    start = time.perf_counter()
+    fits, table = compare_models(df_rates, criterion=criterion)
+    elapsed = time.perf_counter() - start
+
+    selected = table[table.selected].set_index('subject').model.sort_index().rename('selected')
+    soas = {m: pd.DataFrame({k: v for k, v in solve_soas(fits[m][0].params, fits[m][1].params, m).items()})
+            for m in COMPARE_MODELS}
+    chosen = pd.DataFrame([soas[m].iloc[i] for i, m in enumerate(selected)]).reset_index(drop=True)
+
+    def rmse(estimated):
+        return ((estimated - truth) ** 2).groupby(generating).mean().mean(axis=1) ** 0.5
+
+    recovery = pd.crosstab(generating, selected.values, normalize='index')
+    recovery.columns.name = 'selected'
+    error = pd.DataFrame({'selected_rmse_ms': rmse(chosen), 'sigmoid_rmse_ms': rmse(soas['sigmoid'])})
+    return recovery, error, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TBW_fitting.py headless startup benchmark')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET)
+    parser.add_argument('--fits', type=int, default=0, metavar='N', help='compare fit modes on N simulated subjects')
+    parser.add_argument('--models', type=int, default=0, metavar='N',
+                        help='model recovery on N simulated subjects per candidate model')
+    parser.add_argument('--criterion', choices=['aic', 'bic'], default='bic', help='model selection criterion for --models')
+    parser.add_argument('--blocks', type=int, default=4, help='msi_a blocks per simulated subject for --fits/--models')
+    parser.add_argument('--no-response', type=float, default=0, metavar='P',
+                        help='probability of a trial without a response for --fits/--models')
+    args = parser.parse_args(argv)
+
+    if args.fits:
+        print(compare_fits(args.fits, blocks=args.blocks, no_response=args.no_response).round(3).to_string())
+        return
+
+    if args.models:
+        from tbw_fit import COMPARE_MODELS
+        recovery, error, elapsed = model_recovery(args.models, blocks=args.blocks, no_response=args.no_response,
+                                                  criterion=args.criterion)
+        print(recovery.round(2).to_string())
+        print(error.round(1).to_string())
+        print("%d subjects x %d models compared in %.2f s" % (len(error) * args.models, len(COMPARE_MODELS), elapsed))
+        return
+
+    subj = '999'
+    with tempfile.TemporaryDirectory() as wd:
+        SOA_filename = make_wd(wd, subj)
+        times = [time_to_soa_file(wd, subj, SOA_filename) for _ in range(args.repeats)]
+
+    print("time to SOA file (s): min %.3f  median %.3f  max %.3f  budget %.3f"
+          % (min(times), np.median(times), max(times), args.budget))
+    if np.median(times) > args.budget:
+        sys.exit("Over startup budget")
+
+
+if __name__ == '__main__':
+    main()
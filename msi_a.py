@@ -17,9 +17,22 @@ import numpy as np
 import pandas as pd
 import os, sys
 from psychopy import visual, core, event, gui, logging, sound
+from psychopy.hardware import keyboard
 import random
 import matplotlib.pyplot as plt
-import csv
+from msi_logger import TrialLogger, SessionJournal, resume_point, save_csv
+from msi_responses import ResponseCollector
+from msi_timing import FrameTimer
+from msi_display import calibrate, mismatch
+from msi_stimuli import build_screens
+from msi_profile import PhaseProfiler, PROMPT_FLIP, RESPONSE, BLANK_FLIP, LOG_FLUSHED, ITI_END, FLUSH_BUDGET
+from msi_schedule import compile_session, run_trial
+from msi_audio import tone, TONE_SAMPLE_RATE
+from msi_adaptive import AdaptiveSOA
+from tbw_online import OnlineTBW
+from TBW_fitting import subject_paths, write_soas, write_fit
+from tbw_fit import FitResult
+from tbw_models import solve_soas
 
 
 #system setup
@@ -28,11 +41,17 @@ framerate = 100 #For debugging purposes only. Must be 100 for data collection
 if framerate != 100:
     print("Warning: framerate not set to 100 Hz")
 
+audio_latency = 0.02 #s from the on-flip beep.play() to sound onset, measured for this setup (see msi_audio)
+
 #get Subject ID
 subgui = gui.Dlg() 
 subgui.addField("Subject ID:")
+subgui.addField("Resume crashed session:", initial=False)
+subgui.addField("Adaptive SOAs:", initial=False)
 subgui.show()
 subj = subgui.data[0]
+resume = subgui.data[1]
+adaptive = subgui.data[2]
 
 #determine counterbalance (0: left=sync, 1: right=sync)
 cb = int(subj) % 2
@@ -45,11 +64,11 @@ elif cb == 1:
 
 #setup
 win = visual.Window(fullscr=True, allowGUI=False, color="black", screen=0, units='height', waitBlanking=True)
-trialClock = core.Clock()
 all_responses = []
 
 num_blocks = 4
 SOA_list= 4*[-30, -25, -20, -15, -10, -8, -5, -2, -1, 0, 1, 2, 5, 8, 10, 15, 20, 25, 30] # SOA (in number of frames)
+adaptive_trials_per_block = 38 #half the fixed grid; SOAs chosen trial by trial (msi_adaptive)
 
 
 #check for existing subject file
@@ -58,179 +77,182 @@ outputFileName = 'data' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '.csv
 if os.path.isfile(outputFileName) :
     sys.exit("Data for this subject already exists")
 
-#setup log file
-logFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '_log.csv'
-
-#check refresh rate
-actual_framerate = win.getActualFrameRate(nIdentical=100, nMaxFrames=1000,
-    nWarmUpFrames=10, threshold=1)
-if actual_framerate < framerate - 0.15 or actual_framerate >  framerate + 0.15:
-    sys.exit("Expected refresh rate: " + str(framerate) + ". Actual rate: " + str(actual_framerate))
+#check refresh rate (quick check against this display's cached calibration, full measurement only if they disagree)
+#before any log or journal is created, so a failed startup check leaves nothing behind to resume
+calibration = calibrate(win, screen = 0)
+if mismatch(calibration, framerate):
+    sys.exit(mismatch(calibration, framerate))
 
-#create beep stimulus
-beep = sound.Sound('C:/data/pjohnston/msi/audiocheck.net_sin_3500Hz_0dBFS_1s', stop = 0.01, stereo=True)
+#create beep stimulus (10ms 3500Hz tone synthesised in memory)
+beep = sound.Sound(tone(), sampleRate = TONE_SAMPLE_RATE, stereo=True)
 beep.setVolume(1)
 
-#create flash stimulus (diameter 4cm = 3.8 degrees of visual angle at 60 cm)
-flash = visual.RadialStim(win, size = 0.15, radialCycles = 1, radialPhase = 1/2, 
-                                angularPhase = 1/4, angularCycles = 1/2)
+#write-ahead journal: the whole shuffled schedule up front, then every completed trial
+journalFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '_journal.jsonl'
+if int(subj) >= 900 and os.path.isfile(journalFile): #practice sessions are never resumed
+    os.remove(journalFile)
+if resume and not os.path.isfile(journalFile):
+    sys.exit("No unfinished session for this subject to resume - restart with resume unchecked")
+elif resume:
+    journal, schedule, all_responses = SessionJournal.resume(journalFile)
+elif os.path.isfile(journalFile):
+    sys.exit("Unfinished session for this subject exists - restart with resume checked")
+elif adaptive: #SOAs are chosen online, so the schedule only fixes the trial count
+    schedule = [adaptive_trials_per_block*[None] for block in range(num_blocks)]
+    journal = SessionJournal.create(journalFile, schedule)
+else:
+    schedule = [random.sample(SOA_list, len(SOA_list)) for block in range(num_blocks)]
+    journal = SessionJournal.create(journalFile, schedule)
+adaptive = schedule[0][0] is None #a resumed session keeps its original mode
 
-#create fixation
-fixation = visual.TextStim(win, text = "+", color = "white", height = 0.06)
+#adaptive sampler and running TBW fit, replaying any responses already in the journal
+if adaptive:
+    sampler = AdaptiveSOA()
+    for row in all_responses:
+        sampler.update(row[3]//10, row[5])
+    sampler.next_SOA() #one search for the first trial, however many rows were replayed
+tbw = OnlineTBW()
+for row in all_responses:
+    tbw.add(row[3], row[5])
 
-#create responses prompt (counterbalanced)
-prompt = visual.TextStim(win, text = "Simultaneous?", height = 0.073, pos = (0, 0.15))
+#setup log file
+logFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '_log.csv'
+trial_log = TrialLogger(logFile) #rows are written to disk during the ITI only
+keyFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '_keys.csv'
+key_log = TrialLogger(keyFile) #every key event: trial, key, rt, response
 
-if cb == 0:
-    key_prompt = visual.TextStim(win, text = "   YES                              NO   ", height = 0.073, pos = (0, -0.3))
-elif cb == 1:
-    key_prompt = visual.TextStim(win, text = "   NO                              YES   ", height = 0.073, pos = (0, -0.3))
+#per-trial flip timestamps for the stimulus window, saved next to the CSV
+timingFile = 'data' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '_timing.npy'
+timer = FrameTimer(timingFile, sum(len(trials) for trials in schedule), core.getTime,
+                   frame_dur = 1.0/framerate, audio_latency = audio_latency, resume = resume)
 
+#per-phase timestamps of the trial loop (ring buffer, no I/O until the end), report saved next to the CSV
+profileFile = 'data' + os.sep + 'msi_a' + os.sep + 'msi_a_sub' + subj + '_profile.npy'
+profile = PhaseProfiler(profileFile, core.getTime, frame_dur = 1.0/framerate, resume = resume)
+
+#compile every trial's frames up front (beep started audio_latency ahead of its onset); adaptive trials are compiled one at a time
+if not adaptive:
+    frame_table = compile_session([SOA*10 for trials in schedule for SOA in trials], audio_latency = audio_latency)
+
+#every screen (fixation, flash, prompt, break, instructions, thank-you) pre-rendered to one texture
+screens = build_screens(win, cb)
+
+#responses timed by the keyboard's background thread against the prompt flip
+responses = ResponseCollector(keyboard.Keyboard(), win, core.wait, log = key_log)
 
 #instruction screen
-if cb == 1:
-    instructions = visual.TextStim(win, text = u"""You will hear a beep and see a flash. When prompted, please use the left and right arrow keys to report whether they occur simultaneously or not. Press any key to begin.
-                                                        ← = NO              → = YES""", height = 0.075, pos = (0,0))
-elif cb == 0:
-    instructions = visual.TextStim(win, text = u"""You will hear a beep and see a flash. When prompted, please use the left and right arrow keys to report whether they occur simultaneously or not. Press any key to begin.
-                                                        ← = YES              → = NO""", height = 0.075, pos = (0,0))
-start_prompt = visual.TextStim(win, text = "Press any key to begin", height = -0.075)
-instructions.draw()
+screens.instructions.draw()
 win.flip()
 event.waitKeys()
 
-block_count = 0
+#run (a resumed session starts at the first trial missing from the journal)
+start_block, start_trial = resume_point(schedule, all_responses)
 
-#run
-for block in range(num_blocks):
-    random.shuffle(SOA_list)
-    block_count += 1
+for block in range(start_block, num_blocks):
+    block_count = block + 1
     
-    if block_count != 1:
+    if block != start_block:
         
         #prompt any key
-        break_prompt = visual.TextStim(win, text = """                Break           
-                                                            Press any key to continue""", height = 0.075)
-        break_prompt.draw()
+        screens.block_break.draw()
         win.flip()
+        if not adaptive:
+            tbw.refit() #warm start for the final fit
+        profile.save()
         event.waitKeys()
     
-    trial_count = 0
+    trial_count = start_trial if block == start_block else 0
     
-    for SOA in SOA_list:
+    for SOA in schedule[block][trial_count:]:
         
-        corrected_SOA = SOA-1 #correct for 10ms audio lag
         trial_count += 1
+        trial_index = len(all_responses)
+        profile.start_trial(trial_index)
         
-        fixation.draw()
-        win.flip()
-        #trigger fixation start here
+        if adaptive:
+            SOA = sampler.next_SOA() #already chosen during the last ITI
+            rows = compile_session([SOA*10], audio_latency = audio_latency).trial(0)
+        else:
+            rows = frame_table.trial(trial_index)
         
-        #jitter initial fixation
-        jitter = random.randint(100,150)
-        for frameN in range(jitter):
-            fixation.draw()
-            win.flip()
-        
-        core.rush(True) #give psychopy priority during stimulus presentation
-        
-        fixation.draw()
-        win.flip()
+        responses.start_trial(trial_index)
         
-        if corrected_SOA < 0: #auditory then visual
-            
-            #beep
-            beep.play()
-            
-            #SOA
-            for frameN in range(-1*corrected_SOA):
-                fixation.draw()
-                win.flip()
-            
-            #flash
-            flash.draw()
-            fixation.draw()
-            win.flip()
-            #trigger here
-            fixation.draw()
-            win.flip()
-            
-        elif corrected_SOA == 0: #simultaneous
-            beep.play()
-            flash.draw()
-            fixation.draw()
-            win.flip()
-            #trigger here
-            fixation.draw()
-            win.flip()
-            
-        else: #visual then auditory (this coding would logically give 10ms less than expected, but it checks out with the oscilloscope?)
-            
-            #flash
-            flash.draw()
-            fixation.draw()
-            win.flip()
-            #trigger here
-            
-            #SOA
-            for frameN in range(corrected_SOA-1):
-                fixation.draw()
-                win.flip()
-            
-            #beep
-            beep.play()
-            fixation.draw()
-            win.flip()
-            
-        core.rush(False)
+        #fixation, jitter and stimulus window replayed from the precompiled frame table
+        timer.start_trial(trial_index, block + 1, trial_count, SOA*10)
+        run_trial(rows, win, screens.fixation, screens.flash, beep, core.rush, timer=timer, profile=profile)
+        timer.end_trial()
         core.wait(0.75)
         
         #collect response
-        prompt.draw()
-        key_prompt.draw()
-        win.flip()
-        trialClock.reset()
-        keys = event.waitKeys(timeStamped=trialClock, keyList = ['left', 'right', 'escape', 'ctrl'], maxWait = 2)
+        screens.prompt.draw()
+        responses.prompt() #RT clock starts on this flip
+        profile.mark(PROMPT_FLIP, win.flip(), budget = 0.75 + 1.0/framerate)
+        resp, rt = responses.wait(maxWait = 2)
+        profile.mark(RESPONSE, budget = 2)
         
-        if keys == None: # check for no response
-            keys=[['NaN', 'NaN']]
-        elif keys[0][0] == 'escape' and int(subj) < 900: #data saves on quit
+        if resp == 'escape' and int(subj) < 900: #data saves on quit
             win.close()
             df = pd.DataFrame(all_responses)
             df.columns = ['subj', 'block', 'trial', 'SOA', 'resp', 'resp_recode', 'rt']
-            df.to_csv(outputFileName)
+            save_csv(df, outputFileName)
+            journal.end()
+            timer.close()
+            profile.close()
             win.close()
             core.quit()
-        elif keys[0][0] == 'escape' and int(subj) >= 900: #data doesn't save
+        elif resp == 'escape' and int(subj) >= 900: #data doesn't save
             win.close()
             core.quit()
             
-        resp = keys[0][0]
-            
-        trial_responses = [subj, block + 1, trial_count, SOA*10, resp, resp_dict[resp], keys[0][1]]
+        trial_responses = [subj, block + 1, trial_count, SOA*10, resp, resp_dict[resp], rt] #rt is NaN if no response
         all_responses.append(trial_responses)
         
-        #write to log file
-        with open(logFile, 'a') as fd:
-            wr = csv.writer(fd, dialect='excel')
-            wr.writerow(trial_responses)
+        #queue for log file
+        trial_log.log(trial_responses)
+        journal.log_trial(trial_responses)
+        tbw.add(SOA*10, resp_dict[resp])
             
-        win.flip()
-        core.wait(0.75) #ITI
+        profile.mark(BLANK_FLIP, win.flip())
+        trial_log.flush() #written by the logger thread during the ITI
+        key_log.flush()
+        journal.flush()
+        ITI_start = profile.mark(LOG_FLUSHED, budget = FLUSH_BUDGET)
+        if adaptive:
+            sampler.update(SOA, resp_dict[resp])
+            sampler.next_SOA() #choose now, during the ITI
+        core.wait(0.75 - (core.getTime() - ITI_start)) #ITI
+        profile.mark(ITI_END, budget = 0.75)
         
         if trial_count == 5 and int(subj) >= 900: #practice quits after 5 trials
             win.close()
             core.quit()
 
 #thank you screen
-thank_you = visual.TextStim(win, text = "Thanks for participating!", height = 0.06)
-thank_you.draw()
+screens.thank_you.draw()
 win.flip()
+
+#SOAs for msi_b written behind the thank-you screen: from the running counts, or the adaptive posterior-mean
+#parameters. The fit file holds the parameters the SOAs are solved from, so tbw_plot.py draws a figure that agrees with them
+if int(subj) < 900 and not os.path.isfile(subject_paths(subj)['SOAs']):
+    if adaptive:
+        left, right, _ = sampler.estimates()
+        l_result, r_result = [FitResult(params, np.nan, 0, True) for params in (left, right)]
+        soas = {k: float(v) for k, v in solve_soas(left, right).items()}
+    else:
+        l_result, r_result = tbw.refit()
+        soas = tbw.soas()
+    write_soas(subj, soas, source = 'adaptive' if adaptive else 'online')
+    write_fit(subj, l_result, r_result)
+
 event.waitKeys()
 
 win.close()
+trial_log.close()
+key_log.close()
 
 df = pd.DataFrame(all_responses)
 df.columns = ['subj', 'block', 'trial', 'SOA', 'resp', 'resp_recode', 'rt']
-df.to_csv(outputFileName)
-
+save_csv(df, outputFileName)
+journal.end()
+timer.close()
+profile.close()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# msi adaptive SOA placement
+# Psi-style Bayesian placement for msi_a on the two-sided sigmoid fitted in
+# TBW_fitting.py. Each side keeps a posterior over a grid of (a, b, c); the next SOA
+# is the candidate whose response is expected to tell us most about that side's
+# 50% and 95% points (ASOA50/ASOA95 or VSOA50/VSOA95, binned to 10 ms). SOA = 0 is
+# on both sides, as in the fit. Choosing the next SOA takes ~50 ms, well inside the
+# 0.75 s ITI; a posterior update alone is a few hundred microseconds, so a resumed
+# session replays its journal with update() and chooses once.
+#
+# python msi_adaptive.py --check compares, on simulated observers, the fixed 304-trial
+# grid fitted as in TBW_fitting.py with an adaptive run of half as many trials (both
+# its posterior-mean SOAs and the same least-squares fit of its trials).
+
+import argparse
+import numpy as np
+from tbw_models import sigmoid, solve_soas
+
+CANDIDATE_SOAS = np.arange(-30, 31) #frames
+FIXED_SOAS = [-30, -25, -20, -15, -10, -8, -5, -2, -1, 0, 1, 2, 5, 8, 10, 15, 20, 25, 30] #msi_a grid (frames)
+
+#parameter grid for each side (a, b, c); b is positive on the left and negative on the right
+GRID_A = np.linspace(0.5, 1, 11)
+GRID_B = np.logspace(-2.5, -0.7, 20)
+GRID_C = np.arange(0, 401, 5)
+
+LAPSE = 0.02 #keeps every response possible under every grid point
+BIN_MS = 10
+
+
+def param_grid(side):
+    sign = 1 if side == 'left' else -1
+    a, b, c = np.meshgrid(GRID_A, sign * GRID_B, -sign * GRID_C, indexing='ij')
+    return np.stack([a.ravel(), b.ravel(), c.ravel()], axis=-1)
+
+
+def _entropy(p, axis=-1):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.sum(np.where(p > 0, p * np.log(p), 0), axis=axis)
+
+
+class _Side:
+    """Grid posterior for one side of the TBW"""
+
+    def __init__(self, side, candidates, frame_ms):
+        self.grid = param_grid(side)
+        self.candidates = candidates
+        p = sigmoid(candidates * frame_ms, self.grid).T #(candidate, grid)
+        self.lik = LAPSE / 2 + (1 - LAPSE) * p
+        self.log_post = np.zeros(len(self.grid))
+
+        #grid points grouped by their (SOA50, SOA95) bin; unreachable SOAs share one bin
+        soas = solve_soas(self.grid, self.grid)
+        names = ['ASOA50', 'ASOA95'] if side == 'left' else ['VSOA50', 'VSOA95']
+        self.soas = dict((k, soas[k]) for k in names)
+        pair = [self.soas[k] for k in names]
+        bins = [np.where(np.isnan(x), 9999, np.round(x / BIN_MS)).astype(int) for x in pair]
+        _, self.bin = np.unique(bins[0] * 100000 + bins[1], return_inverse=True)
+        self.order = np.argsort(self.bin, kind='stable')
+        self.starts = np.flatnonzero(np.r_[True, np.diff(self.bin[self.order]) != 0])
+
+    def posterior(self):
+        p = np.exp(self.log_post - self.log_post.max())
+        return p / p.sum()
+
+    def _bin_entropy(self, p):
+        return _entropy(np.add.reduceat(p[..., self.order], self.starts, axis=-1))
+
+    def info_gain(self):
+        """Expected reduction in threshold-bin entropy for every candidate SOA"""
+        p = self.posterior()
+        p_sync = self.lik @ p
+        post_sync = self.lik * p / p_sync[:, np.newaxis]
+        post_async = (1 - self.lik) * p / (1 - p_sync)[:, np.newaxis]
+        expected = p_sync * self._bin_entropy(post_sync) + (1 - p_sync) * self._bin_entropy(post_async)
+        return self._bin_entropy(p) - expected
+
+    def update(self, i, sync):
+        self.log_post += np.log(self.lik[i] if sync else 1 - self.lik[i])
+
+    def mean_params(self):
+        return self.posterior() @ self.grid
+
+    def mean_soas(self):
+        """Posterior mean of each SOA over the grid points where it is reachable"""
+        p = self.posterior()
+        out = {}
+        for k, x in self.soas.items():
+            ok = ~np.isnan(x)
+            out[k] = float(np.sum(p[ok] * x[ok]) / np.sum(p[ok])) if p[ok].sum() > 0 else np.nan
+        return out
+
+
+class AdaptiveSOA:
+    """Chooses msi_a SOAs (in frames) one trial at a time.
+
+    Call next_SOA() for the trial to present and update(SOA, resp_recode) once the
+    response is in ('NaN' responses are ignored). update() only moves the posterior;
+    the next next_SOA() call does the search."""
+
+    def __init__(self, candidates=CANDIDATE_SOAS, frame_ms=10):
+        self.candidates = np.asarray(candidates)
+        self.sides = {'left': _Side('left', self.candidates[self.candidates <= 0], frame_ms),
+                      'right': _Side('right', self.candidates[self.candidates >= 0], frame_ms)}
+        self._next = None
+
+    def next_SOA(self):
+        if self._next is None:
+            gain = dict((SOA, 0.0) for SOA in self.candidates.tolist())
+            for side in self.sides.values():
+                for SOA, g in zip(side.candidates.tolist(), side.info_gain()):
+                    gain[SOA] += g
+            self._next = max(gain, key=gain.get)
+        return self._next
+
+    def update(self, SOA, resp_recode):
+        if resp_recode not in ('sync', 'async'):
+            return
+        for side in self.sides.values():
+            i = np.flatnonzero(side.candidates == SOA)
+            if len(i):
+                side.update(i[0], resp_recode == 'sync')
+        self._next = None
+
+    def estimates(self):
+        """Posterior-mean parameters for each side and posterior-mean SOAs (ms)"""
+        soas = self.sides['left'].mean_soas()
+        soas.update(self.sides['right'].mean_soas())
+        return self.sides['left'].mean_params(), self.sides['right'].mean_params(), soas
+
+
+#%% simulation check
+def _observer(rng, SOA_ms, params):
+    a, b, c = params[0] if SOA_ms <= 0 else params[1]
+    return 'sync' if rng.random() < a / (1 + np.exp(-b * (SOA_ms - c))) else 'async'
+
+
+def _fit_soas(trials):
+    """SOAs from the TBW_fitting least-squares fit of (SOA ms, resp_recode) trials"""
+    import pandas as pd
+    from TBW_fitting import sync_rates
+    from tbw_fit import fit_tbw
+    df = pd.DataFrame(trials, columns=['SOA', 'resp_recode'])
+    left, right = fit_tbw([sync_rates(df)])
+    return solve_soas(left.params[0], right.params[0])
+
+
+def check(n_subjects=40, adaptive_trials=152, seed=0):
+    """RMSE of each SOA for the fixed 304-trial grid and an adaptive design on simulated observers"""
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    errors = {'fixed': [], 'adaptive posterior': [], 'adaptive fit': []}
+    for _ in range(n_subjects):
+        params = ((rng.uniform(0.8, 1), rng.uniform(0.015, 0.05), rng.uniform(-200, -60)),
+                  (rng.uniform(0.8, 1), -rng.uniform(0.015, 0.05), rng.uniform(80, 250)))
+        truth = solve_soas(params[0], params[1])
+
+        fixed = [(SOA*10, _observer(rng, SOA*10, params)) for SOA in 16*FIXED_SOAS]
+
+        sampler = AdaptiveSOA()
+        adaptive = []
+        for _ in range(adaptive_trials):
+            SOA = sampler.next_SOA()
+            resp = _observer(rng, SOA*10, params)
+            sampler.update(SOA, resp)
+            adaptive.append((SOA*10, resp))
+
+        for name, trials in [('fixed', fixed), ('adaptive fit', adaptive)]:
+            fit = _fit_soas(trials)
+            errors[name].append({k: float(fit[k] - truth[k]) for k in truth})
+        posterior = sampler.estimates()[2]
+        errors['adaptive posterior'].append({k: posterior[k] - float(truth[k]) for k in truth})
+
+    rows = []
+    for name, errs in errors.items():
+        df = pd.DataFrame(errs)
+        rows.append(pd.Series(np.sqrt(np.nanmean(df**2, axis=0)), index=df.columns, name=name + ' RMSE (ms)'))
+        rows.append(pd.Series(df.isna().mean(), name=name + ' failed'))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare adaptive and fixed-grid SOA designs on simulated observers')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--subjects', type=int, default=40)
+    parser.add_argument('--trials', type=int, default=152)
+    args = parser.parse_args()
+    print(check(args.subjects, args.trials).round(2).to_string())
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# msi audio
+# The beep and the audio latency model.
+#
+# The beep is a 10 ms 3500 Hz full-scale sine synthesised in memory (the same tone
+# the scripts used to cut from a 1 s file with stop=0.01), so nothing is decoded at
+# startup.
+#
+# Latency model: the beep is started from the on-flip callback of one frame, and the
+# sound comes out audio_latency seconds later (measured per setup; 0.02 s for the
+# pyo/ASIO setup in the lab, i.e. one frame of buffering plus the 10 ms card lag that
+# corrected_SOA = SOA-1 used to absorb). For an SOA (audio minus visual onset, ms) the
+# beep is therefore started on the flip play_offset() frames after the flash flip.
+#
+# python msi_audio.py --check verifies the model over the msi_a/msi_b SOA range
+# against the frame tables msi_schedule compiles.
+
+import sys, argparse
+import numpy as np
+
+TONE_FREQ = 3500 #Hz
+TONE_DUR = 0.01 #s
+TONE_SAMPLE_RATE = 44100
+
+AUDIO_LATENCY = 0.02 #s from the on-flip play() call to sound onset
+
+
+def tone(freq=TONE_FREQ, dur=TONE_DUR, sample_rate=TONE_SAMPLE_RATE, stereo=True):
+    """Full-scale sine as a float array in [-1, 1], (n,) or (n, 2) for stereo"""
+    t = np.arange(int(round(dur * sample_rate))) / float(sample_rate)
+    wave = np.sin(2 * np.pi * freq * t)
+    return np.column_stack([wave, wave]) if stereo else wave
+
+
+def nearest(x):
+    """x rounded to the nearest integer, halves up (round() takes halves to the even
+    neighbour, which flips the sign of the half-frame error from one SOA to the next)"""
+    return int(np.floor(x + 0.5))
+
+
+def play_offset(SOA_ms, audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """Flips from the flash flip to the flip whose callback starts the beep"""
+    return nearest((SOA_ms - 1000 * audio_latency) / float(frame_ms))
+
+
+def onset_flip(play_frame, audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """Frame whose flip is nearest the sound onset of a beep started on play_frame"""
+    return play_frame + nearest(1000 * audio_latency / float(frame_ms))
+
+
+def soa_errors(audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """Predicted achieved - requested SOA (ms) over -300..300 ms for compiled trials, without
+    and with a trigger"""
+    from msi_schedule import compile_stimulus
+    errors = []
+    for trigger in [None, 1]:
+        for SOA in range(-300, 301, 10):
+            frames = compile_stimulus(SOA, trigger, audio_latency=audio_latency, frame_ms=frame_ms)
+            flash = [i for i, f in enumerate(frames) if f[2]]
+            play = [i for i, f in enumerate(frames) if f[1]]
+            if len(flash) != 1 or len(play) != 1:
+                raise AssertionError("SOA " + str(SOA) + ": expected one flash and one beep frame")
+            errors.append((play[0] - flash[0]) * frame_ms + 1000 * audio_latency - SOA)
+    return np.array(errors)
+
+
+def check(audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """Largest predicted |achieved - requested| SOA (ms) over -300..300 ms for compiled trials"""
+    return np.abs(soa_errors(audio_latency, frame_ms)).max()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the audio latency model against compiled frame tables')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--latency', type=float, default=AUDIO_LATENCY, help='audio latency (s)')
+    args = parser.parse_args()
+    worst = check(args.latency)
+    print("Largest predicted SOA error: %.1f ms (half a frame: 5 ms)" % worst)
+    if worst > 5 + 1e-9:
+        sys.exit(1)
@@ -18,14 +18,25 @@ import numpy as np
 import pandas as pd
 import os, sys
 from psychopy import visual, core, event, gui, logging, sound
+from psychopy.hardware import keyboard
 import random
 import matplotlib.pyplot as plt
-import csv
+from msi_logger import TrialLogger, SessionJournal, resume_point, save_csv
+from msi_responses import ResponseCollector
+from msi_timing import FrameTimer
+from msi_display import calibrate, mismatch
+from msi_stimuli import build_screens
+from msi_profile import PhaseProfiler, PROMPT_FLIP, RESPONSE, BLANK_FLIP, LOG_FLUSHED, ITI_END, FLUSH_BUDGET
+from msi_schedule import compile_session, run_trial
+from msi_audio import tone, TONE_SAMPLE_RATE
+from msi_triggers import TriggerScheduler
+from msi_events import build_events, write_events
 import pandas as pd
 from datetime import datetime
 from psychopy import parallel
 
 parallel.setPortAddress(0xB010)
+trigger_pulse_frames = 1 #EEG trigger pulse width (frames)
 
 #system setup
 framerate = 100 #For debugging purposes only. Must be 100 for data collection 
@@ -33,11 +44,15 @@ framerate = 100 #For debugging purposes only. Must be 100 for data collection
 if framerate != 100:
     print("Warning: framerate not set to 100 Hz")
 
+audio_latency = 0.02 #s from the on-flip beep.play() to sound onset, measured for this setup (see msi_audio)
+
 #get Subject ID
 subgui = gui.Dlg() 
 subgui.addField("Subject ID:")
+subgui.addField("Resume crashed session:", initial=False)
 subgui.show()
 subj = subgui.data[0]
+resume = subgui.data[1]
 
 #determine counterbalance (0: left=sync, 1: right=sync)
 cb = int(subj) % 2
@@ -67,6 +82,10 @@ else:
 
 #get SOAs and assign to list of the form ['label', duration]
 SOAs = pd.read_csv(SOA_filename)
+missing = [k for k in ['ASOA50r', 'ASOA95r', 'VSOA50r', 'VSOA95r'] if k not in SOAs or pd.isna(SOAs[k][0])]
+if missing:
+    sys.exit("SOA file " + SOA_filename + " has no value for " + ', '.join(missing)
+             + " (could not be solved from the msi_a data) - set them by hand before running msi_b")
 ASOA50r = ['ASOA50r', int(SOAs.ASOA50r[0]), 50]
 ASOA95r = ['ASOA95r', int(SOAs.ASOA95r[0]), 95]
 VSOA50r = ['VSOA50r', int(SOAs.VSOA50r[0]), 150]
@@ -76,7 +95,6 @@ V10 = ['V10', 10, 110]
 
 #setup
 win = visual.Window(fullscr=True, allowGUI=False, color="black", screen=0, units='height', waitBlanking=True)
-trialClock = core.Clock()
 all_responses = []
 
 num_blocks = 4
@@ -87,192 +105,157 @@ outputFileName = 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '.csv
 if os.path.isfile(outputFileName) :
     sys.exit("Data for this subject already exists")
 
+#check refresh rate (quick check against this display's cached calibration, full measurement only if they disagree)
+#before any log or journal is created, so a failed startup check leaves nothing behind to resume
+calibration = calibrate(win, screen = 0)
+if mismatch(calibration, framerate):
+    sys.exit(mismatch(calibration, framerate))
+
+#create beep stimulus (10ms 3500Hz tone synthesised in memory)
+beep = sound.Sound(tone(), sampleRate = TONE_SAMPLE_RATE, stereo=True)
+beep.setVolume(1)
+
+#write-ahead journal: the whole shuffled schedule up front, then every completed trial
+journalFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_journal.jsonl'
+if resume and not os.path.isfile(journalFile):
+    sys.exit("No unfinished session for this subject to resume - restart with resume unchecked")
+elif resume:
+    journal, schedule, all_responses = SessionJournal.resume(journalFile)
+elif os.path.isfile(journalFile):
+    sys.exit("Unfinished session for this subject exists - restart with resume checked")
+else:
+    schedule = [random.sample(SOA_list, len(SOA_list)) for block in range(num_blocks)]
+    journal = SessionJournal.create(journalFile, schedule)
+
 #setup log file
 logFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_log.csv'
+trial_log = TrialLogger(logFile) #rows are written to disk during the ITI only
+keyFile = 'data' + os.sep + 'logfiles' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_keys.csv'
+key_log = TrialLogger(keyFile) #every key event: trial, key, rt, response
 
-#check refresh rate
-actual_framerate = win.getActualFrameRate(nIdentical=100, nMaxFrames=1000,
-    nWarmUpFrames=10, threshold=1)
-if actual_framerate < framerate - 0.15 or actual_framerate >  framerate + 0.15:
-    sys.exit("Expected refresh rate: " + str(framerate) + ". Actual rate: " + str(actual_framerate))
+#per-trial flip timestamps for the stimulus window, saved next to the CSV
+timingFile = 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_timing.npy'
+timer = FrameTimer(timingFile, sum(len(trials) for trials in schedule), core.getTime,
+                   frame_dur = 1.0/framerate, audio_latency = audio_latency, resume = resume)
 
-#create beep stimulus
-beep = sound.Sound('C:/data/pjohnston/msi/audiocheck.net_sin_3500Hz_0dBFS_1s', stop = 0.01, stereo=True)
-beep.setVolume(1)
+#per-phase timestamps of the trial loop (ring buffer, no I/O until the end), report saved next to the CSV
+profileFile = 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_profile.npy'
+profile = PhaseProfiler(profileFile, core.getTime, frame_dur = 1.0/framerate, resume = resume)
 
-#create flash stimulus (diameter 4cm = 3.8 degrees of visual angle at 60 cm)
-flash = visual.RadialStim(win, size = 0.15, radialCycles = 1, radialPhase = 1/2, 
-                                angularPhase = 1/4, angularCycles = 1/2)
+#compile every trial's frames and triggers up front (beep started audio_latency ahead of its onset)
+flat_schedule = [SOA for trials in schedule for SOA in trials]
+frame_table = compile_session([SOA[1] for SOA in flat_schedule],
+                              triggers = [SOA[2] for SOA in flat_schedule],
+                              pulse_frames = trigger_pulse_frames, audio_latency = audio_latency)
 
-#create fixation
-fixation = visual.TextStim(win, text = "+", color = "white", height = 0.06)
+#triggers go out from on-flip callbacks; intended and actual times are logged next to the CSV
+triggerFile = 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_triggers.npy'
+triggers = TriggerScheduler(triggerFile, 8*len(flat_schedule) + 64, parallel.setData, core.getTime,
+                            frame_dur = 1.0/framerate, resume = resume)
 
-#create responses prompt (counterbalanced)
-prompt = visual.TextStim(win, text = "Simultaneous?", height = 0.073, pos = (0, 0.15))
+#EEG event table (triggers joined with stimulus onsets and responses) written at the end of the session
+eventFile = 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + subj + '_events.npy'
 
-if cb == 0:
-    key_prompt = visual.TextStim(win, text = "   YES                              NO   ", height = 0.073, pos = (0, -0.3))
-elif cb == 1:
-    key_prompt = visual.TextStim(win, text = "   NO                              YES   ", height = 0.073, pos = (0, -0.3))
+#every screen (fixation, flash, prompt, break, instructions, thank-you) pre-rendered to one texture
+screens = build_screens(win, cb)
 
+#responses timed by the keyboard's background thread against the prompt flip
+responses = ResponseCollector(keyboard.Keyboard(), win, core.wait, log = key_log)
 
 #instruction screen
-if cb == 1:
-    instructions = visual.TextStim(win, text = u"""You will hear a beep and see a flash. When prompted, please use the left and right arrow keys to report whether they occur simultaneously or not. Press any key to begin.
-                                                        ← = NO              → = YES""", height = 0.075, pos = (0,0))
-elif cb == 0:
-    instructions = visual.TextStim(win, text = u"""You will hear a beep and see a flash. When prompted, please use the left and right arrow keys to report whether they occur simultaneously or not. Press any key to begin.
-                                                        ← = YES              → = NO""", height = 0.075, pos = (0,0))
-start_prompt = visual.TextStim(win, text = "Press any key to begin", height = -0.075)
-instructions.draw()
+screens.instructions.draw()
 win.flip()
 event.waitKeys()
 
-block_count = 0
+#run (a resumed session starts at the first trial missing from the journal)
+start_block, start_trial = resume_point(schedule, all_responses)
 
-#run
-for block in range(num_blocks):
-    random.shuffle(SOA_list)
-    block_count += 1
+for block in range(start_block, num_blocks):
+    block_count = block + 1
     
-    if block_count != 1:
+    if block != start_block:
         
         #prompt any key
-        break_prompt = visual.TextStim(win, text = """                Break           
-                                                            Press any key to continue""", height = 0.075)
-        break_prompt.draw()
+        screens.block_break.draw()
         win.flip()
+        profile.save()
         event.waitKeys()
     
-    trial_count = 0
+    trial_count = start_trial if block == start_block else 0
     
-    for SOA in SOA_list:
+    for SOA in schedule[block][trial_count:]:
 
-        corrected_SOA = (SOA[1]/10)-1 #divide by 10 and correct for 10ms audio lag
         trial_count += 1
+        trial_index = len(all_responses)
+        profile.start_trial(trial_index)
         
-        fixation.draw()
-        win.flip()
-        
-        #jitter initial fixation
-        jitter = random.randint(100,150)
-        for frameN in range(jitter):
-            fixation.draw()
-            win.flip()
-        
-        core.rush(True) #give psychopy priority during stimulus presentation
+        responses.start_trial(trial_index)
         
-        fixation.draw()
-        win.flip()
-
-        if corrected_SOA < 0: #auditory then visual
-            
-            #beep
-            beep.play()
-            
-            fixation.draw()
-            win.flip()
-            fixation.draw()
-            win.flip()
-            parallel.setData(SOA[2])
-            
-            #SOA
-            for frameN in range(-1*corrected_SOA -2):
-                fixation.draw()
-                win.flip()
-                
-                if frameN == 0:
-                    parallel.setData(0)
-            
-            #flash
-            flash.draw()
-            fixation.draw()
-            win.flip()
-            
-            if corrected_SOA == -2: # then for loop above won't be entered, so set all pins to 0 here
-                parallel.setData(0)
-            
-            fixation.draw()
-            win.flip()
-            
-        elif corrected_SOA == 0: #simultaneous
-            beep.play()
-            flash.draw()
-            fixation.draw()
-            win.flip()
-            #trigger here
-            parallel.setData(SOA[2])
-            fixation.draw()
-            win.flip()
-            parallel.setData(0)
-            
-        else: #visual then auditory (this coding would logically give 10ms less than expected, but it checks out with the oscilloscope?)
-            
-            #flash
-            flash.draw()
-            fixation.draw()
-            win.flip()
-            #trigger here
-            parallel.setData(SOA[2])
-            fixation.draw()
-            win.flip()
-            parallel.setData(0)
-            
-            #SOA
-            for frameN in range(corrected_SOA-2):
-                fixation.draw()
-                win.flip()
-            
-            #beep
-            beep.play()
-            fixation.draw()
-            win.flip()
-            
-        core.rush(False)
+        #fixation, jitter and stimulus window replayed from the precompiled frame table
+        timer.start_trial(trial_index, block + 1, trial_count, SOA[1])
+        triggers.start_trial(trial_index)
+        run_trial(frame_table.trial(trial_index), win, screens.fixation, screens.flash, beep, core.rush, triggers=triggers, timer=timer,
+                  profile=profile)
+        timer.end_trial()
         core.wait(0.75)
         
         #collect response
-        prompt.draw()
-        key_prompt.draw()
-        win.flip()
-        trialClock.reset()
-        keys = event.waitKeys(timeStamped=trialClock, keyList = ['left', 'right', 'escape', 'ctrl'], maxWait = 2)
+        screens.prompt.draw()
+        responses.prompt() #RT clock starts on this flip
+        prompt_flip = profile.mark(PROMPT_FLIP, win.flip(), budget = 0.75 + 1.0/framerate)
+        resp, rt = responses.wait(maxWait = 2)
+        profile.mark(RESPONSE, budget = 2)
         
-        if keys == None: # check for no response
-            keys=[['NaN', 'NaN']]
-            parallel.setData(3) #send no response trigger
-            resp=keys[0][0]
-        elif keys[0][0] == 'escape': #data saves on quit
+        if resp == 'NaN': # check for no response
+            resp_code = 3 #no response trigger
+        elif resp == 'escape': #data saves on quit
             win.close()
             df = pd.DataFrame(all_responses)
             df.columns = ['subj', 'block', 'trial', 'SOA', 'resp', 'resp_recode', 'rt']
-            df.to_csv(outputFileName)
+            save_csv(df, outputFileName)
+            journal.end()
+            timer.close()
+            profile.close()
+            write_events(eventFile, build_events(triggers.close(), np.load(timingFile), df))
             core.quit()
         else:
-            resp = keys[0][0]
-            parallel.setData(resp_trig[resp])
+            resp_code = resp_trig[resp]
         
-        trial_responses = [subj, block + 1, trial_count, SOA[0], resp, resp_dict[resp], keys[0][1]]
+        trial_responses = [subj, block + 1, trial_count, SOA[0], resp, resp_dict[resp], rt] #rt is NaN if no response
         all_responses.append(trial_responses)
         
-        #write to log file
-        with open(logFile, 'a') as fd:
-            wr = csv.writer(fd, dialect='excel')
-            wr.writerow(trial_responses)
+        #queue for log file
+        trial_log.log(trial_responses)
+        journal.log_trial(trial_responses)
             
-        win.flip()
-        parallel.setData(0) #zero all pins
-        core.wait(0.75) #ITI
+        #response trigger goes out with the blank flip (the first on the prompt's frame grid after the response)
+        #and is cleared trigger_pulse_frames flips later
+        triggers.on_flip(win, resp_code, prompt_flip)
+        last_flip = profile.mark(BLANK_FLIP, win.flip())
+        trial_log.flush() #written by the logger thread during the ITI
+        key_log.flush()
+        journal.flush()
+        profile.mark(LOG_FLUSHED, budget = FLUSH_BUDGET)
+        for frame in range(trigger_pulse_frames):
+            if frame == trigger_pulse_frames - 1:
+                triggers.on_flip(win, 0, last_flip) #zero all pins
+            last_flip = win.flip()
+        core.wait(0.75 - trigger_pulse_frames / float(framerate)) #rest of the ITI
+        profile.mark(ITI_END, budget = 0.75)
 
 #thank you screen
-thank_you = visual.TextStim(win, text = "Thanks for participating!", height = 0.06)
-thank_you.draw()
+screens.thank_you.draw()
 win.flip()
 event.waitKeys()
 
 win.close()
+trial_log.close()
+key_log.close()
 
 df = pd.DataFrame(all_responses)
 df.columns = ['subj', 'block', 'trial', 'SOA', 'resp', 'resp_recode', 'rt']
-df.to_csv(outputFileName)
-
+save_csv(df, outputFileName)
+journal.end()
+timer.close()
+profile.close()
+write_events(eventFile, build_events(triggers.close(), np.load(timingFile), df))
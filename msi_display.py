@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# msi display calibration
+# Replaces the blocking win.getActualFrameRate() startup check. The refresh rate and
+# frame-interval jitter are measured once per display (host, screen, window size,
+# monitor profile) and cached in data/display_calibration.json. At launch
+# QUICK_FRAMES flips are timed and compared with the cached rate; only if they
+# disagree, drop a frame or nothing is cached is the full FULL_FRAMES measurement
+# run again (and the cache updated). The rate is frames elapsed over the span of
+# flip timestamps, so a short run already resolves it to a few hundredths of a Hz.
+#
+# python msi_display.py           show the cached calibrations
+# python msi_display.py --clear   forget them (the next launch measures again)
+
+import os, json, time, platform, argparse
+from collections import namedtuple
+import numpy as np
+
+CACHE_FILENAME = 'data' + os.sep + 'display_calibration.json'
+
+WARMUP_FRAMES = 5
+QUICK_FRAMES = 40 #launch check, 0.4 s at 100 Hz
+FULL_FRAMES = 300 #full measurement, 3 s at 100 Hz
+QUICK_TOLERANCE = 0.1 #Hz between the launch check and the cached rate
+RATE_TOLERANCE = 0.15 #Hz between the display and the rate the script needs
+
+Calibration = namedtuple('Calibration', ['key', 'rate', 'jitter_ms', 'max_interval_ms', 'n_dropped',
+                                         'n_frames', 'measured', 'source'])
+
+
+def display_key(win, screen=0):
+    """Identifies a display configuration: host, screen, window size and monitor profile"""
+    size = getattr(win, 'size', None)
+    monitor = getattr(getattr(win, 'monitor', None), 'name', None)
+    return '|'.join([platform.node(), 'screen' + str(screen),
+                     'x'.join(str(int(v)) for v in size) if size is not None else '-', str(monitor or '-')])
+
+
+def measure(win, n_frames, frame_dur=None):
+    """Time n_frames flips: rate (Hz), jitter (sd of single-frame intervals, ms), longest
+    interval (ms) and dropped frames, with frame_dur (or the median interval) as one frame"""
+    for _ in range(WARMUP_FRAMES):
+        win.flip()
+    t = np.array([win.flip() for _ in range(n_frames + 1)])
+    intervals = np.diff(t)
+    frames = np.maximum(np.round(intervals / (frame_dur or np.median(intervals))), 1)
+    single = intervals[frames == 1]
+    return {'rate': float(frames.sum() / (t[-1] - t[0])),
+            'jitter_ms': float(np.std(single) * 1000) if len(single) > 1 else float('nan'),
+            'max_interval_ms': float(intervals.max() * 1000),
+            'n_dropped': int((frames - 1).sum()),
+            'n_frames': int(n_frames)}
+
+
+def load_cache(filename=CACHE_FILENAME):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _save_cache(cache, filename):
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def calibrate(win, screen=0, filename=CACHE_FILENAME, force=False):
+    """Refresh rate and jitter for this display: the cached calibration if a quick check agrees
+    with it, otherwise a full measurement (which is cached). Returns a Calibration."""
+    key = display_key(win, screen)
+    cache = load_cache(filename)
+    cached = cache.get(key)
+
+    if cached is not None and not force:
+        quick = measure(win, QUICK_FRAMES, 1.0 / cached['rate'])
+        if abs(quick['rate'] - cached['rate']) <= QUICK_TOLERANCE and quick['n_dropped'] == 0:
+            return Calibration(key=key, source='cached', **cached)
+
+    full = measure(win, FULL_FRAMES)
+    full['measured'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    cache[key] = full
+    _save_cache(cache, filename)
+    return Calibration(key=key, source='measured', **full)
+
+
+def describe(calibration):
+    return ("%.3f Hz, jitter %.3f ms, longest interval %.1f ms, %d dropped of %d frames (%s %s, display %s)"
+            % (calibration.rate, calibration.jitter_ms, calibration.max_interval_ms, calibration.n_dropped,
+               calibration.n_frames, calibration.source, calibration.measured, calibration.key))
+
+
+def mismatch(calibration, framerate, tolerance=RATE_TOLERANCE):
+    """None if the display runs at framerate, otherwise a message for sys.exit"""
+    if abs(calibration.rate - framerate) <= tolerance:
+        return None
+    return ("Expected refresh rate: " + str(framerate) + ". Actual rate: " + describe(calibration)
+            + ". Fix the display settings; if the display changed, the next launch measures again"
+            + " (or run msi_display.py --clear).")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cached display calibrations')
+    parser.add_argument('--clear', action='store_true', help='forget every cached calibration')
+    parser.add_argument('--wd', default='.', help='experiment directory containing data/')
+    args = parser.parse_args()
+    os.chdir(args.wd)
+    if args.clear:
+        if os.path.isfile(CACHE_FILENAME):
+            os.remove(CACHE_FILENAME)
+        print("Cleared " + CACHE_FILENAME)
+    else:
+        for key, values in sorted(load_cache().items()):
+            print(describe(Calibration(key=key, source='cached', **values)))
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# msi EEG event table
+# One typed row per trigger msi_b sent: trial index, run, block, code and kind (condition,
+# response, clear), its intended and actual time, and that trial's audio and visual
+# onsets, requested/achieved SOA and RT, all on the session clock (core.getTime, the
+# clock of win.flip() and of the trigger and frame-timing logs). A resumed session is one
+# run per process, each with its own clock starting from 0, so times only compare within
+# a run. msi_b.py writes it to
+# data/msi_b/msi_b_sub<N>_events.npy at the end of the session by joining the
+# _triggers.npy and _timing.npy logs with the responses on trial index, so nothing has
+# to be matched up against the behavioural CSV afterwards.
+#
+# epoch_samples() turns the table into epoch onset/start/stop sample indices for any
+# EEG sampling rate. Session times map to EEG samples either relative to the first
+# trigger (single-run sessions only) or through align(), a least-squares fit per run of
+# the samples at which the EEG recorded the condition triggers (which also absorbs clock
+# drift and the gap before a resumed run).
+#
+# python msi_events.py [--wd DIR] [--force]   build missing tables for finished sessions
+# python msi_events.py --check                  build and epoch a simulated msi_b session
+
+import os, sys, glob, re, argparse, tempfile
+import numpy as np
+import pandas as pd
+
+CONDITION_CODES = {50: 'ASOA50r', 95: 'ASOA95r', 150: 'VSOA50r', 195: 'VSOA95r', 10: 'A10', 110: 'V10'}
+RESPONSE_CODES = {1: 'async', 2: 'sync', 3: 'no response'}
+KINDS = ['clear', 'condition', 'response']
+CLEAR, CONDITION, RESPONSE = range(len(KINDS))
+
+EVENT_DTYPE = np.dtype([('trial', 'i2'), ('run', 'i1'), ('block', 'i1'), ('code', 'i2'), ('kind', 'i1'),
+                        ('intended', 'f8'), ('actual', 'f8'),
+                        ('audio_onset', 'f8'), ('visual_onset', 'f8'),
+                        ('requested_SOA', 'f4'), ('achieved_SOA', 'f4'), ('rt', 'f4')])
+
+EPOCH_DTYPE = np.dtype([('trial', 'i2'), ('code', 'i2'), ('onset', 'i8'), ('start', 'i8'), ('stop', 'i8')])
+
+ONSETS = {'trigger': 'actual', 'audio': 'audio_onset', 'visual': 'visual_onset'}
+
+
+def event_paths(subj):
+    base = 'data' + os.sep + 'msi_b' + os.sep + 'msi_b_sub' + str(subj)
+    return {'data': base + '.csv', 'triggers': base + '_triggers.npy', 'timing': base + '_timing.npy',
+            'events': base + '_events.npy'}
+
+
+def build_events(triggers, timing, responses):
+    """Event table from the trigger log (load_triggers), the FrameTimer array and the
+    session's responses (dataframe with an rt column, rows in trial order), in the order the
+    triggers were sent (a resumed session's clock starts again from 0, so actual times only
+    increase within one run)"""
+    trial = triggers['trial'].astype(int)
+    run = triggers['run'].astype(int)
+    events = np.zeros(len(triggers), dtype=EVENT_DTYPE)
+    events['trial'] = trial
+    events['run'] = run
+    events['code'] = triggers['value']
+    events['kind'] = np.where(triggers['value'] == 0, CLEAR,
+                              np.where(np.isin(triggers['value'], list(CONDITION_CODES)), CONDITION, RESPONSE))
+    events['intended'] = triggers['intended']
+    events['actual'] = triggers['actual']
+
+    #rows of trials the timer never finished (unused, or escaped mid-trial) have no requested SOA
+    known = (trial >= 0) & (trial < len(timing))
+    known[known] = ~np.isnan(timing['requested_SOA'][trial[known]])
+    #a trial cut off by a crash is run again after the resume, and the timer row is the rerun's
+    last_run = np.full(len(timing), -1)
+    np.maximum.at(last_run, trial[known], run[known])
+    known[known] = run[known] == last_run[trial[known]]
+    rows = np.where(known, trial, 0)
+    events['block'] = np.where(known, timing['block'][rows], 0)
+    for name, column in [('audio_onset', 'audio_time'), ('visual_onset', 'visual_time'),
+                         ('requested_SOA', 'requested_SOA'), ('achieved_SOA', 'achieved_SOA')]:
+        events[name] = np.where(known, timing[column][rows], np.nan)
+
+    answered = (trial >= 0) & (trial < len(responses))
+    rt = pd.to_numeric(responses['rt'], errors='coerce').values
+    events['rt'] = np.where(answered, rt[np.where(answered, trial, 0)], np.nan)
+    return events
+
+
+def write_events(filename, events):
+    tmp = filename + '.tmp.npy'
+    np.save(tmp, events)
+    os.replace(tmp, filename)
+
+
+def build_subject(subj):
+    """Build and write one finished msi_b session's event table from its logs; returns it"""
+    from msi_triggers import load_triggers
+    paths = event_paths(subj)
+    events = build_events(load_triggers(paths['triggers']), np.load(paths['timing']), pd.read_csv(paths['data']))
+    write_events(paths['events'], events)
+    return events
+
+
+#%% loading and epoching
+def load_events(filename, codes=None, kinds=None):
+    """A saved event table, memory-mapped, optionally only some codes or kinds"""
+    events = np.load(filename, mmap_mode='r')
+    mask = np.ones(len(events), dtype=bool)
+    if codes is not None:
+        mask &= np.isin(events['code'], list(codes))
+    if kinds is not None:
+        mask &= np.isin(events['kind'], list(kinds))
+    return np.asarray(events[mask])
+
+
+def align(events, eeg_samples):
+    """(intercept, slope) per run mapping that run's session time to EEG sample, from the
+    samples at which the EEG recorded each condition trigger (in order, all runs in one
+    recording); row r is run r and its slope is the effective sampling rate"""
+    condition = events[events['kind'] == CONDITION]
+    eeg_samples = np.asarray(eeg_samples, dtype=float)
+    if len(condition) != len(eeg_samples):
+        raise ValueError("%d condition triggers in the table but %d in the EEG" % (len(condition), len(eeg_samples)))
+    alignment = np.full((int(events['run'].max()) + 1 if len(events) else 0, 2), np.nan)
+    for run in np.unique(condition['run']):
+        in_run = condition['run'] == run
+        if in_run.sum() < 2:
+            raise ValueError("run %d has fewer than 2 condition triggers to align" % run)
+        slope, intercept = np.polyfit(condition['actual'][in_run], eeg_samples[in_run], 1)
+        alignment[run] = intercept, slope
+    return alignment
+
+
+def epoch_samples(events, sfreq, tmin=-0.2, tmax=0.8, onset='trigger', codes=CONDITION_CODES, alignment=None):
+    """Epoch onset, start and stop (exclusive) sample indices, one row per event with a code in codes.
+
+    onset: 'trigger' (actual trigger time), 'audio' or 'visual' (that trial's stimulus onset).
+    alignment: (intercept, slope) per run from align(); without it, samples at sfreq count
+    from the first trigger in the table, which only holds for a session that was never resumed."""
+    selected = events[np.isin(events['code'], list(codes))]
+    if alignment is None:
+        if len(events) and events['run'].max() > 0:
+            raise ValueError("resumed session (%d runs): epoch it with align()" % (events['run'].max() + 1))
+        alignment = [(-events['actual'].min() * sfreq, float(sfreq))]
+    alignment = np.asarray(alignment, dtype=float)
+    if selected['run'].max(initial=-1) >= len(alignment):
+        raise ValueError("no alignment for run %d" % selected['run'].max())
+    intercept, slope = alignment[selected['run']].T
+    onsets = np.round(intercept + slope * selected[ONSETS[onset]])
+    epochs = np.zeros(len(selected), dtype=EPOCH_DTYPE)
+    epochs['trial'] = selected['trial']
+    epochs['code'] = selected['code']
+    epochs['onset'] = np.where(np.isnan(onsets), -1, onsets)
+    epochs['start'] = epochs['onset'] + int(np.round(tmin * sfreq))
+    epochs['stop'] = epochs['onset'] + int(np.round(tmax * sfreq)) + 1
+    return epochs[~np.isnan(onsets)]
+
+
+def to_frame(events):
+    """Event table as a dataframe with categorical condition, response and kind labels"""
+    df = pd.DataFrame(events)
+    df['kind'] = pd.Categorical.from_codes(df.kind, KINDS)
+    df['label'] = df.code.map({**CONDITION_CODES, **RESPONSE_CODES, 0: 'clear'}).astype('category')
+    return df
+
+
+#%% check
+def check(subj='2', sfreq=512, drift=20e-6, offset=37.25):
+    """Simulated msi_b session: the table written at the end has one row per trigger sent, and
+    epochs aligned to simulated EEG samples (offset s into the recording, clock drift in s/s)
+    land on the samples the EEG would have recorded the condition triggers at"""
+    from msi_sim import run_session
+    from bench_msi import write_soa_file
+    with tempfile.TemporaryDirectory() as wd:
+        run_session('msi_a.py', subj=subj, wd=wd)
+        write_soa_file(wd, subj)
+        sim = run_session('msi_b.py', subj=subj, wd=wd)
+        if sim.exit not in (None, 0) or sim.error is not None:
+            sys.exit("Simulated session failed: " + str(sim.exit or sim.error))
+        events = load_events(os.path.join(wd, event_paths(subj)['events']))
+
+    sent = np.array([value for _, _, value, _ in sim.triggers])
+    if len(events) != len(sent) or not np.array_equal(events['code'], sent):
+        raise AssertionError("event table does not match the %d triggers sent" % len(sent))
+    condition = events[events['kind'] == CONDITION]
+    eeg = np.round((np.array([t for t, _, value, _ in sim.triggers if value in CONDITION_CODES]) + offset)
+                   * sfreq * (1 + drift))
+    epochs = epoch_samples(events, sfreq, alignment=align(events, eeg))
+    return {'events': len(events), 'condition_events': len(condition),
+            'epoch_error_samples': np.abs(epochs['onset'] - eeg).mean(),
+            #condition triggers go out on the flip of whichever stimulus comes first
+            'trigger_minus_first_onset_ms': np.median(condition['actual'] - np.minimum(condition['audio_onset'],
+                                                                                 condition['visual_onset'])) * 1000,
+            'audio_minus_visual_ms': np.median(condition['audio_onset'] - condition['visual_onset']
+                                               - condition['requested_SOA'] / 1000) * 1000}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build EEG event tables for finished msi_b sessions')
+    parser.add_argument('--wd', default='.', help='experiment directory containing data/')
+    parser.add_argument('--force', action='store_true', help='rebuild existing tables')
+    parser.add_argument('--check', action='store_true', help='build and epoch a simulated msi_b session')
+    args = parser.parse_args()
+    if args.check:
+        for name, value in check().items():
+            print(name + ": " + str(round(value, 3)))
+        sys.exit()
+    os.chdir(args.wd)
+    for f in sorted(glob.glob(os.path.join('data', 'msi_b', 'msi_b_sub*.csv'))):
+        m = re.match(r'msi_b_sub(\d+)\.csv$', os.path.basename(f))
+        if not m:
+            continue
+        paths = event_paths(m.group(1))
+        if os.path.isfile(paths['events']) and not args.force:
+            continue
+        if not (os.path.isfile(paths['triggers']) and os.path.isfile(paths['timing'])):
+            print("sub" + m.group(1) + ": no trigger/timing logs")
+            continue
+        events = build_subject(m.group(1))
+        print("sub" + m.group(1) + ": " + str(len(events)) + " events -> " + paths['events'])
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# msi trial logger
+# Keeps the per-subject log file open and writes rows from a background thread.
+# Rows are only queued during a trial; nothing touches the disk until flush() is
+# called from the ITI, so file I/O can't land inside the core.rush stimulus window.
+# SessionJournal uses the same writer to keep a write-ahead journal of the
+# pre-shuffled schedule and completed trials so a crashed session can be resumed.
+
+import os, csv, json, atexit, threading, queue
+
+
+class TrialLogger:
+    """Append-only CSV log written by a background thread.
+
+    log() only queues the row. flush() hands everything queued so far to the
+    writer thread, which writes, flushes and fsyncs it while the caller carries on."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'a', newline='')
+        self._writer = csv.writer(self._file, dialect='excel')
+        self._pending = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='TrialLogger', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, row):
+        """Queue a row; no I/O happens until the next flush()"""
+        self._pending.append(list(row))
+
+    def flush(self, wait=False):
+        """Write all queued rows to disk on the writer thread.
+
+        Call during the ITI. With wait=True, block until the rows are fsynced."""
+        rows, self._pending = self._pending, []
+        done = threading.Event()
+        self._queue.put((rows, done))
+        if wait:
+            done.wait()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def abandon(self):
+        """Stop as a killed process would: rows not yet flushed are dropped, not written"""
+        if self._file.closed:
+            return
+        self._pending = []
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            rows, done = item
+            if rows:
+                self._write(rows)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            done.set()
+
+    def _write(self, rows):
+        self._writer.writerows(rows)
+
+
+class SessionJournal(TrialLogger):
+    """Write-ahead journal of a session: one JSON record per line.
+
+    The first record is the whole pre-shuffled schedule (one list of SOAs per block),
+    followed by one record per completed trial and an 'end' record when the session
+    finishes. Use create() for a new session and resume() after a crash."""
+
+    @classmethod
+    def create(cls, filename, schedule):
+        if os.path.isfile(filename):
+            raise FileExistsError(filename)
+        journal = cls(filename)
+        journal.log({'type': 'schedule', 'blocks': schedule})
+        journal.flush(wait=True)
+        return journal
+
+    @classmethod
+    def resume(cls, filename):
+        """Reopen a journal, returning (journal, schedule, completed trial rows)"""
+        schedule, rows, valid_bytes = cls.read(filename)
+
+        #drop a torn last record so new records follow a complete line
+        with open(filename, 'r+b') as fd:
+            fd.truncate(valid_bytes)
+        return cls(filename), schedule, rows
+
+    @staticmethod
+    def read(filename):
+        """Schedule, completed trial rows and length in bytes of the valid part of a journal.
+
+        A partially written last line (the process died mid-write) is ignored."""
+        schedule, rows, valid_bytes = None, [], 0
+        with open(filename, 'rb') as fd:
+            for line in fd:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                valid_bytes += len(line)
+                if record['type'] == 'schedule':
+                    schedule = record['blocks']
+                elif record['type'] == 'trial':
+                    rows.append(record['row'])
+                elif record['type'] == 'end':
+                    raise ValueError("Session in " + filename + " already finished")
+        if schedule is None:
+            raise ValueError("No schedule in " + filename)
+        return schedule, rows, valid_bytes
+
+    def log_trial(self, row):
+        self.log({'type': 'trial', 'row': row})
+
+    def end(self):
+        self.log({'type': 'end'})
+        self.close()
+
+    def log(self, record):
+        self._pending.append(record)
+
+    def _write(self, records):
+        for record in records:
+            self._file.write(json.dumps(record) + '\n')
+
+
+def resume_point(schedule, rows):
+    """(block, trial) index of the first trial still to run, given completed rows"""
+    done = len(rows)
+    for block, trials in enumerate(schedule):
+        if done < len(trials):
+            return block, done
+        done -= len(trials)
+    return len(schedule), 0
+
+
+def save_csv(df, filename):
+    """Write a dataframe so that filename is either the old file or the complete new one.
+
+    The data goes to a temporary file which is fsynced and then renamed over filename."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', newline='') as fd:
+        df.to_csv(fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# msi phase profiler
+# Timestamps every phase of the trial loop (trial start, jitter end, beep start, flash
+# flip, end of the stimulus window, prompt flip, response, blank flip, log flushed,
+# end of the ITI) into a preallocated ring buffer. mark() is a clock read and four
+# array stores with no allocation or I/O, so it can stay on in real EEG sessions.
+# Phases with a deadline (the flip they belong to, or a budget after the previous
+# event) store it too, so overruns can be reported.
+#
+# save() writes the events so far to a .npy next to the subject's CSV; it is called at
+# block breaks, so a crashed session keeps all but its last block and a resumed one
+# carries on from them. close() saves them and writes an end-of-session report
+# (_profile_summary.csv): per phase, the time since the previous event (total, median,
+# 95th/99th percentile, max) and the overrun past its deadline (count over
+# OVERRUN_TOLERANCE, worst overrun and its trial).
+#
+# python msi_profile.py --check   mark() cost and the report of a simulated msi_a session
+# python msi_profile.py FILE.npy  report of a saved session
+
+import os, sys, time, argparse, tempfile
+import numpy as np
+import pandas as pd
+
+PHASES = ['trial_start', 'jitter_end', 'beep_start', 'flash_flip', 'stim_end',
+          'prompt_flip', 'response', 'blank_flip', 'log_flushed', 'iti_end']
+(TRIAL_START, JITTER_END, BEEP_START, FLASH_FLIP, STIM_END,
+ PROMPT_FLIP, RESPONSE, BLANK_FLIP, LOG_FLUSHED, ITI_END) = range(len(PHASES))
+
+EVENT_DTYPE = np.dtype([('trial', 'i4'), ('phase', 'i1'), ('t', 'f8'), ('deadline', 'f8')])
+
+CAPACITY = 16384 #events kept; a 304-trial session uses about 3000
+FLUSH_BUDGET = 0.002 #s from the blank flip until the log/journal flushes have returned
+OVERRUN_TOLERANCE = 0.5 #frames past a deadline before an event counts as an overrun
+
+
+class PhaseProfiler:
+    """Ring buffer of (trial, phase, time, deadline) events for one session.
+
+    Usage:
+        profile.start_trial(trial_index)
+        run_trial(..., profile=profile)                  # jitter_end .. stim_end
+        profile.mark(PROMPT_FLIP, win.flip(), budget=0.75 + frame_dur)
+        profile.mark(RESPONSE)
+        ...
+        profile.close()                                  # at the end of the session
+
+    clock is the same clock as msi_timing.FrameTimer's.
+    A deadline is an absolute time; budget (s) sets it relative to the previous event."""
+
+    def __init__(self, filename, clock, capacity=CAPACITY, frame_dur=0.01, resume=False):
+        self.filename = filename
+        self.clock = clock
+        self.capacity = capacity
+        self.frame_dur = frame_dur
+        self._trial = np.zeros(capacity, dtype='i4')
+        self._phase = np.full(capacity, -1, dtype='i1')
+        self._t = np.full(capacity, np.nan)
+        self._deadline = np.full(capacity, np.nan)
+        self.n = 0 #events marked, including any overwritten
+        self.trial = -1
+        self._last = np.nan
+        if resume and os.path.isfile(filename):
+            for event in np.load(filename)[-capacity:]:
+                self.trial = event['trial']
+                self.mark(event['phase'], event['t'], event['deadline'])
+
+    def start_trial(self, index):
+        self.trial = index
+        self.mark(TRIAL_START)
+
+    def mark(self, phase, t=None, deadline=np.nan, budget=None):
+        """Record phase at time t (default: now); returns t"""
+        if t is None:
+            t = self.clock()
+        if budget is not None:
+            deadline = self._last + budget
+        i = self.n % self.capacity
+        self._trial[i] = self.trial
+        self._phase[i] = phase
+        self._t[i] = t
+        self._deadline[i] = deadline
+        self.n += 1
+        self._last = t
+        return t
+
+    def events(self):
+        """Recorded events in the order they were marked, as an EVENT_DTYPE array"""
+        n = min(self.n, self.capacity)
+        order = np.arange(self.n - n, self.n) % self.capacity
+        events = np.empty(n, dtype=EVENT_DTYPE)
+        events['trial'] = self._trial[order]
+        events['phase'] = self._phase[order]
+        events['t'] = self._t[order]
+        events['deadline'] = self._deadline[order]
+        return events
+
+    def save(self):
+        """Write the events so far (only call outside the trial loop, e.g. at a block break)"""
+        events = self.events()
+        np.save(self.filename, events)
+        return events
+
+    def close(self):
+        """Save the events and the report next to the subject's CSV; returns the report"""
+        events = self.save()
+        if self.n > len(events):
+            print("Warning: profile ring buffer overflowed - the first " + str(self.n - len(events))
+                  + " events were overwritten")
+        summary = report(events, self.frame_dur)
+        summary.to_csv(os.path.splitext(self.filename)[0] + '_summary.csv')
+        return summary
+
+
+def report(events, frame_dur=0.01):
+    """Per-phase time since the previous event and overruns past deadlines, in ms"""
+    events = np.sort(events, order='t', kind='stable')
+    since = np.diff(events['t'], prepend=np.nan) * 1000
+    overrun = (events['t'] - events['deadline']) * 1000
+    rows = []
+    for code, name in enumerate(PHASES):
+        mask = events['phase'] == code
+        if not mask.any():
+            continue
+        x = since[mask][np.isfinite(since[mask])]
+        over = overrun[mask]
+        has_deadline = np.isfinite(over)
+        late = has_deadline & (over > OVERRUN_TOLERANCE * frame_dur * 1000)
+        worst = np.nanargmax(np.where(has_deadline, over, -np.inf)) if has_deadline.any() else None
+        rows.append({'phase': name, 'n': int(mask.sum()),
+                     'total_s': x.sum() / 1000,
+                     'median_ms': np.median(x) if len(x) else np.nan,
+                     'p95_ms': np.percentile(x, 95) if len(x) else np.nan,
+                     'p99_ms': np.percentile(x, 99) if len(x) else np.nan,
+                     'max_ms': x.max() if len(x) else np.nan,
+                     'n_deadlines': int(has_deadline.sum()),
+                     'n_overruns': int(late.sum()),
+                     'max_overrun_ms': over[worst] if worst is not None else np.nan,
+                     'worst_trial': int(events['trial'][mask][worst]) if worst is not None else -1})
+    summary = pd.DataFrame(rows).set_index('phase')
+    summary['share'] = summary.total_s / summary.total_s.sum()
+    return summary
+
+
+#%% check
+def mark_cost(n=100000):
+    """Mean wall time of one mark() call with the clock read included (s)"""
+    profile = PhaseProfiler(os.devnull, time.perf_counter, capacity=4096)
+    start = time.perf_counter()
+    for _ in range(n):
+        profile.mark(STIM_END)
+    return (time.perf_counter() - start) / n
+
+
+def check(subj='2'):
+    """Report of a simulated msi_a session (msi_sim)"""
+    from msi_sim import run_session
+    with tempfile.TemporaryDirectory() as wd:
+        sim = run_session('msi_a.py', subj=subj, wd=wd)
+        if sim.exit not in (None, 0) or sim.error is not None:
+            sys.exit("Simulated session failed: " + str(sim.exit or sim.error))
+        return report(np.load(os.path.join(wd, 'data', 'msi_a', 'msi_a_sub' + subj + '_profile.npy')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trial-loop phase profile report')
+    parser.add_argument('filename', nargs='?', help='a saved _profile.npy')
+    parser.add_argument('--check', action='store_true', help='mark() cost and a simulated msi_a session')
+    parser.add_argument('--frame-dur', type=float, default=0.01)
+    args = parser.parse_args()
+    pd.set_option('display.width', 200)
+    if args.check:
+        print("mark(): %.2f us per call" % (mark_cost() * 1e6))
+        print(check().round(3).to_string())
+    elif args.filename:
+        print(report(np.load(args.filename), args.frame_dur).round(3).to_string())
+    else:
+        parser.error("give a _profile.npy file or --check")
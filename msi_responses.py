@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# msi response collection
+# Collects responses with psychopy.hardware.keyboard, whose key events are queued
+# and timestamped by a background thread (psychtoolbox) rather than by the event pump.
+# RTs are measured from the prompt flip: the keyboard clock is reset in the prompt's
+# callOnFlip. Every key event of a trial, including presses made during the stimulus
+# window (negative RT) and after the response, is written to a _keys.csv log with
+# columns trial, key, rt, response (1 for the press taken as the response).
+# No response gives a real NaN RT.
+
+import numpy as np
+
+NO_RESPONSE = 'NaN' #resp value for no response, as in the resp_dict lookups
+
+
+class ResponseCollector:
+    """Flip-locked, hardware-timestamped responses for one session.
+
+    Usage:
+        responses.start_trial(trial_index)    # before the stimulus window
+        prompt.draw()
+        responses.prompt()                    # just before the prompt's win.flip()
+        win.flip()
+        resp, rt = responses.wait(maxWait=2)  # ('NaN', nan) if no response
+
+    keyboard is a psychopy.hardware.keyboard.Keyboard; wait is core.wait (used between
+    polls; the timestamps come from the keyboard, so the poll interval only delays
+    detection). log is an optional TrialLogger for the key events."""
+
+    def __init__(self, keyboard, win, wait, keyList=('left', 'right', 'escape', 'ctrl'), log=None,
+                 poll_interval=0.001):
+        self.keyboard = keyboard
+        self.win = win
+        self._wait = wait
+        self.keyList = list(keyList)
+        self.log = log
+        self.poll_interval = poll_interval
+        self.trial = -1
+
+    def start_trial(self, index):
+        """Log the previous trial's remaining key events and start collecting for this one"""
+        if self.trial >= 0:
+            self._record(self.keyboard.getKeys(keyList=self.keyList, waitRelease=False))
+        else:
+            self.keyboard.clearEvents()
+        self.trial = index
+
+    def prompt(self):
+        """Reset the RT clock on the next flip; call right before the prompt's flip"""
+        self.win.callOnFlip(self.keyboard.clock.reset)
+
+    def _record(self, keys, response=None):
+        if self.log is not None:
+            for key in keys:
+                self.log.log([self.trial, key.name, key.rt, int(key is response)])
+
+    def wait(self, maxWait=2):
+        """First key press after the prompt flip as (key, rt in s), or ('NaN', nan) after maxWait"""
+        while True:
+            keys = self.keyboard.getKeys(keyList=self.keyList, waitRelease=False)
+            response = next((key for key in keys if key.rt >= 0), None)
+            self._record(keys, response)
+            if response is not None:
+                return response.name, float(response.rt)
+            if self.keyboard.clock.getTime() >= maxWait:
+                return NO_RESPONSE, np.nan
+            self._wait(self.poll_interval)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# msi frame schedule
+# Compiles a whole session's SOA list into a flat per-frame action table before the
+# first trial (what to draw, when to start the beep, which trigger to send), so the
+# trial loop only replays rows and the frame counts can be checked without a display.
+#
+# Frame positions come from the audio latency model in msi_audio: the beep is started
+# from the on-flip callback of the frame play_offset() flips after the flash, so its
+# onset lands SOA ms after the flash for any measured latency. With the lab's 20 ms
+# latency this gives the frame counts of the original hand-tuned branches.
+# In msi_b the trigger is set on the flip where the first stimulus lands (sound onset
+# for A first, flash otherwise) and cleared pulse_frames flips later.
+
+import random
+import numpy as np
+from msi_audio import AUDIO_LATENCY, play_offset, onset_flip
+from msi_profile import BEEP_START, JITTER_END, FLASH_FLIP, STIM_END
+
+NO_TRIGGER = -1 #trigger column value for "leave the port alone"
+
+FRAME_DTYPE = np.dtype([('rush', '?'),      #inside the core.rush stimulus window
+                        ('beep', '?'),      #start the beep from this frame's on-flip callback
+                        ('flash', '?'),     #draw the flash on this frame
+                        ('trigger', 'i2')]) #set the port to this value on this frame's flip
+
+
+def compile_stimulus(SOA_ms, trigger=None, pulse_frames=1, audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """Frames of one trial's stimulus window, starting with the fixation flip after core.rush(True).
+
+    SOA_ms is audio minus visual onset; trigger is the condition code to send (msi_b)
+    or None for no port output (msi_a)."""
+    offset = play_offset(SOA_ms, audio_latency, frame_ms)
+    flash_at = max(1, -offset) #the beep can start on the first flip of the window, the flash can't
+    play_at = flash_at + offset
+
+    fix = (True, False, False, NO_TRIGGER)
+    frames = (max(flash_at, play_at) + 2)*[fix] #one fixation frame after the last stimulus
+    frames[flash_at] = (True, False, True, NO_TRIGGER)
+    frames[play_at] = (True, True, frames[play_at][2], NO_TRIGGER)
+
+    if trigger is not None:
+        set_at = min(flash_at, onset_flip(play_at, audio_latency, frame_ms))
+        clear_at = set_at + pulse_frames
+        frames += (clear_at + 1 - len(frames))*[fix] #hold fixation until the pulse ends
+        frames[set_at] = frames[set_at][:3] + (trigger,)
+        frames[clear_at] = frames[clear_at][:3] + (0,)
+
+    return frames
+
+
+def compile_trial(SOA_ms, jitter, trigger=None, pulse_frames=1, audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """All frames of one trial: fixation onset, jitter frames, then the stimulus window"""
+    fix = (False, False, False, NO_TRIGGER)
+    return (jitter + 1)*[fix] + compile_stimulus(SOA_ms, trigger, pulse_frames, audio_latency, frame_ms)
+
+
+class FrameTable:
+    """Per-frame action table for a whole session, indexed by trial number"""
+
+    def __init__(self, frames, offsets):
+        self.frames = frames
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def trial(self, index):
+        """Rows of one trial as a list of (rush, beep, flash, trigger) tuples, ready to replay"""
+        return self.frames[self.offsets[index]:self.offsets[index + 1]].tolist()
+
+    def stimulus_frames(self, index):
+        """Number of frames in the trial's core.rush window"""
+        return int(np.sum(self.frames['rush'][self.offsets[index]:self.offsets[index + 1]]))
+
+
+def compile_session(SOAs, triggers=None, jitter_range=(100, 150), pulse_frames=1,
+                    audio_latency=AUDIO_LATENCY, frame_ms=10):
+    """Compile every trial of a session into one FrameTable.
+
+    SOAs: SOA in ms for each trial in presentation order.
+    triggers: condition trigger per trial, or None for no port output.
+    pulse_frames: trigger pulse width in frames.
+    audio_latency: seconds from the on-flip play() call to sound onset for this setup."""
+    if triggers is None:
+        triggers = [None]*len(SOAs)
+
+    trials = [compile_trial(SOA, random.randint(*jitter_range), trigger, pulse_frames, audio_latency, frame_ms)
+              for SOA, trigger in zip(SOAs, triggers)]
+    offsets = np.cumsum([0] + [len(t) for t in trials])
+    frames = np.array([f for t in trials for f in t], dtype=FRAME_DTYPE)
+    return FrameTable(frames, offsets)
+
+
+def run_trial(rows, win, fixation, flash, beep, rush, triggers=None, timer=None, profile=None):
+    """Replay one trial's rows from FrameTable.trial().
+
+    fixation and flash are the pre-rendered fixation and flash + fixation screens (msi_stimuli),
+    so each frame is one draw call. rush is core.rush; the beep and triggers (a TriggerScheduler) are started from their
+    frame's on-flip callback; timer is an optional FrameTimer recording the stimulus window flips;
+    profile is an optional PhaseProfiler, given each stimulus phase with its frame deadline
+    (the fixation onset flip plus that many frames)."""
+    in_rush = False
+    t = t0 = jitter_end = None
+    for i, (in_window, play_beep, show_flash, trigger) in enumerate(rows):
+        if in_window and not in_rush:
+            rush(True) #give psychopy priority during stimulus presentation
+            in_rush = True
+            jitter_end = i
+        if play_beep:
+            if timer is not None:
+                win.callOnFlip(timer.audio)
+            win.callOnFlip(beep.play)
+            if profile is not None:
+                win.callOnFlip(profile.mark, BEEP_START, None, t0 + i * profile.frame_dur)
+        if show_flash:
+            flash.draw() #flash and fixation in one texture
+        else:
+            fixation.draw()
+        if trigger != NO_TRIGGER:
+            triggers.on_flip(win, trigger, t)
+        t = win.flip()
+        if in_rush and timer is not None:
+            timer.flip(t, visual=show_flash)
+        if profile is not None:
+            if i == 0:
+                t0 = t
+            elif i == jitter_end:
+                profile.mark(JITTER_END, t, t0 + i * profile.frame_dur)
+            if show_flash:
+                profile.mark(FLASH_FLIP, t, t0 + i * profile.frame_dur)
+    rush(False)
+    if profile is not None:
+        profile.mark(STIM_END, None, t0 + (len(rows) - 1) * profile.frame_dur)
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+# msi simulation backend
+# Stand-ins for the psychopy modules msi_a.py and msi_b.py use (prefs, visual, core,
+# event, gui, logging, sound, parallel, hardware.keyboard) driven by a virtual clock, plus a simulated
+# observer who answers from the SOA actually presented. A full session runs headless
+# in seconds with no display, sound card or parallel port.
+#
+# Usage:
+#     from msi_sim import run_session
+#     sim = run_session('msi_a.py', subj='2', wd='/tmp/msi')
+#     sim.flips, sim.triggers, sim.trials     #everything the script did, with times
+
+import os, sys, time, types, runpy, random, contextlib
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#left (SOA <= 0) and right (SOA > 0) sigmoid parameters of the simulated observer
+OBSERVER_PARAMS = ((0.95, 0.03, -120), (0.95, -0.025, 160))
+
+DATA_FOLDERS = ['msi_a', 'msi_b', 'SOAs', 'plots', 'fit_results',
+                os.path.join('logfiles', 'msi_a'), os.path.join('logfiles', 'msi_b')]
+
+
+class SimCrash(Exception):
+    """Raised by the simulation to kill a session mid-run (for testing resume)"""
+
+
+class Simulation:
+    """Shared state of one simulated session: virtual clock, observer and event logs.
+
+    framerate: simulated refresh rate (Hz)
+    audio_latency: seconds from beep.play() to sound onset
+    no_response_rate: fraction of trials with no key press
+    crash_after: raise SimCrash after this many responses (None = never)
+    early_press_rate: fraction of trials with an extra key press on the flash (hardware.keyboard only)
+    realtime_factor: 0 runs as fast as possible; N > 0 paces flips at N x real time"""
+
+    def __init__(self, subj='2', resume=False, adaptive=False, framerate=100, audio_latency=0.02,
+                 observer_params=OBSERVER_PARAMS, no_response_rate=0.02,
+                 crash_after=None, early_press_rate=0.0, realtime_factor=0, seed=0):
+        self.subj = subj
+        self.resume = resume
+        self.adaptive = adaptive
+        self.frame_dur = 1.0 / framerate
+        self.framerate = framerate
+        self.audio_latency = audio_latency
+        self.observer_params = observer_params
+        self.no_response_rate = no_response_rate
+        self.crash_after = crash_after
+        self.early_press_rate = early_press_rate
+        self.realtime_factor = realtime_factor
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.rushing = False
+        self.wall_start = time.perf_counter()
+
+        #event logs
+        self.flips = [] #(virtual time, wall time, rush, flash drawn, trial index)
+        self.triggers = [] #(virtual time, wall time, value, trial index)
+        self.beeps = [] #(virtual play time, wall time)
+        self.trials = [] #(presented SOA in ms, key, rt)
+        self.keys = [] #hardware.keyboard queue: (virtual press time, key)
+        self._audio = None
+        self._visual = None
+        self._flash = False
+
+    #%% clock
+    def advance(self, dt):
+        self.now += dt
+        if self.realtime_factor:
+            deadline = self.wall_start + self.now / self.realtime_factor
+            while time.perf_counter() < deadline:
+                pass
+
+    def next_flip(self):
+        n = np.floor(self.now / self.frame_dur + 1e-9) + 1
+        self.advance(n * self.frame_dur - self.now)
+        self.flips.append((self.now, time.perf_counter(), self.rushing, self._flash, len(self.trials)))
+        if self._flash:
+            self._visual = self.now
+            self._flash = False
+        return self.now
+
+    #%% observer
+    def decide(self):
+        """Key and RT for the trial just presented; key is None for no response"""
+        if self.crash_after is not None and len(self.trials) >= self.crash_after:
+            raise SimCrash("simulated crash after " + str(len(self.trials)) + " trials")
+
+        SOA = (self._audio - self._visual) * 1000 if None not in (self._audio, self._visual) else 0
+        a, b, c = self.observer_params[0] if SOA <= 0 else self.observer_params[1]
+        sync = self.rng.random() < a / (1 + np.exp(-b * (SOA - c)))
+        rt = self.rng.uniform(0.3, 1.2)
+        self._audio = self._visual = None
+
+        if self.rng.random() < self.no_response_rate:
+            self.trials.append((SOA, None, None))
+            return None, None
+
+        #counterbalance as in the scripts (0: left=sync, 1: right=sync)
+        if int(self.subj) % 2 == 0:
+            key = 'left' if sync else 'right'
+        else:
+            key = 'right' if sync else 'left'
+        self.trials.append((SOA, key, rt))
+        return key, rt
+
+    def respond(self, maxWait):
+        """event.waitKeys: decide and wait for the response"""
+        key, rt = self.decide()
+        self.advance(maxWait if key is None else rt)
+        return key, rt
+
+    def press_keys(self):
+        """hardware.keyboard: queue the response to the trial just presented (and any early press)"""
+        visual = self._visual
+        key, rt = self.decide()
+        if visual is not None and self.rng.random() < self.early_press_rate:
+            self.keys.append((visual, self.rng.choice(['left', 'right'])))
+        if key is not None:
+            self.keys.append((self.now + rt, key))
+        self.keys.sort()
+
+
+#%% psychopy stand-ins
+def _modules(sim):
+    """Fake psychopy package bound to sim"""
+
+    prefs = types.SimpleNamespace(general={}, hardware={})
+
+    class Clock:
+        def __init__(self):
+            self._start = sim.now
+
+        def getTime(self):
+            return sim.now - self._start
+
+        def reset(self, newT=0.0):
+            self._start = sim.now + newT
+
+    def wait(secs, hogCPUperiod=0.2):
+        sim.advance(secs)
+
+    def rush(value=True, realtime=False):
+        sim.rushing = bool(value)
+        return True
+
+    def quit():
+        raise SystemExit(0)
+
+    core = types.SimpleNamespace(Clock=Clock, wait=wait, rush=rush, quit=quit,
+                                 getTime=lambda: sim.now, monotonicClock=Clock())
+
+    class Window:
+        def __init__(self, *args, **kwargs):
+            self.units = kwargs.get('units')
+            self.closed = False
+            self._toDraw = []
+            self._callOnFlip = []
+
+        def flip(self, clearBuffer=True):
+            t = sim.next_flip()
+            callbacks, self._callOnFlip = self._callOnFlip, []
+            for function, args, kwargs in callbacks:
+                function(*args, **kwargs)
+            return t
+
+        def callOnFlip(self, function, *args, **kwargs):
+            self._callOnFlip.append((function, args, kwargs))
+
+        def getActualFrameRate(self, nIdentical=10, nMaxFrames=100, nWarmUpFrames=10, threshold=1):
+            for _ in range(nWarmUpFrames + nIdentical):
+                self.flip()
+            return float(sim.framerate)
+
+        def close(self):
+            self.closed = True
+
+    class Stim:
+        def __init__(self, win, *args, **kwargs):
+            self.win = win
+            self.__dict__.update(kwargs)
+
+        def draw(self, win=None):
+            pass
+
+        def setText(self, text):
+            self.text = text
+
+    class RadialStim(Stim):
+        def draw(self, win=None):
+            sim._flash = True
+
+    class BufferImageStim(Stim):
+        #a capture of the stimuli it was built from; drawing it draws them (so a captured flash counts)
+        def __init__(self, win, stim=(), **kwargs):
+            Stim.__init__(self, win, **kwargs)
+            self.stim = list(stim)
+
+        def draw(self, win=None):
+            for stim in self.stim:
+                stim.draw()
+
+    visual = types.SimpleNamespace(Window=Window, TextStim=Stim, RadialStim=RadialStim,
+                                   ImageStim=Stim, BufferImageStim=BufferImageStim)
+
+    class Sound:
+        def __init__(self, value='A', secs=0.5, stop=-1, stereo=True, **kwargs):
+            self.value = value
+
+        def setVolume(self, volume):
+            self.volume = volume
+
+        def play(self, when=None, **kwargs):
+            sim.beeps.append((sim.now, time.perf_counter()))
+            sim._audio = sim.now + sim.audio_latency
+
+        def stop(self):
+            pass
+
+    sound = types.SimpleNamespace(Sound=Sound)
+
+    def waitKeys(maxWait=float('inf'), keyList=None, timeStamped=False, **kwargs):
+        if keyList is None or 'left' not in keyList:
+            #instruction, break and thank-you screens
+            sim.advance(0.5)
+            key, rt = 'space', 0.5
+        else:
+            key, rt = sim.respond(maxWait)
+            if key is None:
+                return None
+        if timeStamped:
+            return [[key, timeStamped.getTime()]]
+        return [key]
+
+    event = types.SimpleNamespace(waitKeys=waitKeys, getKeys=lambda *a, **k: [],
+                                  clearEvents=lambda *a, **k: None)
+
+    class Dlg:
+        def __init__(self, *args, **kwargs):
+            self.data = []
+            self.OK = True
+
+        def addField(self, label, initial='', **kwargs):
+            self.data.append(sim.subj if label.startswith('Subject') else
+                             sim.resume if label.startswith('Resume') else
+                             sim.adaptive if label.startswith('Adaptive') else initial)
+
+        def addText(self, text, **kwargs):
+            pass
+
+        def show(self):
+            return self.data
+
+    gui = types.SimpleNamespace(Dlg=Dlg)
+
+    class KeyPress:
+        def __init__(self, name, tDown, rt):
+            self.name, self.tDown, self.rt, self.duration = name, tDown, rt, None
+
+    class Keyboard:
+        def __init__(self, *args, **kwargs):
+            self.clock = Clock()
+
+        def getKeys(self, keyList=None, waitRelease=True, clear=True):
+            #the first poll after a stimulus is the observer's cue to respond
+            if sim._visual is not None or sim._audio is not None:
+                sim.press_keys()
+            keys = [(t, k) for t, k in sim.keys if t <= sim.now and (keyList is None or k in keyList)]
+            if clear:
+                sim.keys = [e for e in sim.keys if e not in keys]
+            return [KeyPress(k, t, t - self.clock._start) for t, k in keys]
+
+        def clearEvents(self, eventType=None):
+            sim.keys = [(t, k) for t, k in sim.keys if t > sim.now]
+
+    keyboard = types.SimpleNamespace(Keyboard=Keyboard, KeyPress=KeyPress)
+
+    def setData(value):
+        sim.triggers.append((sim.now, time.perf_counter(), value, len(sim.trials)))
+
+    parallel = types.SimpleNamespace(setPortAddress=lambda address: None, setData=setData)
+
+    logging = types.SimpleNamespace(warning=lambda *a: None, info=lambda *a: None,
+                                    flush=lambda: None, defaultClock=Clock())
+
+    psychopy = types.ModuleType('psychopy')
+    modules = {'psychopy': psychopy}
+    for name, value in [('prefs', prefs), ('core', core), ('visual', visual), ('sound', sound),
+                        ('event', event), ('gui', gui), ('parallel', parallel), ('logging', logging),
+                        ('hardware', types.SimpleNamespace()), ('hardware.keyboard', keyboard)]:
+        module = types.ModuleType('psychopy.' + name)
+        module.__dict__.update(vars(value))
+        parent, _, attr = ('psychopy.' + name).rpartition('.')
+        setattr(modules[parent], attr, module)
+        modules['psychopy.' + name] = module
+    return modules
+
+
+@contextlib.contextmanager
+def installed(sim):
+    """Temporarily replace psychopy in sys.modules with the simulated backend"""
+    saved = {k: v for k, v in sys.modules.items() if k == 'psychopy' or k.startswith('psychopy.')}
+    for k in saved:
+        del sys.modules[k]
+    sys.modules.update(_modules(sim))
+    try:
+        yield sim
+    finally:
+        for k in [k for k in sys.modules if k == 'psychopy' or k.startswith('psychopy.')]:
+            del sys.modules[k]
+        sys.modules.update(saved)
+
+
+def make_wd(wd):
+    """Create the data folders the scripts expect under wd"""
+    for folder in DATA_FOLDERS:
+        os.makedirs(os.path.join(wd, 'data', folder), exist_ok=True)
+
+
+@contextlib.contextmanager
+def tracked_loggers():
+    """Yield a list collecting every msi_logger.TrialLogger (and SessionJournal) opened meanwhile"""
+    import msi_logger
+    loggers = []
+    init = msi_logger.TrialLogger.__init__
+
+    def tracking_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        loggers.append(self)
+    msi_logger.TrialLogger.__init__ = tracking_init
+    try:
+        yield loggers
+    finally:
+        msi_logger.TrialLogger.__init__ = init
+
+
+def run_session(script, subj='2', wd='.', **kwargs):
+    """Run msi_a.py or msi_b.py against the simulated backend inside wd.
+
+    kwargs go to Simulation. Returns the Simulation; sim.exit holds the SystemExit
+    code/message if the script exited and sim.error a SimCrash if one was raised.
+    A SimCrash kills the session's loggers like process death would: their writer
+    threads stop and rows they had not flushed are lost."""
+    sim = Simulation(subj=subj, **kwargs)
+    sim.exit = sim.error = None
+    make_wd(wd)
+
+    script = os.path.join(HERE, script)
+    cwd = os.getcwd()
+    sys.path.insert(0, HERE)
+    os.chdir(wd)
+    try:
+        with installed(sim), tracked_loggers() as loggers:
+            try:
+                runpy.run_path(script, run_name='__main__')
+            except SimCrash:
+                for logger in loggers:
+                    logger.abandon()
+                raise
+    except SystemExit as e:
+        sim.exit = e.code
+    except SimCrash as e:
+        sim.error = e
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(HERE)
+    return sim
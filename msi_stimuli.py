@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# msi stimulus cache
+# Every screen msi_a.py and msi_b.py show is built once before the first trial and
+# captured into a psychopy BufferImageStim, a single texture drawn with one call:
+# fixation, flash + fixation, the response prompt (question and counterbalanced key
+# labels), the block break, the instructions and the thank-you screen. The trial loop
+# then draws exactly one texture per frame and no TextStim is laid out or uploaded
+# during the session. The screens are captured full-window (the background is the
+# window's black), with interpolation off so they match the live stimuli pixel for pixel.
+
+from collections import namedtuple
+
+INSTRUCTIONS = {0: u"""You will hear a beep and see a flash. When prompted, please use the left and right arrow keys to report whether they occur simultaneously or not. Press any key to begin.
+                                                        ← = YES              → = NO""",
+                1: u"""You will hear a beep and see a flash. When prompted, please use the left and right arrow keys to report whether they occur simultaneously or not. Press any key to begin.
+                                                        ← = NO              → = YES"""} #by counterbalance (0: left=sync, 1: right=sync)
+KEY_LABELS = {0: "   YES                              NO   ",
+              1: "   NO                              YES   "}
+BREAK_TEXT = """                Break           
+                                                            Press any key to continue"""
+PROMPT_TEXT = "Simultaneous?"
+THANK_YOU_TEXT = "Thanks for participating!"
+
+Screens = namedtuple('Screens', ['fixation', 'flash', 'prompt', 'block_break', 'instructions', 'thank_you'])
+
+
+def build_screens(win, cb):
+    """Pre-render every screen for counterbalance cb; returns Screens of BufferImageStims"""
+    from psychopy import visual #at call time, so the simulated backend can stand in
+
+    #flash: diameter 4cm = 3.8 degrees of visual angle at 60 cm
+    flash = visual.RadialStim(win, size = 0.15, radialCycles = 1, radialPhase = 1/2,
+                              angularPhase = 1/4, angularCycles = 1/2)
+    fixation = visual.TextStim(win, text = "+", color = "white", height = 0.06)
+    prompt = visual.TextStim(win, text = PROMPT_TEXT, height = 0.073, pos = (0, 0.15))
+    key_prompt = visual.TextStim(win, text = KEY_LABELS[cb], height = 0.073, pos = (0, -0.3))
+    block_break = visual.TextStim(win, text = BREAK_TEXT, height = 0.075)
+    instructions = visual.TextStim(win, text = INSTRUCTIONS[cb], height = 0.075, pos = (0,0))
+    thank_you = visual.TextStim(win, text = THANK_YOU_TEXT, height = 0.06)
+
+    def capture(*stims):
+        return visual.BufferImageStim(win, stim = list(stims), interpolate = False)
+
+    return Screens(fixation = capture(fixation), flash = capture(flash, fixation),
+                   prompt = capture(prompt, key_prompt), block_break = capture(block_break),
+                   instructions = capture(instructions), thank_you = capture(thank_you))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# msi result store
+# Collects every subject's msi_a/msi_b trials, SOA file and TBW fit parameters into
+# three Parquet tables under data/store, with compact dtypes (categorical conditions
+# and responses, int8 blocks, float32 RTs) and plain numeric fit columns, so one
+# subject or the whole cohort loads in milliseconds without unpickling anything.
+# The per-subject CSVs stay the acquisition format (they are what the journal and
+# atomic saves protect); the store is rebuilt from them with
+#
+#     python msi_store.py [--wd DIR]
+#
+# and is refreshed by TBW_fitting.py --all. Needs pyarrow.
+#
+# For analysis, cohort() and aggregates() refresh the store only when a source file
+# was added, removed or modified since the last build (mtimes are kept in
+# data/store/sources.csv), so repeated queries never re-parse the CSVs. aggregates()
+# returns per subject x condition sync rate, no-response rate and RT statistics,
+# computed once per build and cached next to the tables.
+
+import os, glob, re, argparse, time
+import numpy as np
+import pandas as pd
+
+STORE_DIR = 'data' + os.sep + 'store'
+TABLES = ['trials', 'soas', 'fits', 'aggregates']
+KEYS = {'trials': ['subj', 'part', 'block', 'trial'], 'soas': ['subj'], 'fits': ['subj', 'side'],
+        'aggregates': ['subj', 'part', 'condition']}
+SOURCES_FILENAME = os.path.join(STORE_DIR, 'sources.csv')
+
+MSI_B_CONDITIONS = ['ASOA95r', 'ASOA50r', 'A10', 'V10', 'VSOA50r', 'VSOA95r']
+MSI_B_FIXED_SOAS = {'A10': -10, 'V10': 10} #ms; the others come from the SOA file
+FIT_COLUMNS = ['a', 'b', 'c', 'cost', 'nfev', 'success']
+
+
+def store_path(table):
+    return os.path.join(STORE_DIR, table + '.parquet')
+
+
+def _source_files():
+    """Every file the store is built from"""
+    patterns = [os.path.join('data', 'msi_a', 'msi_a_sub*.csv'), os.path.join('data', 'msi_b', 'msi_b_sub*.csv'),
+                os.path.join('data', 'SOAs', 'msi_a_sub*_SOAs.csv'),
+                os.path.join('data', 'fit_results', 'msi_a_sub*_fit.csv')]
+    return sorted(f for pattern in patterns for f in glob.glob(pattern))
+
+
+def _sources():
+    files = _source_files()
+    return pd.DataFrame({'filename': files, 'mtime': [os.path.getmtime(f) for f in files]})
+
+
+def is_stale():
+    """True if a source file was added, removed or modified since the last build"""
+    if not all(os.path.isfile(store_path(t)) for t in ['trials', 'aggregates']) or not os.path.isfile(SOURCES_FILENAME):
+        return True
+    built = pd.read_csv(SOURCES_FILENAME)
+    current = _sources()
+    return (len(built) != len(current) or not (built.filename == current.filename).all()
+            or not np.allclose(built.mtime, current.mtime, rtol=0, atol=1e-3))
+
+
+def _subject_files(part, suffix='.csv'):
+    """{subj: filename} for every data/<part>/<part>_sub<N>.csv"""
+    files = {}
+    for f in glob.glob(os.path.join('data', part, part + '_sub*' + suffix)):
+        m = re.match(part + r'_sub(\d+)' + re.escape(suffix) + '$', os.path.basename(f))
+        if m:
+            files[int(m.group(1))] = f
+    return files
+
+
+#%% conversion to compact frames
+def trial_frame(df, part, soas=None):
+    """Compact trials table from one msi_a/msi_b response dataframe.
+
+    soas is the subject's SOA file (msi_b only), used to give every condition its SOA in ms."""
+    out = pd.DataFrame({'subj': df.subj.astype('int16'),
+                        'part': pd.Categorical([part[-1]]*len(df), categories=['a', 'b']),
+                        'block': df.block.astype('int8'),
+                        'trial': df.trial.astype('int16')})
+    if part == 'msi_a':
+        out['condition'] = pd.Categorical(df.SOA.astype(int).astype(str))
+        out['SOA_ms'] = df.SOA.astype('float32')
+    else:
+        out['condition'] = pd.Categorical(df.SOA, categories=MSI_B_CONDITIONS)
+        lookup = dict(MSI_B_FIXED_SOAS)
+        if soas is not None:
+            lookup.update((k, soas[k].iloc[0]) for k in MSI_B_CONDITIONS if k in soas)
+        out['SOA_ms'] = df.SOA.map(lookup).astype('float32')
+    out['resp'] = pd.Categorical(df.resp, categories=['left', 'right']) #'NaN' (no response) -> missing
+    out['resp_recode'] = pd.Categorical(df.resp_recode, categories=['sync', 'async'])
+    out['rt'] = pd.to_numeric(df.rt, errors='coerce').astype('float32')
+    return out
+
+
+def _condition_key(condition):
+    #msi_a SOAs in numeric order, then msi_b conditions from A-first to V-first
+    if condition in MSI_B_CONDITIONS:
+        return (1, MSI_B_CONDITIONS.index(condition))
+    return (0, int(condition))
+
+
+def fit_rows(l_result, r_result, model='sigmoid'):
+    """Plain numeric fit parameters from lmfit MinimizerResults or tbw_fit FitResults, one row per side"""
+    rows = []
+    for side, result in [('left', l_result), ('right', r_result)]:
+        if hasattr(result, 'chisqr'): #lmfit
+            row = [result.params[k].value for k in 'abc'] + [0.5 * result.chisqr, result.nfev, result.success]
+        else:
+            row = list(np.asarray(result.params, dtype=float)) + [float(result.cost), int(result.nfev), bool(result.success)]
+        rows.append([side, model] + row)
+    df = pd.DataFrame(rows, columns=['side', 'model'] + FIT_COLUMNS)
+    return df.astype({'nfev': 'int32', 'success': bool})
+
+
+def aggregate(trials):
+    """Per subject x condition trial counts, sync and no-response rates and RT statistics"""
+    trials = trials.assign(sync=(trials.resp_recode == 'sync').astype('float32'),
+                           responded=trials.resp_recode.notna().astype('float32'))
+    g = trials.groupby(['subj', 'part', 'condition'], observed=True)
+    out = g.agg(n=('responded', 'size'), n_responses=('responded', 'sum'), n_sync=('sync', 'sum'),
+                SOA_ms=('SOA_ms', 'first'), rt_mean=('rt', 'mean'), rt_median=('rt', 'median'),
+                rt_sd=('rt', 'std'))
+    out['sync_rate'] = (out.n_sync / out.n_responses).astype('float32')
+    out['no_response_rate'] = (1 - out.n_responses / out.n).astype('float32')
+    return out.astype({'n': 'int16', 'n_responses': 'int16', 'n_sync': 'int16'}).reset_index()
+
+
+#%% build and load
+def build():
+    """Rebuild every table from the files under data/ (run from the experiment directory).
+
+    Returns {table: number of rows}."""
+    sources = _sources()
+    soa_files = {}
+    for f in glob.glob(os.path.join('data', 'SOAs', 'msi_a_sub*_SOAs.csv')):
+        m = re.match(r'msi_a_sub(\d+)_SOAs\.csv$', os.path.basename(f))
+        if m:
+            soa_files[int(m.group(1))] = pd.read_csv(f, index_col=0)
+
+    trials = []
+    for part in ['msi_a', 'msi_b']:
+        for subj, f in sorted(_subject_files(part).items()):
+            trials.append(trial_frame(pd.read_csv(f), part, soa_files.get(subj)))
+
+    soas = []
+    for subj, SOA_out in sorted(soa_files.items()):
+        SOA_out = SOA_out.reset_index(drop=True)
+        SOA_out.insert(0, 'subj', subj)
+        soas.append(SOA_out)
+
+    fits = []
+    for f in sorted(glob.glob(os.path.join('data', 'fit_results', 'msi_a_sub*_fit.csv'))):
+        m = re.match(r'msi_a_sub(\d+)_fit\.csv$', os.path.basename(f))
+        if m:
+            fit = pd.read_csv(f)
+            fit.insert(0, 'subj', int(m.group(1)))
+            fits.append(fit)
+
+    if trials:
+        #concatenate without passing through object dtype
+        conditions = pd.api.types.union_categoricals([t.condition for t in trials], ignore_order=True)
+        conditions = conditions.reorder_categories(sorted(conditions.categories, key=_condition_key))
+        trials = [pd.concat(trials, ignore_index=True).assign(condition=conditions)]
+
+    frames = {'trials': trials, 'soas': soas, 'fits': fits}
+    frames['aggregates'] = [aggregate(trials[0])] if trials else []
+    os.makedirs(STORE_DIR, exist_ok=True)
+    counts = {}
+    for table in TABLES:
+        if not frames[table]:
+            continue
+        df = pd.concat(frames[table], ignore_index=True)
+        df['subj'] = df.subj.astype('int16')
+        for column in ['side', 'model']:
+            if column in df:
+                df[column] = df[column].astype('category')
+        df = df.sort_values(KEYS[table], kind='stable').reset_index(drop=True)
+        if table != 'fits': #fit parameters keep full precision
+            df = df.astype({k: 'float32' for k in df.select_dtypes('float64').columns})
+
+        #write atomically so a loader never sees a half-written table
+        tmp = store_path(table) + '.tmp'
+        df.to_parquet(tmp, index=False, row_group_size=64 * 1024)
+        os.replace(tmp, store_path(table))
+        counts[table] = len(df)
+
+    #recorded last: a build that dies part-way leaves the store stale
+    sources.to_csv(SOURCES_FILENAME, index=False)
+    return counts
+
+
+def refresh():
+    """Rebuild the store if any source file changed. Returns True if it was rebuilt."""
+    if is_stale():
+        build()
+        return True
+    return False
+
+
+def load(table, subj=None, part=None):
+    """One table, for one subject (or all), indexed by its keys. part ('a'/'b') filters trials."""
+    filters = []
+    if subj is not None:
+        filters.append(('subj', '==', int(subj)))
+    if part is not None:
+        filters.append(('part', '==', part))
+    df = pd.read_parquet(store_path(table), filters=filters or None)
+    return df.set_index(KEYS[table])
+
+
+def cohort(part='b', subj=None):
+    """All trials of one part ('a' or 'b') indexed by subject x condition, refreshing the store first"""
+    refresh()
+    df = load('trials', subj=subj, part=part).reset_index()
+    df['condition'] = df.condition.cat.remove_unused_categories()
+    return df.set_index(['subj', 'condition']).sort_index()
+
+
+def aggregates(part=None, subj=None):
+    """Cached per subject x condition summaries (see aggregate), refreshing the store first"""
+    refresh()
+    return load('aggregates', subj=subj, part=part)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild the Parquet result store from the per-subject files')
+    parser.add_argument('--wd', default='.', help='experiment directory containing data/')
+    args = parser.parse_args(argv)
+    os.chdir(args.wd)
+
+    start = time.perf_counter()
+    counts = build()
+    print("Built " + ", ".join(k + ": " + str(v) + " rows" for k, v in counts.items())
+          + " in %.2f s" % (time.perf_counter() - start))
+    for table in counts:
+        start = time.perf_counter()
+        load(table)
+        print("load('" + table + "'): %.1f ms" % (1e3 * (time.perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# msi frame timing
+# Records every flip timestamp in each trial's critical window (fixation -> flash/beep
+# -> post-stimulus) into a memory-mapped .npy file next to the subject's CSV, with
+# dropped-frame counts and achieved vs requested SOA per trial.
+# Load afterwards with np.load(filename) or summarise(np.load(filename)).
+
+import os
+import numpy as np
+import pandas as pd
+
+MAX_FLIPS = 64 #flips recorded per trial, enough for a 600 ms SOA at 100 Hz
+
+TIMING_DTYPE = np.dtype([('block', 'i1'), ('trial', 'i2'),
+                         ('requested_SOA', 'f4'), ('achieved_SOA', 'f4'),
+                         ('audio_time', 'f8'), ('visual_time', 'f8'),
+                         ('n_flips', 'i2'), ('n_dropped', 'i2'), ('max_interval', 'f4'),
+                         ('flips', 'f8', (MAX_FLIPS,))])
+
+
+class FrameTimer:
+    """Per-trial flip timestamps written straight to a memmapped structured array.
+
+    Usage inside the trial loop:
+        timer.start_trial(index, block, trial, requested_SOA)
+        timer.flip(win.flip())                 # any flip in the critical window
+        win.callOnFlip(timer.audio)            # with the beep's on-flip play()
+        timer.flip(win.flip(), visual=True)    # the flip that shows the flash
+        timer.end_trial()                      # after core.rush(False)
+
+    clock must be the clock win.flip() timestamps come from (psychopy.core.getTime).
+    audio_latency (s) is added to the play() call time to estimate the sound onset, as in
+    the msi_audio latency model."""
+
+    def __init__(self, filename, n_trials, clock, frame_dur=0.01, audio_latency=0.02, resume=False):
+        self.filename = filename
+        self.clock = clock
+        self.frame_dur = frame_dur
+        self.audio_latency = audio_latency
+        if resume and os.path.isfile(filename):
+            self.data = np.lib.format.open_memmap(filename, mode='r+')
+        else:
+            self.data = np.lib.format.open_memmap(filename, mode='w+', dtype=TIMING_DTYPE, shape=(n_trials,))
+            self.data['flips'] = np.nan
+            self.data['requested_SOA'] = np.nan
+        self._flips = np.full(MAX_FLIPS, np.nan)
+
+    def start_trial(self, index, block, trial, requested_SOA):
+        self._index = index
+        self._row = (block, trial, requested_SOA)
+        self._n = 0
+        self._audio = np.nan
+        self._visual = np.nan
+        self._flips[:] = np.nan
+
+    def flip(self, t, visual=False):
+        if self._n < MAX_FLIPS:
+            self._flips[self._n] = t
+        self._n += 1
+        if visual:
+            self._visual = t
+
+    def audio(self):
+        self._audio = self.clock() + self.audio_latency
+
+    def end_trial(self):
+        n = min(self._n, MAX_FLIPS)
+        intervals = np.diff(self._flips[:n])
+        row = self.data[self._index]
+        row['block'], row['trial'], row['requested_SOA'] = self._row
+        row['achieved_SOA'] = (self._audio - self._visual) * 1000 #negative = auditory first, as in SOA
+        row['audio_time'] = self._audio
+        row['visual_time'] = self._visual
+        row['n_flips'] = self._n
+        row['n_dropped'] = np.sum(np.round(intervals / self.frame_dur) - 1, where=intervals > 1.5 * self.frame_dur)
+        row['max_interval'] = intervals.max() if n > 1 else np.nan
+        row['flips'] = self._flips
+
+    def close(self):
+        self.data.flush()
+        summary = summarise(self.data, self.frame_dur)
+        summary.to_csv(os.path.splitext(self.filename)[0] + '_summary.csv', index=False)
+        del self.data
+        return summary
+
+
+def bad_trials(data, frame_dur=0.01):
+    """Boolean mask of trials with a dropped frame or an SOA off by half a frame or more"""
+    error = np.abs(data['achieved_SOA'] - data['requested_SOA'])
+    return (data['n_dropped'] > 0) | ~(error < frame_dur * 500)
+
+
+def summarise(data, frame_dur=0.01):
+    """One-row session summary of a timing array; bad_trials lists each bad trial as block:trial,
+    the block and trial columns of the subject's data file"""
+    done = data[~np.isnan(data['requested_SOA'])]
+    error = done['achieved_SOA'] - done['requested_SOA']
+    bad = bad_trials(done, frame_dur)
+    named = ['%d:%d' % (block, trial) for block, trial in zip(done['block'][bad], done['trial'][bad])]
+    return pd.DataFrame({'n_trials': [len(done)],
+                         'n_dropped_frames': [int(done['n_dropped'].sum())],
+                         'n_bad_trials': [int(bad.sum())],
+                         'bad_trials': [' '.join(named)],
+                         'max_interval_ms': [np.nanmax(done['max_interval'], initial=np.nan) * 1000],
+                         'mean_SOA_error_ms': [np.nanmean(error) if len(done) else np.nan],
+                         'max_abs_SOA_error_ms': [np.nanmax(np.abs(error), initial=np.nan)]})
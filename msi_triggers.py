@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# msi EEG triggers
+# Sends parallel-port triggers from the window's on-flip callbacks, so a trigger goes
+# out straight after the buffer swap of the frame it marks instead of whenever Python
+# gets back from win.flip(). Every set/clear is logged with its intended time (the
+# predicted flip) and actual time into a memmapped .npy next to the subject's CSV,
+# with the run it was sent in (0, then one more each time a crashed session is resumed,
+# since the clock of a resumed run starts again from 0).
+
+import os
+import numpy as np
+
+TRIGGER_DTYPE = np.dtype([('trial', 'i2'), ('run', 'i1'), ('value', 'i2'),
+                          ('intended', 'f8'), ('actual', 'f8')])
+
+
+class MockPort:
+    """Records setData calls instead of driving a port (for testing)"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.log = []
+
+    def setData(self, value):
+        self.log.append((self.clock(), value))
+
+
+class TriggerScheduler:
+    """Flip-locked trigger output with a log of intended vs actual times.
+
+    set_data is psychopy.parallel.setData (or MockPort.setData); clock is the same
+    clock as msi_timing.FrameTimer's."""
+
+    def __init__(self, filename, max_events, set_data, clock, frame_dur=0.01, resume=False):
+        self.filename = filename
+        self.set_data = set_data
+        self.clock = clock
+        self.frame_dur = frame_dur
+        self.trial = -1
+        if resume and os.path.isfile(filename):
+            self.events = np.lib.format.open_memmap(filename, mode='r+')
+            self.n = int(np.sum(self.events['trial'] >= 0))
+            self.run = int(self.events['run'][:self.n].max()) + 1 if self.n else 0
+        else:
+            self.events = np.lib.format.open_memmap(filename, mode='w+', dtype=TRIGGER_DTYPE, shape=(max_events,))
+            self.events['trial'] = -1
+            self.events['intended'] = np.nan
+            self.events['actual'] = np.nan
+            self.n = 0
+            self.run = 0
+
+    def start_trial(self, index):
+        self.trial = index
+
+    def on_flip(self, win, value, last_flip=None):
+        """Send value from win's callOnFlip, i.e. right after the next flip.
+
+        last_flip is the time of an earlier flip, used to log the intended time: the first
+        flip on its frame grid after now (one frame after it if called straight after it)."""
+        if last_flip is None:
+            intended = np.nan
+        else:
+            frames = np.floor((self.clock() - last_flip) / self.frame_dur + 1e-9) + 1
+            intended = last_flip + max(frames, 1) * self.frame_dur
+        win.callOnFlip(self._fire, value, intended)
+
+    def _fire(self, value, intended):
+        self.set_data(value)
+        actual = self.clock()
+        if self.n < len(self.events):
+            self.events[self.n] = (self.trial, self.run, value, intended, actual)
+            self.n += 1
+
+    def close(self):
+        self.events.flush()
+        events = self.events[:self.n].copy()
+        del self.events
+        return events
+
+
+def load_triggers(filename):
+    """Logged trigger events from a session's _triggers.npy (unused rows dropped)"""
+    events = np.load(filename)
+    return events[events['trial'] >= 0]
+
+
+def trigger_latency(events):
+    """Actual minus intended time (s) for every flip-locked event"""
+    events = events[~np.isnan(events['intended'])]
+    return events['actual'] - events['intended']
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Batched fitting of the TBW sigmoids
+
+Levenberg-Marquardt with the analytic Jacobian from tbw_models, run on stacked
+NumPy arrays so many (subject x side) problems converge together instead of one
+lmfit Minimizer call each. Besides least squares on the synchrony rates there is
+a binomial maximum-likelihood fit on the sync/total counts (damped Fisher scoring),
+and a hierarchical version of it with empirical-Bayes group priors on each
+side's parameters, estimated from and applied to the whole cohort at once.
+compare_models fits every candidate model by maximum likelihood, one batch per
+model for the whole cohort, and ranks them per subject by AIC or BIC.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from tbw_models import MODELS, fixed_params, n_free
+
+#starting values for each side of the TBW
+START_PARAMS = {'left': {'a': 1, 'b': 0.01, 'c': -150},
+                'right': {'a': 1, 'b': -0.01, 'c': 150}}
+
+#smallest group prior sd on (a, log|b|, c) for the hierarchical fit
+PRIOR_MIN_SD = np.array([0.02, 0.05, 5.0])
+
+PROB_EPS = 1e-6 #model rates are clipped to [PROB_EPS, 1 - PROB_EPS] in the likelihood
+
+#grid searched for starting values with init='grid' (joint and binomial fits); b and c take each side's sign
+START_GRID = {'a': np.linspace(0.5, 1, 6),
+              'b': np.logspace(-3, -0.5, 12),
+              'c': np.arange(0, 401, 20)}
+
+#candidate one-sided models for compare_models; the first is the reference model, kept unless another
+#beats its AIC/BIC by more than SELECT_MARGIN ("strong" evidence: the models mostly differ in the
+#tails the 95% SOAs are read off, and choosing between them on weak evidence makes those SOAs worse).
+#sigmoid1 is not a candidate: fixing a at 1 saves more BIC than the margin, so it was picked for about
+#a fifth of observers with a lower asymptote, whose SOAs it then put 80-120 ms off
+COMPARE_MODELS = ['sigmoid', 'gaussian', 'weibull', 'gumbel']
+SELECT_MARGIN = 6.0
+
+FitResult = namedtuple('FitResult', ['params', 'cost', 'nfev', 'success'])
+
+
+def start_params(side, model='sigmoid'):
+    if model == 'joint':
+        left, right = start_params('left'), start_params('right')
+        return np.r_[left, right[1:]]
+    return np.array([START_PARAMS[side][k] for k in MODELS[model].param_names], dtype=float)
+
+
+def start_grid(side, model='sigmoid'):
+    """START_GRID as (n_a, n_bc, 3) parameter sets of a one-sided model for one side"""
+    sign = 1 if side == 'left' else -1
+    a, b, c = np.meshgrid(START_GRID['a'], sign * START_GRID['b'], -sign * START_GRID['c'], indexing='ij')
+    fixed, values = fixed_params(model)
+    grid = np.where(fixed, values, np.stack([a, b, c], axis=-1))
+    return grid.reshape(len(START_GRID['a']), -1, 3)
+
+
+def _grid_sse(x, y, side, model='sigmoid', n=None):
+    """Sum of squared errors of every start_grid point for every problem, shape (..., n_a, n_bc).
+
+    With n (responses per point), the binomial negative log-likelihood of rates y instead."""
+    grid = start_grid(side, model)
+    w = np.isfinite(x) & np.isfinite(y)
+    if n is not None:
+        w &= np.isfinite(n) & (n > 0)
+        n = np.where(w, n, 0)[..., np.newaxis, np.newaxis, :]
+    x, y = np.where(w, x, 0), np.where(w, y, 0)
+    with np.errstate(over='ignore'):
+        rate = MODELS[model].forward(x[..., np.newaxis, np.newaxis, :], grid)
+    y = y[..., np.newaxis, np.newaxis, :]
+    if n is None:
+        r = ((rate - y) * w[..., np.newaxis, np.newaxis, :]) ** 2
+    else:
+        mu = np.clip(rate, PROB_EPS, 1 - PROB_EPS)
+        r = -n * (y * np.log(mu) + (1 - y) * np.log(1 - mu))
+    return np.sum(r, axis=-1), grid
+
+
+def grid_start(x, y, side, model='sigmoid', n=None):
+    """Best start_grid point of one side for every row of x/y (NaN = missing), shape (..., 3).
+
+    Best is the smallest squared error, or with n (responses per point) the largest binomial
+    likelihood, which keeps likelihood fits away from starts on their flat step-function ridge."""
+    sse, grid = _grid_sse(np.asarray(x, dtype=float), np.asarray(y, dtype=float), side, model,
+                          None if n is None else np.asarray(n, dtype=float))
+    flat = sse.reshape(sse.shape[:-2] + (-1,))
+    return grid.reshape(-1, 3)[np.argmin(flat, axis=-1)]
+
+
+def joint_grid_start(x_left, y_left, x_right, y_right):
+    """Best joint-model start for every problem: for each shared a, the best left and right
+    (b, c) from start_grid, then the best a. Shape (..., 5)."""
+    sse_l, grid_l = _grid_sse(np.asarray(x_left, dtype=float), np.asarray(y_left, dtype=float), 'left')
+    sse_r, grid_r = _grid_sse(np.asarray(x_right, dtype=float), np.asarray(y_right, dtype=float), 'right')
+    best_l, best_r = np.argmin(sse_l, axis=-1), np.argmin(sse_r, axis=-1) #(..., n_a)
+    total = np.take_along_axis(sse_l, best_l[..., np.newaxis], -1)[..., 0] + \
+            np.take_along_axis(sse_r, best_r[..., np.newaxis], -1)[..., 0]
+    i_a = np.argmin(total, axis=-1)[..., np.newaxis]
+    left = grid_l[i_a, np.take_along_axis(best_l, i_a, -1)][..., 0, :]
+    right = grid_r[i_a, np.take_along_axis(best_r, i_a, -1)][..., 0, :]
+    return np.concatenate([left, right[..., 1:]], axis=-1)
+
+
+def side_data(df_rate, side):
+    """SOAs and synchrony rates for the left (SOA <= 0) or right (SOA >= 0) side"""
+    if side == 'left':
+        mask = df_rate.SOA <= 0
+    else:
+        mask = df_rate.SOA >= 0
+    return df_rate.SOA[mask].values, df_rate.sync_rate[mask].values
+
+
+def side_counts(df_rate, side):
+    """SOAs, sync counts and response counts for the left (SOA <= 0) or right (SOA >= 0) side"""
+    if side == 'left':
+        mask = df_rate.SOA <= 0
+    else:
+        mask = df_rate.SOA >= 0
+    return df_rate.SOA[mask].values, df_rate.sync[mask].values, df_rate.total[mask].values
+
+
+def stack(xs, ys):
+    """Pad a list of ragged (x, y) problems into (n_problems, n_max) arrays; padding is NaN"""
+    n = max(len(x) for x in xs)
+    x_out = np.full((len(xs), n), np.nan)
+    y_out = np.full((len(xs), n), np.nan)
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        x_out[i, :len(x)] = x
+        y_out[i, :len(y)] = y
+    return x_out, y_out
+
+
+#%% Levenberg-Marquardt
+def _solve(A, g):
+    """Batched solve of A step = g; falls back to the pseudo-inverse if any problem is singular"""
+    try:
+        return np.linalg.solve(A, g[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('...ij,...j->...i', np.linalg.pinv(A), g)
+
+
+def least_squares(x, y, p0, model='sigmoid', max_iter=200, tol=1e-10):
+    """Fit model to every row of x/y at once.
+
+    x, y: arrays of shape (..., n); NaNs mark missing points.
+    p0: starting values, broadcastable to (..., n_params); the model's fixed parameters are
+    set to their values and not moved.
+    Returns a FitResult of arrays with the problems' leading shape."""
+    m = MODELS[model]
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    w = (np.isfinite(x) & np.isfinite(y)).astype(float)
+    x = np.where(w > 0, x, 0)
+    y = np.where(w > 0, y, 0)
+
+    fixed, values = fixed_params(model)
+    p = np.array(np.broadcast_to(p0, x.shape[:-1] + (len(m.param_names),)), dtype=float)
+    p = np.where(fixed, values, p)
+    eye = np.eye(p.shape[-1])
+
+    def residuals(p):
+        with np.errstate(over='ignore'):
+            return (m.forward(x, p) - y) * w
+
+    r = residuals(p)
+    cost = 0.5 * np.sum(r ** 2, axis=-1)
+    lam = np.full(cost.shape, 1e-3)
+    done = np.zeros(cost.shape, dtype=bool)
+    nfev = np.ones(cost.shape, dtype=int)
+
+    for _ in range(max_iter):
+        with np.errstate(over='ignore'):
+            J = m.jacobian(x, p) * w[..., np.newaxis] * ~fixed
+        JTJ = np.einsum('...ni,...nj->...ij', J, J) + eye * fixed
+        g = np.einsum('...ni,...n->...i', J, r)
+
+        #Marquardt scaling keeps b (~0.01) and c (~100) on an equal footing
+        D = np.maximum(np.diagonal(JTJ, axis1=-2, axis2=-1), 1e-12)
+        A = JTJ + lam[..., np.newaxis, np.newaxis] * D[..., np.newaxis, :] * eye
+        step = -_solve(A, g)
+        step[done] = 0
+
+        p_new = p + step
+        r_new = residuals(p_new)
+        cost_new = 0.5 * np.sum(r_new ** 2, axis=-1)
+        nfev += ~done
+
+        better = (cost_new < cost) & np.isfinite(cost_new) & ~done
+        converged = better & ((cost - cost_new) <= tol * np.maximum(cost, tol))
+        converged |= np.all(np.abs(step) <= tol * (np.abs(p) + tol), axis=-1)
+
+        p = np.where(better[..., np.newaxis], p_new, p)
+        r = np.where(better[..., np.newaxis], r_new, r)
+        cost = np.where(better, cost_new, cost)
+        lam = np.where(better, lam * 0.3, lam * 10)
+
+        #stalled: no step can reduce the cost any further
+        converged |= lam > 1e12
+        done |= converged
+        if done.all():
+            break
+
+    return FitResult(p, cost, nfev, done)
+
+
+def fit_tbw(df_rates, model='sigmoid', **kwargs):
+    """Fit left and right sides for a list of synchrony-rate dataframes in one batch, from START_PARAMS.
+
+    Returns (left, right) FitResults whose params have shape (n_subjects, n_params)."""
+    results = []
+    for side in ['left', 'right']:
+        xs, ys = zip(*[side_data(df_rate, side) for df_rate in df_rates])
+        x, y = stack(xs, ys)
+        results.append(least_squares(x, y, start_params(side, model), model=model, **kwargs))
+    return tuple(results)
+
+
+def fit_joint(df_rates, init='grid', **kwargs):
+    """Fit the joint two-sided model (shared peak) for a list of synchrony-rate dataframes in one batch.
+
+    Every SOA is used once (SOA = 0 by the left half). Returns a FitResult whose params
+    have shape (n_subjects, 5); tbw_models.joint_sides splits them into left and right."""
+    x, y = stack([df_rate.SOA.values for df_rate in df_rates], [df_rate.sync_rate.values for df_rate in df_rates])
+    if init == 'grid':
+        x_left, y_left = np.where(x <= 0, x, np.nan), np.where(x <= 0, y, np.nan)
+        x_right, y_right = np.where(x >= 0, x, np.nan), np.where(x >= 0, y, np.nan)
+        p0 = joint_grid_start(x_left, y_left, x_right, y_right)
+    else:
+        p0 = start_params(None, 'joint')
+    return least_squares(x, y, p0, model='joint', **kwargs)
+
+
+#%% binomial maximum likelihood
+def _prior_transform(p, model='sigmoid'):
+    """Parameters on the scale the group prior is Gaussian on (log|b| for slopes) and the derivative"""
+    slope = np.array([name.startswith('b') for name in MODELS[model].param_names])
+    with np.errstate(divide='ignore'):
+        t = np.where(slope, np.log(np.abs(p)), p)
+        dt = np.where(slope, 1 / p, 1.0)
+    return t, dt
+
+
+def binomial_ml(x, k, n, p0, model='sigmoid', prior=None, max_iter=200, tol=1e-10):
+    """Maximum-likelihood fit of model to sync counts k out of n at every row of x at once.
+
+    x, k, n: arrays of shape (..., n_points); NaNs (or n = 0) mark missing points.
+    prior: optional (mean, sd) of a Gaussian on _prior_transform(params), broadcastable to
+    (..., n_params); the fit is then the posterior mode.
+    Returns a FitResult whose cost is the negative log-likelihood (plus the prior term)."""
+    m = MODELS[model]
+    x, k, n = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (x, k, n)])
+    w = (np.isfinite(x) & np.isfinite(k) & np.isfinite(n) & (n > 0)).astype(float)
+    x, k, n = [np.where(w > 0, v, 0) for v in (x, k, n)]
+
+    #asymptotes are probabilities here, so they are kept in (0, 1]
+    asymptote = np.array([name == 'a' for name in m.param_names])
+    fixed, values = fixed_params(model)
+    p = np.array(np.broadcast_to(p0, x.shape[:-1] + (len(m.param_names),)), dtype=float)
+    p = np.where(asymptote, np.clip(p, PROB_EPS, 1), p)
+    p = np.where(fixed, values, p)
+    eye = np.eye(p.shape[-1])
+
+    def objective(p):
+        with np.errstate(over='ignore'):
+            rate = m.forward(x, p)
+        mu = np.clip(rate, PROB_EPS, 1 - PROB_EPS)
+        nll = -np.sum(w * (k * np.log(mu) + (n - k) * np.log(1 - mu)), axis=-1)
+        if prior is not None:
+            t, _ = _prior_transform(p, model)
+            nll = nll + 0.5 * np.sum(((t - prior[0]) / prior[1]) ** 2, axis=-1)
+        return np.where(np.isfinite(nll), nll, np.inf), rate
+
+    cost, rate = objective(p)
+    lam = np.full(cost.shape, 1e-3)
+    done = np.zeros(cost.shape, dtype=bool)
+    nfev = np.ones(cost.shape, dtype=int)
+
+    for _ in range(max_iter):
+        with np.errstate(over='ignore'):
+            J = m.jacobian(x, p)
+        #clipped points have no gradient, as in the objective
+        J = J * (w * (rate > PROB_EPS) * (rate < 1 - PROB_EPS))[..., np.newaxis]
+        mu = np.clip(rate, PROB_EPS, 1 - PROB_EPS)
+        v = mu * (1 - mu)
+        g = np.einsum('...ni,...n->...i', J, (n * mu - k) / v)
+        F = np.einsum('...ni,...n,...nj->...ij', J, n / v, J) #Fisher information
+        if prior is not None:
+            t, dt = _prior_transform(p, model)
+            g = g + (t - prior[0]) / prior[1] ** 2 * dt
+            F = F + (dt ** 2 / prior[1] ** 2)[..., np.newaxis] * eye
+
+        #an asymptote at 1 that the gradient pushes further up is held there for this step
+        free = ~fixed & ~(asymptote & (p >= 1) & (g < 0))
+        g = g * free
+        F = F * free[..., np.newaxis, :] * free[..., :, np.newaxis] + eye * ~free[..., np.newaxis]
+
+        D = np.maximum(np.diagonal(F, axis1=-2, axis2=-1), 1e-12)
+        A = F + lam[..., np.newaxis, np.newaxis] * D[..., np.newaxis, :] * eye
+        step = -_solve(A, g)
+        step[done] = 0
+
+        p_new = p + step
+        p_new = np.where(asymptote, np.clip(p_new, PROB_EPS, 1), p_new)
+        cost_new, rate_new = objective(p_new)
+        nfev += ~done
+
+        better = (cost_new < cost) & ~done
+        converged = better & ((cost - cost_new) <= tol * np.maximum(np.abs(cost), tol))
+        converged |= np.all(np.abs(step) <= tol * (np.abs(p) + tol), axis=-1)
+
+        p = np.where(better[..., np.newaxis], p_new, p)
+        rate = np.where(better[..., np.newaxis], rate_new, rate)
+        cost = np.where(better, cost_new, cost)
+        lam = np.where(better, lam * 0.3, lam * 10)
+
+        converged |= lam > 1e12
+        done |= converged
+        if done.all():
+            break
+
+    return FitResult(p, cost, nfev, done)
+
+
+def fit_binomial(df_rates, model='sigmoid', init='grid', **kwargs):
+    """Binomial maximum-likelihood fit of both sides for a list of synchrony-rate dataframes.
+
+    Starts from the most likely START_GRID point (init='grid') or START_PARAMS ('fixed').
+    Returns (left, right) FitResults whose params have shape (n_subjects, n_params)."""
+    results = []
+    for side in ['left', 'right']:
+        xs, ks, ns = zip(*[side_counts(df_rate, side) for df_rate in df_rates])
+        x, k = stack(xs, ks)
+        _, n = stack(xs, ns)
+        p0 = grid_start(x, k / n, side, model, n) if init == 'grid' else start_params(side, model)
+        results.append(binomial_ml(x, k, n, p0, model=model, **kwargs))
+    return tuple(results)
+
+
+def fit_hierarchical(df_rates, model='sigmoid', max_outer=50, outer_tol=1e-3, **kwargs):
+    """Hierarchical binomial fit of a whole cohort with empirical-Bayes group priors.
+
+    Each side's parameters get a Gaussian group prior on (a, log|b|, c). Starting from the
+    unpooled ML fits, the prior mean and sd are re-estimated from all subjects' current
+    fits and every subject is refitted to its posterior mode, until the fits stop moving.
+    Noisy subjects are pulled towards the group; well-measured ones hardly move.
+    Returns (left, right) FitResults and {'left': (mean, sd), 'right': (mean, sd)} (empty if
+    no side had a successful fit to pool)."""
+    results = list(fit_binomial(df_rates, model=model, **kwargs))
+    priors = {}
+    for i, side in enumerate(['left', 'right']):
+        xs, ks, ns = zip(*[side_counts(df_rate, side) for df_rate in df_rates])
+        x, k = stack(xs, ks)
+        _, n = stack(xs, ns)
+        p = results[i].params
+        ok = results[i].success
+
+        for _ in range(max_outer):
+            t, _ = _prior_transform(p, model)
+            good = ok & np.all(np.isfinite(t), axis=-1)
+            if not good.any(): #nothing to pool; keep the unpooled fits
+                break
+            mean = t[good].mean(axis=0)
+            sd = np.sqrt(t[good].var(axis=0) + PRIOR_MIN_SD ** 2)
+            result = binomial_ml(x, k, n, p, model=model, prior=(mean, sd))
+            moved = np.max(np.abs(result.params - p) / (np.abs(p) + 1e-6))
+            p, ok = result.params, result.success
+            results[i], priors[side] = result, (mean, sd)
+            if moved < outer_tol:
+                break
+    return tuple(results), priors
+
+
+#%% model comparison
+def information_criteria(nll, k, n):
+    """AIC and BIC of a fit with negative log-likelihood nll, k free parameters and n observations"""
+    return 2 * k + 2 * nll, k * np.log(n) + 2 * nll
+
+
+def _fit_model(args):
+    df_rates, model, kwargs = args
+    return fit_binomial(df_rates, model=model, **kwargs)
+
+
+def compare_models(df_rates, models=COMPARE_MODELS, criterion='bic', margin=SELECT_MARGIN, jobs=None, **kwargs):
+    """Binomial maximum-likelihood fits of every candidate model to a list of synchrony-rate
+    dataframes, ranked per subject by criterion ('aic' or 'bic').
+
+    Each model is fitted to all subjects and both sides in one batch, the models in parallel on
+    jobs processes (default: one per model, at most one per core; 1 fits them in this process).
+    A subject's log-likelihood and parameter count are summed over its sides, with every
+    sync/async response an observation.
+    Returns {model: (left, right) FitResults} and a table with one row per subject (its index in
+    df_rates) and model: n_params, n_trials, nll, aic, bic, success, delta (criterion minus the
+    subject's best) and selected: the best converged model (the best of all if none converged),
+    unless it beats the first of models by no more than margin."""
+    tasks = [(df_rates, model, kwargs) for model in models]
+    jobs = jobs or min(len(models), os.cpu_count() or 1)
+    if jobs == 1:
+        fits = dict(zip(models, map(_fit_model, tasks)))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            fits = dict(zip(models, pool.map(_fit_model, tasks)))
+
+    n_trials = np.array([df_rate.total.sum() for df_rate in df_rates], dtype=float)
+    rows = []
+    for model, (left, right) in fits.items():
+        k = 2 * n_free(model)
+        nll = left.cost + right.cost
+        aic, bic = information_criteria(nll, k, n_trials)
+        rows.append({'subject': np.arange(len(df_rates)), 'model': model, 'n_params': k, 'n_trials': n_trials,
+                     'nll': nll, 'aic': aic, 'bic': bic, 'success': left.success & right.success})
+
+    table = pd.concat([pd.DataFrame(r) for r in rows], ignore_index=True)
+    table['score'] = table[criterion].where(np.isfinite(table[criterion]), np.inf)
+    table['delta'] = table.score - table.groupby('subject').score.transform('min')
+    best = (table.sort_values(['subject', 'success', 'score'], ascending=[True, False, True])
+            .groupby('subject').head(1).set_index('subject').sort_index())
+    reference = table[table.model == models[0]].set_index('subject').sort_index()
+    chosen = np.where(reference.success & (reference.score <= best.score + margin), models[0], best.model)
+    table['selected'] = table.model.values == chosen[table.subject.values]
+    return fits, table.drop(columns='score')
+
+
+#%% bootstrap
+def bootstrap_tbw(df_rate, n_resamples=2000, start=None, model='sigmoid', seed=None, likelihood=False, **kwargs):
+    """Refit both sides for n_resamples resamples of one subject's trials in one batch.
+
+    Trials are resampled with replacement within each SOA, i.e. each SOA's sync count is
+    drawn from Binomial(total, sync_rate). start is the (left, right) parameters of the
+    fit to the real data, used as the starting point of every resample. The resamples are
+    refitted by least squares, or with likelihood=True by binomial maximum likelihood
+    (for CIs of binomial fits).
+    Returns (left, right) FitResults whose params have shape (n_resamples, n_params)."""
+    rng = np.random.default_rng(seed)
+    total = df_rate.total.values.astype(int)
+    sync = rng.binomial(total, df_rate.sync_rate.values, size=(n_resamples, len(total)))
+    rates = sync / total.astype(float)
+
+    results = []
+    for i, side in enumerate(['left', 'right']):
+        mask = (df_rate.SOA <= 0).values if side == 'left' else (df_rate.SOA >= 0).values
+        x = np.broadcast_to(df_rate.SOA.values[mask], (n_resamples, mask.sum()))
+        p0 = start_params(side, model) if start is None else start[i]
+        if likelihood:
+            results.append(binomial_ml(x, sync[:, mask], total[mask], p0, model=model, **kwargs))
+        else:
+            results.append(least_squares(x, rates[:, mask], p0, model=model, **kwargs))
+    return tuple(results)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Psychometric models for TBW fitting, with closed-form inverses for SOA calculation
+
+All functions are vectorized: parameter sets are arrays of shape (..., n_params)
+so a whole cohort or a stack of bootstrap samples can be solved in one call.
+
+MODELS is the registry the fitters, SOA solver and plots look models up in. The
+one-sided models all take (a, b, c) - asymptote, slope, location - so start values,
+group priors, fit files and plots carry over; they differ in shape: the logistic
+sigmoid, the cumulative Gaussian and the skewed Weibull-like and Gumbel windows.
+A model can hold parameters fixed (sigmoid1: asymptote 1), which the fitters do not
+move and model comparison does not count.
+"""
+
+import numpy as np
+from collections import namedtuple
+
+#synchrony rate each SOA is read off at, and which side of the TBW it comes from
+SOA_TARGETS = {'ASOA95': ('left', 0.05),
+               'ASOA50': ('left', 0.5),
+               'VSOA50': ('right', 0.5),
+               'VSOA95': ('right', 0.05)}
+
+Model = namedtuple('Model', ['name', 'param_names', 'forward', 'inverse', 'jacobian', 'fixed'], defaults=((),))
+
+
+def _split(params):
+    params = np.asarray(params, dtype=float)
+    return [params[..., i] for i in range(params.shape[-1])]
+
+
+#%% sigmoid
+def sigmoid(x, params):
+    """a / (1 + exp(-b * (x - c))) evaluated at x for each parameter set.
+
+    x is either shared, shape (n,), or per parameter set, shape params.shape[:-1] + (n,).
+    Returns an array of shape params.shape[:-1] + (n,)."""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    return a / (1 + np.exp(-b * (x - c)))
+
+
+def sigmoid_inverse(y, params):
+    """SOA at which the sigmoid reaches rate y.
+
+    NaN where y is not reachable, i.e. y <= 0 or y >= the asymptote a."""
+    a, b, c = _split(params)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = c - np.log(a / y - 1) / b
+    reachable = (y > 0) & (y < a) & (b != 0)
+    return np.where(reachable, x, np.nan)
+
+
+def sigmoid_jacobian(x, params):
+    """Partial derivatives of the sigmoid wrt (a, b, c), shape params.shape[:-1] + (n, 3)"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    s = 1 / (1 + np.exp(-b * (x - c)))
+    ds = a * s * (1 - s)
+    return np.stack(np.broadcast_arrays(s, ds * (x - c), -ds * b), axis=-1)
+
+
+#%% cumulative Gaussian
+def _ndtr():
+    from scipy.special import ndtr, ndtri
+    return ndtr, ndtri
+
+
+def gaussian(x, params):
+    """a * Phi(b * (x - c)), Phi the standard normal CDF (1/|b| is the sd); shapes as for sigmoid"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    return a * _ndtr()[0](b * (x - c))
+
+
+def gaussian_inverse(y, params):
+    """SOA at which the cumulative Gaussian reaches rate y (NaN if unreachable)"""
+    a, b, c = _split(params)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = c + _ndtr()[1](y / a) / b
+    reachable = (y > 0) & (y < a) & (b != 0)
+    return np.where(reachable, x, np.nan)
+
+
+def gaussian_jacobian(x, params):
+    """Partial derivatives of the cumulative Gaussian wrt (a, b, c)"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    z = b * (x - c)
+    pdf = np.exp(-0.5 * z ** 2) / np.sqrt(2 * np.pi)
+    ds = a * pdf
+    return np.stack(np.broadcast_arrays(_ndtr()[0](z), ds * (x - c), -ds * b), axis=-1)
+
+
+#%% Weibull-like and Gumbel (skewed) windows
+def weibull(x, params):
+    """a * (1 - exp(-exp(b * (x - c)))): a Weibull CDF in exp(x), so the rate leaves 0
+    gradually and saturates abruptly (towards SOA 0 on both sides); shapes as for sigmoid"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    return a * -np.expm1(-np.exp(np.minimum(b * (x - c), 700)))
+
+
+def weibull_inverse(y, params):
+    """SOA at which the Weibull-like model reaches rate y (NaN if unreachable)"""
+    a, b, c = _split(params)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = c + np.log(-np.log1p(-y / a)) / b
+    reachable = (y > 0) & (y < a) & (b != 0)
+    return np.where(reachable, x, np.nan)
+
+
+def weibull_jacobian(x, params):
+    """Partial derivatives of the Weibull-like model wrt (a, b, c)"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    e = np.exp(np.minimum(b * (x - c), 700))
+    ds = a * e * np.exp(-e)
+    return np.stack(np.broadcast_arrays(-np.expm1(-e), ds * (x - c), -ds * b), axis=-1)
+
+
+def gumbel(x, params):
+    """a * exp(-exp(-b * (x - c))): the Weibull-like model mirrored, rising abruptly from 0
+    and saturating gradually; shapes as for sigmoid"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    return a * np.exp(-np.exp(np.minimum(-b * (x - c), 700)))
+
+
+def gumbel_inverse(y, params):
+    """SOA at which the Gumbel model reaches rate y (NaN if unreachable)"""
+    a, b, c = _split(params)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = c - np.log(-np.log(y / a)) / b
+    reachable = (y > 0) & (y < a) & (b != 0)
+    return np.where(reachable, x, np.nan)
+
+
+def gumbel_jacobian(x, params):
+    """Partial derivatives of the Gumbel model wrt (a, b, c)"""
+    a, b, c = [p[..., np.newaxis] for p in _split(params)]
+    x = np.asarray(x, dtype=float)
+    e = np.exp(np.minimum(-b * (x - c), 700))
+    s = np.exp(-e)
+    ds = a * s * e
+    return np.stack(np.broadcast_arrays(s, ds * (x - c), -ds * b), axis=-1)
+
+
+#%% joint two-sided sigmoid
+def joint(x, params):
+    """Both sides in one model with a shared peak a: a / (1 + exp(-b_left * (x - c_left)))
+    for x <= 0 and a / (1 + exp(-b_right * (x - c_right))) for x > 0.
+
+    params are (a, b_left, c_left, b_right, c_right); shapes as for sigmoid."""
+    left, right = joint_sides(params)
+    x = np.asarray(x, dtype=float)
+    return np.where(x <= 0, sigmoid(x, left), sigmoid(x, right))
+
+
+def joint_jacobian(x, params):
+    """Partial derivatives of the joint model, shape params.shape[:-1] + (n, 5)"""
+    left, right = joint_sides(params)
+    x = np.asarray(x, dtype=float)
+    J_left, J_right = sigmoid_jacobian(x, left), sigmoid_jacobian(x, right)
+    is_left = (x <= 0)[..., np.newaxis]
+    zero = np.zeros_like(J_left[..., :2])
+    return np.concatenate([np.where(is_left, J_left[..., :1], J_right[..., :1]),
+                           np.where(is_left, J_left[..., 1:], zero),
+                           np.where(is_left, zero, J_right[..., 1:])], axis=-1)
+
+
+def joint_sides(params):
+    """Left and right sigmoid parameters (a, b, c) of joint model parameters"""
+    params = np.asarray(params, dtype=float)
+    return params[..., [0, 1, 2]], params[..., [0, 3, 4]]
+
+
+MODELS = {'sigmoid': Model('sigmoid', ('a', 'b', 'c'), sigmoid, sigmoid_inverse, sigmoid_jacobian),
+          'sigmoid1': Model('sigmoid1', ('a', 'b', 'c'), sigmoid, sigmoid_inverse, sigmoid_jacobian, (('a', 1.0),)),
+          'gaussian': Model('gaussian', ('a', 'b', 'c'), gaussian, gaussian_inverse, gaussian_jacobian),
+          'weibull': Model('weibull', ('a', 'b', 'c'), weibull, weibull_inverse, weibull_jacobian),
+          'gumbel': Model('gumbel', ('a', 'b', 'c'), gumbel, gumbel_inverse, gumbel_jacobian),
+          #two-sided: solve SOAs with solve_soas(*joint_sides(params))
+          'joint': Model('joint', ('a', 'b_left', 'c_left', 'b_right', 'c_right'), joint, None, joint_jacobian)}
+
+
+def register(model):
+    """Add a Model to MODELS. One-sided models for TBW_fitting take (a, b, c) like the others."""
+    MODELS[model.name] = model
+    return model
+
+
+def fixed_params(model):
+    """Mask of a model's fixed parameters and their values, both shape (n_params,)"""
+    m = MODELS[model]
+    fixed = dict(m.fixed)
+    return (np.array([k in fixed for k in m.param_names]),
+            np.array([fixed.get(k, np.nan) for k in m.param_names], dtype=float))
+
+
+def n_free(model):
+    """Number of parameters a fit of model estimates"""
+    m = MODELS[model]
+    return len(m.param_names) - len(m.fixed)
+
+
+def side_model(name):
+    """One-sided model of a recorded fit model name ('gumbel_ml' -> 'gumbel'; joint sides are sigmoids)"""
+    for suffix in ['_ml', '_hier']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return 'sigmoid' if name == 'joint' else name
+
+
+#%% SOA calculation
+def solve_soas(left_params, right_params, model='sigmoid'):
+    """ASOA95/ASOA50/VSOA50/VSOA95 for arrays of left and right parameter sets.
+
+    Returns a dict of arrays (0-d for a single subject); unreachable SOAs are NaN."""
+    inverse = MODELS[model].inverse
+    params = {'left': left_params, 'right': right_params}
+    return {name: inverse(rate, params[side]) for name, (side, rate) in SOA_TARGETS.items()}
+
+
+def unreachable_soas(soas):
+    """Names of SOAs that could not be solved for (target rate above the asymptote)"""
+    return [name for name, value in soas.items() if np.any(np.isnan(value))]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Online TBW estimation during msi_a
+
+Keeps running sync/total counts per SOA as responses come in and refits both sides
+of the TBW with the batched fitter, warm-started from the previous fit, so the SOA
+file for msi_b can be written as soon as the last trial ends instead of re-reading
+the CSV with TBW_fitting.py.
+"""
+
+import numpy as np
+import pandas as pd
+from tbw_models import solve_soas
+from tbw_fit import FitResult, start_params, side_data, least_squares
+
+
+class OnlineTBW:
+    """Incremental synchrony counts and warm-started left/right fits.
+
+    add(SOA_ms, resp_recode) after every response, refit() whenever there is time
+    (block breaks), then refit() once more after the last trial."""
+
+    def __init__(self, model='sigmoid'):
+        self.model = model
+        self.counts = {} #SOA (ms) -> [sync, total]
+        self.results = {'left': None, 'right': None}
+
+    def add(self, SOA, resp_recode):
+        if resp_recode not in ('sync', 'async'): #no response
+            return
+        count = self.counts.setdefault(SOA, [0, 0])
+        count[0] += resp_recode == 'sync'
+        count[1] += 1
+
+    def sync_rates(self):
+        """The same table as TBW_fitting.sync_rates() on the session's CSV so far"""
+        SOAs = sorted(self.counts)
+        sync, total = np.array([self.counts[SOA] for SOA in SOAs], dtype=float).reshape(-1, 2).T
+        df_rate = pd.DataFrame({'async': total - sync, 'sync': sync, 'total': total, 'SOA': SOAs,
+                                'sync_rate': sync / total},
+                               index=pd.Index(SOAs, name='SOA'), dtype=float)
+        df_rate.columns.name = 'resp_recode'
+        return df_rate
+
+    def refit(self):
+        """Refit both sides from the previous fit and the default start at once and keep the
+        better of the two. Returns the (left, right) FitResults."""
+        df_rate = self.sync_rates()
+        for side in ['left', 'right']:
+            x, y = side_data(df_rate, side)
+            p0 = [start_params(side, self.model)]
+            if self.results[side] is not None:
+                p0.insert(0, self.results[side].params)
+            x, y = np.tile(x, (len(p0), 1)), np.tile(y, (len(p0), 1))
+            batch = least_squares(x, y, np.array(p0), model=self.model)
+            best = int(np.argmin(np.where(np.isfinite(batch.cost), batch.cost, np.inf)))
+            self.results[side] = FitResult(*[v[best] for v in batch])
+        return self.results['left'], self.results['right']
+
+    def soas(self):
+        soas = solve_soas(self.results['left'].params, self.results['right'].params, self.model)
+        return {k: float(v) for k, v in soas.items()}
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Batch rendering of TBW fit figures
+
+Figures are drawn on Agg canvases (matplotlib.figure.Figure, never pyplot), so no
+global pyplot state is touched and rendering works the same in worker processes.
+TBWFigure draws the axes, ticks and labels once and keeps that background; each
+subject then only restores it, draws the data, curves, SOAs and title over it and
+writes the pixel buffer. contact_sheet draws every subject's data, fitted sigmoids
+and SOAs into one grid.
+
+Usage:
+    python tbw_plot.py [--jobs N] [--wd DIR]   redraw every fitted subject's figure
+                                               and data/plots/cohort_TBW.png
+    python tbw_plot.py --sheet-only            only the contact sheet
+"""
+
+import os, time, argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from tbw_models import MODELS, side_model
+
+SHEET_FILENAME = 'data' + os.sep + 'plots' + os.sep + 'cohort_TBW.png'
+
+SOA_MARKERS = [('ASOA50', 0.5), ('ASOA95', 0.05), ('VSOA50', 0.5), ('VSOA95', 0.05)] #SOA and rate it is marked at
+
+X_LEFT = np.linspace(-300, 0, 500)
+X_RIGHT = np.linspace(0, 300, 500)
+XLIM = (-320, 320)
+YLIM = (-0.05, 1.05)
+XTICKS = np.arange(-300, 301, 100)
+YTICKS = np.arange(0, 1.01, 0.2)
+
+SHEET_COLUMNS = 8
+PNG_COMPRESS_LEVEL = 1 #zlib level for subject figures; the default 6 is slower for a few % smaller files
+
+_figure = None #this process's TBWFigure
+
+
+def _agg_figure(**kwargs):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def draw_tbw(ax, fontsize=None):
+    """Create the data, sigmoid and SOA artists of one TBW plot on ax (with no data yet)"""
+    artists = {'data': ax.plot([], [], 'ko', markersize=None if fontsize is None else 3)[0],
+               'left': ax.plot(X_LEFT, np.full_like(X_LEFT, np.nan), 'b')[0],
+               'right': ax.plot(X_RIGHT, np.full_like(X_RIGHT, np.nan), 'b')[0]}
+    for name, rate in SOA_MARKERS:
+        artists[name] = ax.plot([np.nan], [rate], 'k+')[0]
+        artists[name + '_text'] = ax.text(0, rate, '', fontsize=fontsize, clip_on=True)
+    #fixed limits and ticks: nothing is autoscaled or re-located when the data change
+    ax.set_autoscale_on(False)
+    ax.set_xlim(*XLIM)
+    ax.set_ylim(*YLIM)
+    ax.set_xticks(XTICKS)
+    ax.set_yticks(YTICKS)
+    return artists
+
+
+def set_tbw(artists, df_rate, left_params, right_params, soas, decimals=2, model='sigmoid'):
+    """Point the artists from draw_tbw at one subject's rates, fitted parameters (of the one-sided
+    model) and SOAs"""
+    forward = MODELS[model].forward
+    artists['data'].set_data(df_rate.SOA.values, df_rate.sync_rate.values)
+    artists['left'].set_ydata(forward(X_LEFT, np.asarray(left_params, dtype=float)))
+    artists['right'].set_ydata(forward(X_RIGHT, np.asarray(right_params, dtype=float)))
+    for name, rate in SOA_MARKERS:
+        soa = soas[name]
+        solved = not np.isnan(soa)
+        artists[name].set_visible(solved)
+        artists[name + '_text'].set_visible(solved)
+        if solved:
+            artists[name].set_xdata([soa])
+            artists[name + '_text'].set_text(str(round(soa, decimals) if decimals else int(round(soa))))
+            artists[name + '_text'].set_position((soa, rate))
+
+
+class TBWFigure:
+    """One reusable single-subject TBW figure; update() then save() per subject"""
+
+    def __init__(self, figsize=(6.4, 4.8), dpi=100):
+        self.fig = _agg_figure(figsize=figsize, dpi=dpi)
+        self.ax = self.fig.add_subplot()
+        self.ax.set_ylabel('Rate of synchrony perception')
+        self.ax.set_xlabel('SOA (ms)')
+        self.title = self.ax.set_title('msi_a_sub')
+        self.artists = draw_tbw(self.ax)
+        self.fig.tight_layout() #only the title text changes, so the layout is fixed once
+
+        #everything that changes per subject is drawn over a cached background
+        self.dynamic = list(self.artists.values()) + [self.title]
+        for artist in self.dynamic:
+            artist.set_animated(True)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def update(self, subj, df_rate, left_params, right_params, soas, model='sigmoid'):
+        self.title.set_text('msi_a_sub' + str(subj))
+        set_tbw(self.artists, df_rate, left_params, right_params, soas, model=model)
+
+    def save(self, filename):
+        from PIL import Image
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for artist in self.dynamic:
+            if artist.get_visible():
+                self.fig.draw_artist(artist)
+        Image.fromarray(np.asarray(canvas.buffer_rgba())).save(filename, compress_level=PNG_COMPRESS_LEVEL)
+
+
+def figure():
+    """This process's TBWFigure, created on first use"""
+    global _figure
+    if _figure is None:
+        _figure = TBWFigure()
+    return _figure
+
+
+def render(subj, df_rate, left_params, right_params, soas, filename, model='sigmoid'):
+    """Draw one subject with this process's figure and save it to filename"""
+    fig = figure()
+    fig.update(subj, df_rate, left_params, right_params, soas, model)
+    fig.save(filename)
+
+
+def contact_sheet(subjects, filename=SHEET_FILENAME, ncols=SHEET_COLUMNS):
+    """All subjects' TBWs in one grid image.
+
+    subjects: list of (subj, df_rate, left_params, right_params, soas, model) as load_subject returns."""
+    nrows = max(1, int(np.ceil(len(subjects) / float(ncols))))
+    width, height = 2.2 * ncols + 0.6, 1.8 * nrows + 0.5
+    fig = _agg_figure(figsize=(width, height), dpi=100)
+    #fixed margins (inches) instead of a tight bbox, which would draw the sheet twice
+    fig.subplots_adjust(left=0.6 / width, right=1 - 0.1 / width, bottom=0.45 / height, top=1 - 0.25 / height,
+                        wspace=0.15, hspace=0.35)
+    axes = fig.subplots(nrows, ncols, squeeze=False)
+    for i, (ax, (subj, df_rate, left, right, soas, model)) in enumerate(zip(axes.ravel(), subjects)):
+        set_tbw(draw_tbw(ax, fontsize=6), df_rate, left, right, soas, decimals=0, model=model)
+        ax.set_title('sub' + str(subj), fontsize=8, pad=2)
+        ax.tick_params(labelsize=6, labelleft=i % ncols == 0, labelbottom=i + ncols >= len(subjects))
+    for ax in axes.ravel()[len(subjects):]:
+        ax.set_visible(False)
+    fig.supxlabel('SOA (ms)', y=0.05 / height, va='bottom', fontsize=9)
+    fig.supylabel('Rate of synchrony perception', x=0.05 / width, ha='left', fontsize=9)
+    fig.savefig(filename)
+    return filename
+
+
+#%% subjects from the files TBW_fitting.py writes
+def load_subject(subj):
+    """(subj, df_rate, left_params, right_params, soas, model) from a fitted subject's files"""
+    from TBW_fitting import subject_paths, sync_rates
+    paths = subject_paths(subj)
+    df_rate = sync_rates(pd.read_csv(paths['data']))
+    fit = pd.read_csv(paths['fit']).set_index('side')
+    SOA_out = pd.read_csv(paths['SOAs'], index_col=0)
+    soas = {name: float(SOA_out[name].iloc[0]) for name, _ in SOA_MARKERS}
+    return (subj, df_rate, fit.loc['left', list('abc')].values, fit.loc['right', list('abc')].values, soas,
+            side_model(fit.model.iloc[0]))
+
+
+def fitted_subjects():
+    """Subject IDs with msi_a data, fit results and an SOA file"""
+    from TBW_fitting import find_subjects, subject_paths
+    return [s for s in find_subjects()
+            if os.path.isfile(subject_paths(s)['fit']) and os.path.isfile(subject_paths(s)['SOAs'])]
+
+
+def _render_subject(subj):
+    from TBW_fitting import subject_paths
+    loaded = load_subject(subj)
+    render(*loaded[:5], filename=subject_paths(subj)['plot'], model=loaded[5])
+    return loaded
+
+
+def render_subjects(subjs, jobs=None):
+    """Redraw every subject's figure on a process pool (one reused figure per worker).
+
+    Returns the loaded subjects, in order, for contact_sheet."""
+    if jobs == 1:
+        return [_render_subject(s) for s in subjs]
+    chunksize = max(1, len(subjs) // (4 * (jobs or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_render_subject, subjs, chunksize=chunksize))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render TBW figures and the cohort contact sheet')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--sheet-only', action='store_true', help='only draw the contact sheet')
+    parser.add_argument('--wd', default='.', help='experiment directory containing data/')
+    args = parser.parse_args(argv)
+    os.chdir(args.wd)
+
+    subjs = fitted_subjects()
+    start = time.perf_counter()
+    if args.sheet_only:
+        subjects = [load_subject(s) for s in subjs]
+    else:
+        subjects = render_subjects(subjs, args.jobs)
+        print("%d subject figures in %.2f s" % (len(subjs), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    if subjects:
+        print("Contact sheet " + contact_sheet(subjects) + " in %.2f s" % (time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
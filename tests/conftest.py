@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+# the experiment scripts are flat modules in the repository root
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+# adaptive SOA placement: replaying a journal gives the same choice as running live
+
+import time
+import numpy as np
+
+from msi_adaptive import AdaptiveSOA
+
+
+def test_replay_matches_live_run():
+    rng = np.random.default_rng(0)
+    live = AdaptiveSOA()
+    rows = []
+    for _ in range(20):
+        SOA = live.next_SOA()
+        resp = 'sync' if rng.random() < 0.5 else rng.choice(['async', 'NaN'])
+        live.update(SOA, resp)
+        rows.append((SOA, resp))
+
+    #update() alone never searches, so the replay costs a fraction of one next_SOA()
+    replay = AdaptiveSOA()
+    replay.next_SOA()
+    start = time.perf_counter()
+    for SOA, resp in rows:
+        replay.update(SOA, resp)
+    replay_time = time.perf_counter() - start
+    start = time.perf_counter()
+    assert replay.next_SOA() == live.next_SOA()
+    assert replay_time < time.perf_counter() - start
+
+    for side in ['left', 'right']:
+        np.testing.assert_allclose(replay.sides[side].log_post, live.sides[side].log_post)
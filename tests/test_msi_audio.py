@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+# audio latency model: beep flip offsets and the SOA error of compiled trials
+
+import numpy as np
+import pytest
+
+from msi_audio import nearest, play_offset, onset_flip, soa_errors, check
+
+
+def test_nearest_rounds_halves_up():
+    assert [nearest(x) for x in [-2.5, -1.5, -0.5, 0.5, 1.5, 2.5, 2.4, -2.6]] == [-2, -1, 0, 1, 2, 3, 2, -3]
+
+
+@pytest.mark.parametrize('SOA, latency, frames', [(0, 0.02, -2), (100, 0.02, 8), (-300, 0.02, -32),
+                                                  (0, 0.025, -2), (10, 0.025, -1), (100, 0.025, 8),
+                                                  (-100, 0.025, -12)])
+def test_play_offset(SOA, latency, frames):
+    assert play_offset(SOA, latency) == frames
+
+
+def test_onset_flip():
+    assert onset_flip(5, 0.02) == 7
+    assert onset_flip(5, 0.025) == 8
+
+
+def test_exact_latency_has_no_error():
+    assert check(0.02) == 0
+
+
+@pytest.mark.parametrize('latency', [0.015, 0.025, 0.035])
+def test_half_frame_latency_error_has_one_sign(latency):
+    errors = soa_errors(latency)
+    np.testing.assert_allclose(errors, 5)
+    assert check(latency) <= 5
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# whole msi_a/msi_b sessions on the simulated backend: crash and resume, the key log
+# and the EEG event table
+
+import os, json, threading
+import numpy as np
+import pandas as pd
+import pytest
+
+from msi_sim import run_session, make_wd, SimCrash
+from bench_msi import write_soa_file
+from tbw_models import solve_soas
+from msi_events import load_events, align, epoch_samples, CONDITION_CODES, CONDITION, RESPONSE, CLEAR
+
+SUBJ = '2' #even: left = sync
+RESP_TRIG = {'left': 2, 'right': 1}
+KEY_COLUMNS = ['trial', 'key', 'rt', 'response']
+
+
+def paths(wd, part):
+    base = os.path.join(str(wd), 'data')
+    name = part + '_sub' + SUBJ
+    return {'data': os.path.join(base, part, name + '.csv'),
+            'log': os.path.join(base, 'logfiles', part, name + '_log.csv'),
+            'keys': os.path.join(base, 'logfiles', part, name + '_keys.csv'),
+            'journal': os.path.join(base, 'logfiles', part, name + '_journal.jsonl'),
+            'events': os.path.join(base, part, name + '_events.npy')}
+
+
+def journal_records(filename):
+    with open(filename) as fd:
+        return [json.loads(line) for line in fd]
+
+
+@pytest.fixture(scope='module')
+def msi_a(tmp_path_factory):
+    """msi_a crashed after 100 trials and resumed, with early presses and missed responses"""
+    wd = tmp_path_factory.mktemp('msi_a')
+    kwargs = dict(early_press_rate=0.3, no_response_rate=0.1)
+    crashed = run_session('msi_a.py', subj=SUBJ, wd=str(wd), crash_after=100, **kwargs)
+    resumed = run_session('msi_a.py', subj=SUBJ, wd=str(wd), resume=True, **kwargs)
+    return wd, crashed, resumed
+
+
+@pytest.fixture
+def msi_b_wd(tmp_path):
+    """wd with a finished msi_a session and its SOA file"""
+    run_session('msi_a.py', subj=SUBJ, wd=str(tmp_path))
+    write_soa_file(str(tmp_path), SUBJ)
+    return tmp_path
+
+
+def test_crash_stops_loggers(tmp_path):
+    sim = run_session('msi_a.py', subj=SUBJ, wd=str(tmp_path), crash_after=10)
+    assert isinstance(sim.error, SimCrash)
+    assert not [t for t in threading.enumerate() if t.name == 'TrialLogger']
+    assert not os.path.isfile(paths(tmp_path, 'msi_a')['data'])
+    records = journal_records(paths(tmp_path, 'msi_a')['journal'])
+    assert records[0]['type'] == 'schedule'
+    assert [r['type'] for r in records[1:]] == ['trial'] * 10
+
+
+@pytest.mark.parametrize('script', ['msi_a.py', 'msi_b.py'])
+def test_failed_display_check_leaves_nothing(request, tmp_path, script):
+    part = script[:-3]
+    wd = request.getfixturevalue('msi_b_wd') if part == 'msi_b' else tmp_path
+    make_wd(str(wd))
+    before = set(os.listdir(os.path.join(str(wd), 'data', part)))
+
+    #a 60 Hz display fails the refresh-rate check before any session file is created
+    sim = run_session(script, subj=SUBJ, wd=str(wd), framerate=60)
+    assert 'Expected refresh rate' in str(sim.exit) and not sim.trials
+    assert set(os.listdir(os.path.join(str(wd), 'data', part))) == before
+    assert not os.listdir(os.path.join(str(wd), 'data', 'logfiles', part))
+
+    #so the next launch starts a new session instead of asking to resume one that never ran
+    sim = run_session(script, subj=SUBJ, wd=str(wd))
+    assert sim.error is None and sim.exit is None
+    assert os.path.isfile(paths(wd, part)['data'])
+
+
+@pytest.mark.parametrize('script, subj', [('msi_a.py', SUBJ), ('msi_a.py', '902'), ('msi_b.py', SUBJ)])
+def test_resume_without_journal_exits(request, tmp_path, script, subj):
+    wd = request.getfixturevalue('msi_b_wd') if script == 'msi_b.py' else tmp_path
+    if subj != SUBJ: #practice: its journal is deleted before the resume is tried
+        run_session(script, subj=subj, wd=str(wd), crash_after=2)
+    sim = run_session(script, subj=subj, wd=str(wd), resume=True)
+    assert sim.error is None and 'No unfinished session' in str(sim.exit)
+    assert not sim.trials
+
+
+def test_msi_a_resume_row_counts(msi_a):
+    wd, crashed, resumed = msi_a
+    assert isinstance(crashed.error, SimCrash) and resumed.error is None and resumed.exit is None
+    assert len(crashed.trials) == 100 and len(resumed.trials) == 204
+
+    df = pd.read_csv(paths(wd, 'msi_a')['data'], index_col=0)
+    assert len(df) == 304
+    assert list(df.groupby('block').size()) == [76] * 4
+    assert list(df.trial) == list(range(1, 77)) * 4
+
+    records = journal_records(paths(wd, 'msi_a')['journal'])
+    assert records[0]['type'] == 'schedule' and records[-1]['type'] == 'end'
+    rows = [r['row'] for r in records[1:-1]]
+    assert [r['type'] for r in records[1:-1]] == ['trial'] * 304
+    assert [row[3] for row in rows] == list(df.SOA)
+    assert len(pd.read_csv(paths(wd, 'msi_a')['log'], header=None)) == 304
+
+
+def test_msi_a_no_response_rt_is_nan(msi_a):
+    df = pd.read_csv(paths(msi_a[0], 'msi_a')['data'], index_col=0)
+    missed = df.resp.isna()
+    assert missed.any()
+    assert df.rt[missed].isna().all()
+    assert df.rt[~missed].between(0.3, 1.2).all()
+
+
+def test_msi_a_key_log(msi_a):
+    df = pd.read_csv(paths(msi_a[0], 'msi_a')['data'], index_col=0).reset_index(drop=True)
+    keys = pd.read_csv(paths(msi_a[0], 'msi_a')['keys'], header=None, names=KEY_COLUMNS)
+
+    #one logged response per answered trial, with the RT and key in the data file
+    taken = keys[keys.response == 1].set_index('trial')
+    answered = df[df.resp.notna()]
+    assert list(taken.index) == list(answered.index)
+    np.testing.assert_allclose(taken.rt, answered.rt)
+    assert list(taken.key) == list(answered.resp)
+
+    #presses during the stimulus window are logged with a negative RT and never taken as the response
+    early = keys[keys.rt < 0]
+    assert len(early) > 0
+    assert (early.response == 0).all()
+    assert early.key.isin(['left', 'right']).all()
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_msi_a_writes_soas_and_matching_fit(tmp_path, adaptive):
+    sim = run_session('msi_a.py', subj=SUBJ, wd=str(tmp_path), adaptive=adaptive)
+    assert sim.error is None and sim.exit is None
+    data = os.path.join(str(tmp_path), 'data')
+    soas = pd.read_csv(os.path.join(data, 'SOAs', 'msi_a_sub' + SUBJ + '_SOAs.csv'), index_col=0)
+    fit = pd.read_csv(os.path.join(data, 'fit_results', 'msi_a_sub' + SUBJ + '_fit.csv')).set_index('side')
+    assert soas.source[0] == ('adaptive' if adaptive else 'online')
+
+    #no plot during the session; the fit file holds the parameters behind the SOAs
+    assert not os.listdir(os.path.join(data, 'plots'))
+    solved = solve_soas(fit.loc['left', list('abc')].values, fit.loc['right', list('abc')].values)
+    for name, value in solved.items():
+        assert np.isclose(soas[name][0], value)
+
+
+def test_msi_b_event_table(msi_b_wd):
+    sim = run_session('msi_b.py', subj=SUBJ, wd=str(msi_b_wd), no_response_rate=0.1, early_press_rate=0.2)
+    assert sim.error is None and sim.exit is None
+    df = pd.read_csv(paths(msi_b_wd, 'msi_b')['data'], index_col=0).reset_index(drop=True)
+    events = load_events(paths(msi_b_wd, 'msi_b')['events'])
+
+    #one row per trigger sent, at the time it was sent
+    assert list(events['code']) == [value for _, _, value, _ in sim.triggers]
+    np.testing.assert_allclose(events['actual'], [t for t, _, _, _ in sim.triggers])
+    assert not np.isnan(events['intended']).any()
+    np.testing.assert_allclose(events['actual'] - events['intended'], 0, atol=1e-9)
+
+    #every trial: condition trigger and clear, then response trigger and clear
+    assert len(events) == 4 * len(df)
+    assert list(events['trial']) == list(np.repeat(np.arange(len(df)), 4))
+    kinds = events['kind'].reshape(len(df), 4)
+    assert (kinds == [CONDITION, CLEAR, RESPONSE, CLEAR]).all()
+
+    response = events[events['kind'] == RESPONSE]
+    assert list(response['code']) == [RESP_TRIG.get(resp, 3) for resp in df.resp.fillna('NaN')]
+    np.testing.assert_allclose(response['rt'], df.rt.values.astype('f4'))
+    assert np.isnan(response['rt'][response['code'] == 3]).all()
+
+
+def test_msi_b_resume(msi_b_wd):
+    crashed = run_session('msi_b.py', subj=SUBJ, wd=str(msi_b_wd), crash_after=100)
+    resumed = run_session('msi_b.py', subj=SUBJ, wd=str(msi_b_wd), resume=True)
+    assert isinstance(crashed.error, SimCrash) and resumed.error is None and resumed.exit is None
+
+    df = pd.read_csv(paths(msi_b_wd, 'msi_b')['data'], index_col=0)
+    assert len(df) == 512
+    records = journal_records(paths(msi_b_wd, 'msi_b')['journal'])
+    assert [r['type'] for r in records] == ['schedule'] + ['trial'] * 512 + ['end']
+
+    #the table holds both runs' triggers in the order they were sent, one response per trial
+    events = load_events(paths(msi_b_wd, 'msi_b')['events'])
+    sent = [value for _, _, value, _ in crashed.triggers + resumed.triggers]
+    assert list(events['code']) == sent
+    response = events[events['kind'] == RESPONSE]
+    assert list(response['trial']) == list(range(512))
+
+
+def test_msi_b_resume_epochs(msi_b_wd):
+    crashed = run_session('msi_b.py', subj=SUBJ, wd=str(msi_b_wd), crash_after=100)
+    resumed = run_session('msi_b.py', subj=SUBJ, wd=str(msi_b_wd), resume=True)
+    events = load_events(paths(msi_b_wd, 'msi_b')['events'])
+    assert list(events['run']) == [0] * len(crashed.triggers) + [1] * len(resumed.triggers)
+
+    #one EEG recording across the break: the resumed run's clock restarts from 0 two minutes later
+    sfreq, drift = 512, 20e-6
+    offsets = [37.25, 37.25 + crashed.now + 120]
+    eeg = np.round(np.concatenate([(np.array([t for t, _, value, _ in sim.triggers if value in CONDITION_CODES])
+                                    + offset) * sfreq * (1 + drift)
+                                   for sim, offset in zip([crashed, resumed], offsets)]))
+    epochs = epoch_samples(events, sfreq, alignment=align(events, eeg))
+    np.testing.assert_allclose(epochs['onset'], eeg, atol=1)
+    assert (np.diff(epochs['onset']) > 0).all()
+
+    #the trial cut off by the crash was presented again; its onsets are the rerun's
+    cut = events[(events['trial'] == 100) & (events['kind'] == CONDITION)]
+    assert list(cut['run']) == [0, 1]
+    assert np.isnan(cut['audio_onset'][0]) and not np.isnan(cut['audio_onset'][1])
+    audio = epoch_samples(events, sfreq, onset='audio', alignment=align(events, eeg))
+    assert len(audio) == 512
+    assert (np.diff(audio['onset']) > 0).all()
+
+    with pytest.raises(ValueError):
+        epoch_samples(events, sfreq)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+# frame timing summary: bad trials are reported by their block and trial in the data file
+
+import numpy as np
+
+from msi_timing import FrameTimer, summarise
+
+
+def test_bad_trials_are_named_by_block_and_trial(tmp_path):
+    clock = [0.0]
+    timer = FrameTimer(str(tmp_path / 'timing.npy'), 6, lambda: clock[0])
+    #trial 2 of block 1 drops a frame, trial 1 of block 2 misses its SOA; trial index 4 is never run
+    for index, block, trial, SOA, gaps in [(0, 1, 1, 0, [1, 1]), (1, 1, 2, 0, [1, 2]), (2, 1, 3, 0, [1, 1]),
+                                           (3, 2, 1, 50, [1, 1]), (5, 2, 2, 0, [1, 1])]:
+        timer.start_trial(index, block, trial, SOA)
+        t = 10.0 * index
+        timer.flip(t, visual=True)
+        clock[0] = t - 0.02
+        timer.audio()
+        for gap in gaps:
+            t += gap * 0.01
+            timer.flip(t)
+        timer.end_trial()
+    summary = timer.close()
+    assert summary.n_trials[0] == 5 and summary.n_bad_trials[0] == 2
+    assert summary.bad_trials[0] == '1:2 2:1'
+    assert summarise(np.load(str(tmp_path / 'timing.npy'))).bad_trials[0] == '1:2 2:1'
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# flip-locked triggers on a fake window and clock, recorded by MockPort
+
+import numpy as np
+
+from msi_triggers import MockPort, TriggerScheduler, load_triggers, trigger_latency
+
+
+class FakeWindow:
+    """Flips every frame_dur on a virtual clock and runs callOnFlip callbacks after the swap"""
+
+    def __init__(self, frame_dur=0.01):
+        self.frame_dur = frame_dur
+        self.now = 0.0
+        self._callbacks = []
+
+    def clock(self):
+        return self.now
+
+    def callOnFlip(self, function, *args):
+        self._callbacks.append((function, args))
+
+    def flip(self):
+        self.now = (np.floor(self.now / self.frame_dur + 1e-9) + 1) * self.frame_dur
+        t = self.now
+        callbacks, self._callbacks = self._callbacks, []
+        for function, args in callbacks:
+            function(*args)
+        return t
+
+
+def pulse(triggers, win, value, pulse_frames):
+    """Set value on the next flip and clear it pulse_frames flips later, as msi_b does"""
+    triggers.on_flip(win, value)
+    last_flip = win.flip()
+    for frame in range(pulse_frames):
+        if frame == pulse_frames - 1:
+            triggers.on_flip(win, 0, last_flip)
+        last_flip = win.flip()
+
+
+def test_pulses_have_fixed_width(tmp_path):
+    win = FakeWindow()
+    port = MockPort(win.clock)
+    triggers = TriggerScheduler(str(tmp_path / 'triggers.npy'), 64, port.setData, win.clock)
+    for trial, (value, pulse_frames) in enumerate([(1, 1), (2, 1), (3, 2), (50, 3)]):
+        triggers.start_trial(trial)
+        win.now += 0.1234 #response times are not locked to the frame grid
+        pulse(triggers, win, value, pulse_frames)
+        times = [t for t, _ in port.log[-2:]]
+        assert [v for _, v in port.log[-2:]] == [value, 0]
+        assert np.isclose(times[1] - times[0], pulse_frames * win.frame_dur)
+    events = triggers.close()
+    assert list(events['value']) == [1, 0, 2, 0, 3, 0, 50, 0]
+    assert list(events['trial']) == [0, 0, 1, 1, 2, 2, 3, 3]
+    np.testing.assert_array_equal(events['actual'], [t for t, _ in port.log])
+
+
+def test_log_records_intended_and_actual_times(tmp_path):
+    win = FakeWindow()
+    port = MockPort(win.clock)
+    filename = str(tmp_path / 'triggers.npy')
+    triggers = TriggerScheduler(filename, 8, port.setData, win.clock)
+    triggers.start_trial(0)
+    pulse(triggers, win, 2, 1)
+    triggers.close()
+    events = load_triggers(filename)
+    assert len(events) == 2
+    #the set has no previous flip to predict from; the clear is due one frame after it
+    assert np.isnan(events['intended'][0])
+    assert np.isclose(events['intended'][1], events['actual'][0] + win.frame_dur)
+    np.testing.assert_allclose(trigger_latency(events), 0, atol=1e-12)
+
+
+def test_log_is_bounded_by_max_events(tmp_path):
+    win = FakeWindow()
+    port = MockPort(win.clock)
+    triggers = TriggerScheduler(str(tmp_path / 'triggers.npy'), 3, port.setData, win.clock)
+    triggers.start_trial(0)
+    pulse(triggers, win, 1, 1)
+    pulse(triggers, win, 2, 1)
+    assert len(port.log) == 4
+    assert len(triggers.close()) == 3
+
+
+def test_intended_time_of_a_late_trigger(tmp_path):
+    win = FakeWindow()
+    port = MockPort(win.clock)
+    triggers = TriggerScheduler(str(tmp_path / 'triggers.npy'), 8, port.setData, win.clock)
+    triggers.start_trial(0)
+    prompt = win.flip()
+    win.now += 1.2345 #a response long after the last flip
+    triggers.on_flip(win, 2, prompt)
+    win.flip()
+    events = triggers.close()
+    assert np.isclose(events['intended'][0], prompt + 124 * win.frame_dur)
+    np.testing.assert_allclose(trigger_latency(events), 0, atol=1e-12)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# batched least squares against lmfit on well-conditioned simulated observers, and model comparison
+
+import os
+import numpy as np
+import pytest
+
+from bench_tbw import simulate_msi_a
+from tbw_fit import fit_tbw, fit_binomial, bootstrap_tbw, compare_models, COMPARE_MODELS
+from tbw_models import solve_soas, n_free
+import TBW_fitting
+
+pytest.importorskip('lmfit')
+
+OBSERVERS = [((0.95, 0.03, -120), (0.95, -0.025, 160)),
+             ((0.9, 0.05, -80), (0.85, -0.04, 120)),
+             ((1.0, 0.02, -200), (0.97, -0.015, 250))]
+
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'data' / 'msi_a')
+    monkeypatch.chdir(tmp_path)
+    subjs = [str(i + 1) for i in range(len(OBSERVERS))]
+    for subj, params in zip(subjs, OBSERVERS):
+        simulate_msi_a(subj, params, seed=int(subj), blocks=40).to_csv(TBW_fitting.subject_paths(subj)['data'])
+    return subjs
+
+
+def test_batched_matches_lmfit(cohort):
+    df_rates = [TBW_fitting.sync_rates(TBW_fitting.pd.read_csv(TBW_fitting.subject_paths(s)['data']))
+                for s in cohort]
+    left, right = fit_tbw(df_rates)
+    assert left.success.all() and right.success.all()
+    for i, df_rate in enumerate(df_rates):
+        ref = {}
+        for side, batch in [('left', left), ('right', right)]:
+            result = TBW_fitting.fit_side(df_rate, side)
+            ref[side] = np.array([result.params[k].value for k in 'abc'])
+            assert batch.cost[i] == pytest.approx(0.5 * result.chisqr, rel=1e-6)
+            np.testing.assert_allclose(batch.params[i], ref[side], rtol=1e-3)
+        ref_soas = solve_soas(ref['left'], ref['right'])
+        batch_soas = solve_soas(left.params[i], right.params[i])
+        for name in ref_soas:
+            assert batch_soas[name] == pytest.approx(ref_soas[name], abs=0.1)
+
+
+def test_check_fitter_passes(cohort):
+    assert TBW_fitting.check_fitter(cohort)
+
+
+def test_likelihood_bootstrap_centres_on_ml_fit(cohort):
+    df_rate = TBW_fitting.sync_rates(TBW_fitting.pd.read_csv(TBW_fitting.subject_paths(cohort[0])['data']))
+    left, right = fit_binomial([df_rate])
+    boot = bootstrap_tbw(df_rate, 400, start=(left.params[0], right.params[0]), seed=0, likelihood=True)
+    for fit, resampled in zip([left, right], boot):
+        assert resampled.success.mean() > 0.95
+        #binomial_ml costs are negative log-likelihoods, of the order of the trial count
+        assert (resampled.cost > 1).all()
+        np.testing.assert_allclose(np.median(resampled.params, axis=0), fit.params[0], rtol=0.05)
+
+
+@pytest.mark.parametrize('fitter', ['joint', 'hier'])
+def test_bootstrap_refused_for_shared_fits(cohort, fitter):
+    with pytest.raises(ValueError):
+        TBW_fitting.fit_subject(cohort[0], verbose=False, fitter=fitter, headless=True, bootstrap=10)
+
+
+@pytest.mark.parametrize('fitter', ['lmfit', 'lm'])
+def test_cohort_bootstrap_writes_intervals(cohort, fitter):
+    for folder in ['SOAs', 'plots', 'fit_results']:
+        os.makedirs(os.path.join('data', folder), exist_ok=True)
+    TBW_fitting.fit_cohort(jobs=1, fitter=fitter, bootstrap=50)
+    for subj in cohort:
+        SOA_out = TBW_fitting.pd.read_csv(TBW_fitting.subject_paths(subj)['SOAs'], index_col=0)
+        assert 'stable' in SOA_out
+        assert (SOA_out.ASOA50_lo[0] < SOA_out.ASOA50[0] < SOA_out.ASOA50_hi[0])
+
+
+def test_compare_models_table(cohort):
+    df_rates = [TBW_fitting.sync_rates(TBW_fitting.pd.read_csv(TBW_fitting.subject_paths(s)['data']))
+                for s in cohort]
+    fits, table = compare_models(df_rates, jobs=1)
+    assert list(fits) == COMPARE_MODELS
+    assert len(table) == len(cohort) * len(COMPARE_MODELS)
+    for model, rows in table.groupby('model'):
+        assert (rows.n_params == 2 * n_free(model)).all()
+    assert (table.groupby('subject').delta.min() == 0).all()
+    assert (table.groupby('subject').selected.sum() == 1).all()
+
+    #sigmoid observers with plenty of trials keep the reference model
+    assert list(table[table.selected].sort_values('subject').model) == ['sigmoid'] * len(cohort)
+
+
+def test_compare_models_margin(cohort):
+    df_rates = [TBW_fitting.sync_rates(TBW_fitting.pd.read_csv(TBW_fitting.subject_paths(s)['data']))
+                for s in cohort]
+    _, table = compare_models(df_rates, jobs=1, margin=0)
+    best = table[table.success].sort_values('bic').groupby('subject').head(1).set_index('subject').model
+    assert (table[table.selected].set_index('subject').model.sort_index() == best.sort_index()).all()
+    _, table = compare_models(df_rates, models=['gumbel', 'sigmoid'], jobs=1, margin=np.inf)
+    assert (table[table.selected].model == 'gumbel').all()
+
+
+def test_fixed_asymptote_is_not_a_candidate():
+    #sigmoid1 saves more BIC than SELECT_MARGIN and was picked for observers with a < 1
+    assert 'sigmoid1' not in COMPARE_MODELS
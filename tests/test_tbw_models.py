@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# model registry: closed-form inverses and analytic Jacobians of every model
+
+import numpy as np
+import pytest
+
+from tbw_models import MODELS, SOA_TARGETS, solve_soas, fixed_params, n_free, side_model
+
+ONE_SIDED = [name for name, m in MODELS.items() if m.inverse is not None]
+
+#one parameter set per side (a, b, c) and a batch of both, as the fitters pass them
+PARAMS = {'left': np.array([[0.95, 0.03, -120], [0.8, 0.05, -60]]),
+          'right': np.array([[0.95, -0.025, 160], [0.9, -0.04, 90]])}
+
+
+@pytest.mark.parametrize('model', ONE_SIDED)
+@pytest.mark.parametrize('side', ['left', 'right'])
+def test_inverse_round_trips(model, side):
+    params = PARAMS[side]
+    y = np.array([0.05, 0.25, 0.5, 0.75])
+    for p in params:
+        x = MODELS[model].inverse(y, p)
+        np.testing.assert_allclose(MODELS[model].forward(x, p), y, rtol=1e-9)
+
+
+@pytest.mark.parametrize('model', ONE_SIDED)
+def test_inverse_is_nan_where_unreachable(model):
+    p = PARAMS['left'][1] #asymptote 0.8
+    assert np.isnan(MODELS[model].inverse(np.array([0, 0.8, 0.9]), p)).all()
+    assert np.isnan(MODELS[model].inverse(0.5, [0.9, 0, -100]))
+
+
+@pytest.mark.parametrize('model', ONE_SIDED)
+def test_inverse_is_vectorized(model):
+    soas = solve_soas(PARAMS['left'], PARAMS['right'], model)
+    assert list(soas) == list(SOA_TARGETS)
+    for i in range(len(PARAMS['left'])):
+        single = solve_soas(PARAMS['left'][i], PARAMS['right'][i], model)
+        for name in soas:
+            assert soas[name].shape == (len(PARAMS['left']),)
+            assert soas[name][i] == pytest.approx(float(single[name]))
+
+
+@pytest.mark.parametrize('model', list(MODELS))
+def test_jacobian_matches_finite_differences(model):
+    m = MODELS[model]
+    if model == 'joint':
+        params = np.array([[0.95, 0.03, -120, -0.025, 160], [0.85, 0.05, -60, -0.04, 90]])
+    else:
+        params = np.concatenate([PARAMS['left'], PARAMS['right']])
+    x = np.arange(-300, 301, 25.0)
+    J = m.jacobian(x, params)
+    assert J.shape == params.shape[:-1] + (len(x), len(m.param_names))
+    for k in range(params.shape[-1]):
+        h = 1e-6 * np.maximum(np.abs(params[:, k]), 1e-3)
+        up, down = params.copy(), params.copy()
+        up[:, k] += h
+        down[:, k] -= h
+        numeric = (m.forward(x, up) - m.forward(x, down)) / (2 * h[:, np.newaxis])
+        np.testing.assert_allclose(J[..., k], numeric, rtol=1e-5, atol=1e-8)
+
+
+def test_fixed_parameters():
+    fixed, values = fixed_params('sigmoid1')
+    assert list(fixed) == [True, False, False] and values[0] == 1
+    assert n_free('sigmoid1') == 2 and n_free('gumbel') == 3 and n_free('joint') == 5
+    assert side_model('gumbel_ml') == 'gumbel' and side_model('joint') == 'sigmoid'